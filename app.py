@@ -1,230 +1,1436 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
+from werkzeug.http import is_resource_modified
 import base64
+import hashlib
+import hmac
 import os
 import time
 import json
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.backends import default_backend
-import io
+import collections
+import itertools
+import shutil
+import subprocess
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import archive
+import blobstore
+import capture
+import feed
+import renditions
+import storage
+import crypto_pool
+from crypto_pool import CryptoExecutor, QueueFull
+import keystore
+import catalog
+import metrics
+import profiler
+import retention
+from catalog import Catalog
+from image_cache import DecryptedImageCache, cache_key
+from ingest import IngestJournal, IngestWorkers
+from upload_streams import (
+    DecodedBody, MalformedUpload, MeteredStream, MultipartImageReader, iter_multipart_files
+)
 
 
 app = Flask(__name__, static_folder='static')
 CORS(app)  # Enable CORS for all routes
 
-# Create static directory for frontend files if it doesn't exist
+# Importing this module has no side effects: directories, keys, the catalog
+# and the ingest journal are set up by initialize(), which runs before the
+# first request (or earlier, from serve.py or init_storage.py)
+
+# Static directory for frontend files
 STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-if not os.path.exists(STATIC_DIR):
-    os.makedirs(STATIC_DIR)
 
-# Create storage directory if it doesn't exist
+# Storage directory for encrypted images
 STORAGE_DIR = 'secure_images'
-if not os.path.exists(STORAGE_DIR):
-    os.makedirs(STORAGE_DIR)
-
-# Key files
-PRIVATE_KEY_FILE = os.path.join(STORAGE_DIR, "private_key.pem")
-PUBLIC_KEY_FILE = os.path.join(STORAGE_DIR, "public_key.pem")
-
-# Generate or load RSA keys
-def get_rsa_keys():
-    if os.path.exists(PRIVATE_KEY_FILE) and os.path.exists(PUBLIC_KEY_FILE):
-        # Load existing keys
-        with open(PRIVATE_KEY_FILE, "rb") as f:
-            private_key = serialization.load_pem_private_key(
-                f.read(),
-                password=None,
-                backend=default_backend()
-            )
-        
-        with open(PUBLIC_KEY_FILE, "rb") as f:
-            public_key = serialization.load_pem_public_key(
-                f.read(),
-                backend=default_backend()
-            )
-    else:
-        # Generate new key pair
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
-        public_key = private_key.public_key()
-        
-        # Save private key
-        with open(PRIVATE_KEY_FILE, "wb") as f:
-            f.write(private_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.PKCS8,
-                encryption_algorithm=serialization.NoEncryption()
-            ))
-        
-        # Save public key
-        with open(PUBLIC_KEY_FILE, "wb") as f:
-            f.write(public_key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            ))
-    
-    return private_key, public_key
 
-# Get or generate RSA keys
-private_key, public_key = get_rsa_keys()
+def key_file_lock():
+    """Hold an exclusive lock while the key files are checked or created"""
+    return keystore.key_file_lock(STORAGE_DIR)
+
+# Keyring, opened (and the first key pair generated) on first use, and
+# reloaded after rotate_key.py
+crypto = keystore.LazyKeyring(STORAGE_DIR)
+
+# Storage backend: 'files' (one file per image plus a metadata sidecar) or
+# 'packs' (images appended to pack files of PACK_BYTES, see blobstore.py)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'files').lower()
+PACK_BYTES = int(os.environ.get('PACK_BYTES', blobstore.DEFAULT_PACK_BYTES))
+image_store = blobstore.open_store(STORAGE_DIR, STORAGE_BACKEND, pack_bytes=PACK_BYTES)
+
+# Catalog of stored images (SQLite), backfilled from the store on first run
+CATALOG_PATH = os.environ.get('CATALOG_PATH', os.path.join(STORAGE_DIR, 'catalog.db'))
+image_catalog = Catalog(CATALOG_PATH, STORAGE_DIR, records=image_store.iter_records)
+
+# Live feed of newly stored images (/api/images/events). Every open stream
+# holds a web server thread, so there are at most FEED_MAX_CLIENTS per
+# process, each closed after FEED_MAX_SECONDS (clients reconnect and resume)
+FEED_MAX_CLIENTS = int(os.environ.get('FEED_MAX_CLIENTS', '4'))
+FEED_MAX_SECONDS = int(os.environ.get('FEED_MAX_SECONDS', '300'))
+image_feed = feed.ImageFeed(
+    image_catalog, max_clients=FEED_MAX_CLIENTS, max_seconds=FEED_MAX_SECONDS
+)
 
 def encrypt_data(data):
-    """Encrypt data using RSA public key"""
-    # Since RSA can only encrypt small amounts of data,
-    # we'll chunk the data into appropriate sizes
-    chunk_size = 190  # Leave room for padding (for 2048-bit key)
-    chunks = [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
-    encrypted_chunks = []
-    
-    for chunk in chunks:
-        encrypted_chunk = public_key.encrypt(
-            chunk,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
-        encrypted_chunks.append(encrypted_chunk)
-    
-    # Return encrypted chunks with their lengths for easier decryption later
-    result = []
-    for chunk in encrypted_chunks:
-        # Store the length (4 bytes) followed by the encrypted chunk
-        length = len(chunk).to_bytes(4, byteorder='big')
-        result.append(length + chunk)
-    
-    return b''.join(result)
+    """Encrypt data using a one-time AES key wrapped with the RSA public key"""
+    return crypto.encrypt(data)
 
 def decrypt_data(encrypted_data):
-    """Decrypt data using RSA private key"""
-    # Parse the encrypted chunks
-    data = io.BytesIO(encrypted_data)
-    decrypted_chunks = []
-    
-    while data.tell() < len(encrypted_data):
-        # Read the length (4 bytes)
-        chunk_length = int.from_bytes(data.read(4), byteorder='big')
-        # Read the chunk
-        encrypted_chunk = data.read(chunk_length)
-        
-        # Decrypt the chunk
-        decrypted_chunk = private_key.decrypt(
-            encrypted_chunk,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
+    """Decrypt data using RSA private key (handles legacy chunked files)"""
+    return crypto.decrypt(encrypted_data)
+
+# Sampling profiler, switched on through /api/admin/profiler. Every web and
+# crypto worker process follows the control file in PROFILE_DIR and writes
+# its profiles there
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(STORAGE_DIR, '.profiles'))
+profiler_control = profiler.ProfilerControl(PROFILE_DIR, label='web')
+
+# Retention and garbage collection: one process at a time sweeps the store
+# every GC_INTERVAL seconds (0 to only sweep through /api/admin/gc), deleting
+# images older than RETENTION_DAYS or over RETENTION_MAX_BYTES of ciphertext
+# (0 for no limit) and removing orphaned files, at most GC_RATE files a second
+RETENTION_DAYS = float(os.environ.get('RETENTION_DAYS', '0'))
+RETENTION_MAX_BYTES = int(os.environ.get('RETENTION_MAX_BYTES', '0'))
+GC_INTERVAL = float(os.environ.get('GC_INTERVAL', '3600'))
+GC_RATE = float(os.environ.get('GC_RATE', retention.DEFAULT_RATE))
+garbage_collector = retention.GarbageCollector(
+    STORAGE_DIR, image_catalog, image_store, max_age=int(RETENTION_DAYS * 86400),
+    max_bytes=RETENTION_MAX_BYTES, rate=GC_RATE
+)
+
+# Token required by the /api/admin endpoints, which are off without one
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Crypto executor: thread or process pool that runs encryption/decryption
+# off the request thread, with a bounded queue
+CRYPTO_EXECUTOR = os.environ.get('CRYPTO_EXECUTOR', 'thread').lower()
+CRYPTO_WORKERS = int(os.environ.get('CRYPTO_WORKERS', os.cpu_count() or 1))
+CRYPTO_MAX_QUEUE = int(os.environ.get('CRYPTO_MAX_QUEUE', CRYPTO_WORKERS * 16))
+CRYPTO_RETRY_AFTER = int(os.environ.get('CRYPTO_RETRY_AFTER', '1'))
+
+crypto_pool.set_provider(crypto)
+crypto_executor = CryptoExecutor(
+    kind=CRYPTO_EXECUTOR,
+    workers=CRYPTO_WORKERS,
+    max_queue=CRYPTO_MAX_QUEUE,
+    retry_after=CRYPTO_RETRY_AFTER,
+    key_dir=STORAGE_DIR,
+    prepare=crypto.load,
+    profile_dir=PROFILE_DIR
+)
+
+# Renditions made after an upload run on an executor of their own, so a
+# burst of them never takes the slots uploads and decrypts are admitted to
+RENDITION_WORKERS = int(os.environ.get('RENDITION_WORKERS', '1'))
+RENDITION_MAX_QUEUE = int(os.environ.get('RENDITION_MAX_QUEUE', RENDITION_WORKERS * 16))
+rendition_executor = CryptoExecutor(
+    kind=CRYPTO_EXECUTOR,
+    workers=RENDITION_WORKERS,
+    max_queue=RENDITION_MAX_QUEUE,
+    key_dir=STORAGE_DIR,
+    prepare=crypto.load,
+    profile_dir=PROFILE_DIR
+)
+
+# Number of segments decrypted per crypto job when streaming a response
+SEGMENTS_PER_JOB = 16
+
+# Cache of recently decrypted images, bounded by total plaintext bytes
+DECRYPT_CACHE_BYTES = int(os.environ.get('DECRYPT_CACHE_BYTES', 64 * 1024 * 1024))
+DECRYPT_CACHE_MAX_ITEM = int(os.environ.get('DECRYPT_CACHE_MAX_ITEM', 8 * 1024 * 1024))
+DECRYPT_CACHE_TTL = int(os.environ.get('DECRYPT_CACHE_TTL', '0'))
+decrypt_cache = DecryptedImageCache(
+    DECRYPT_CACHE_BYTES, max_item_bytes=DECRYPT_CACHE_MAX_ITEM, ttl=DECRYPT_CACHE_TTL
+)
+
+# Cache-Control sent with decrypted images; stored images never change
+IMAGE_CACHE_CONTROL = os.environ.get('IMAGE_CACHE_CONTROL', 'private, max-age=86400')
+
+# Renditions made in the background for every upload (empty to disable);
+# others are made on their first request
+INGEST_RENDITIONS = [
+    name.strip() for name in os.environ.get('RENDITIONS', 'thumb,medium').split(',')
+    if name.strip()
+]
+for name in INGEST_RENDITIONS:
+    if name not in renditions.SIZES:
+        raise ValueError(f"Unknown rendition {name!r} in RENDITIONS")
+
+# Capture policy published at /api/config for the capture page, and
+# enforced on uploads: larger images are scaled down (or rejected)
+capture_policy = capture.CapturePolicy(
+    max_width=int(os.environ.get('CAPTURE_MAX_WIDTH', '1920')),
+    max_height=int(os.environ.get('CAPTURE_MAX_HEIGHT', '1080')),
+    max_bytes=int(os.environ.get('MAX_UPLOAD_BYTES', 16 * 1024 * 1024)),
+    format=os.environ.get('CAPTURE_FORMAT', 'image/jpeg'),
+    quality=float(os.environ.get('CAPTURE_QUALITY', '0.85')),
+    oversize=os.environ.get('CAPTURE_OVERSIZE', 'downscale')
+)
+
+# Metrics, served at /metrics in the Prometheus text format
+metrics_registry = metrics.Registry()
+HTTP_REQUESTS = metrics_registry.counter(
+    'http_requests_total', "HTTP requests by method, route and status",
+    ('method', 'route', 'status')
+)
+HTTP_LATENCY = metrics_registry.histogram(
+    'http_request_duration_seconds', "Time until the whole response was handed to the server",
+    ('method', 'route')
+)
+HTTP_RESPONSE_BYTES = metrics_registry.counter(
+    'http_response_bytes_total', "Response body bytes by route", ('route',)
+)
+# Stages: receive, decode, encrypt, write, sync, metadata, catalog (storing)
+# and unwrap, decrypt, send (serving)
+STAGE_SECONDS = metrics_registry.histogram(
+    'stage_duration_seconds', "Time spent per stage of storing or serving one image", ('stage',)
+)
+UPLOAD_BYTES = metrics_registry.counter(
+    'upload_received_bytes_total', "Upload request body bytes received"
+)
+IMAGES_STORED = metrics_registry.counter('images_stored_total', "Images stored")
+STORED_BYTES = metrics_registry.counter(
+    'stored_bytes_total', "Bytes of stored images, plaintext and ciphertext", ('kind',)
+)
+IMAGE_BYTES_SENT = metrics_registry.counter(
+    'decrypted_bytes_sent_total', "Decrypted image bytes sent"
+)
+IMAGES_EXPORTED = metrics_registry.counter(
+    'images_exported_total', "Images written to export archives", ('content',)
+)
+
+def executor_stat(name):
+    return lambda: crypto_executor.stats()[name]
+
+def when_initialized(callback):
+    """Scrape-time callback that reports nothing until initialize() has run"""
+    return lambda: callback() if _initialized else {}
+
+metrics_registry.gauge('crypto_jobs_in_flight', "Crypto jobs running or queued",
+                       callback=executor_stat('in_flight'))
+metrics_registry.gauge('crypto_queue_depth', "Crypto jobs waiting for a worker",
+                       callback=executor_stat('queue_depth'))
+metrics_registry.counter('crypto_jobs_completed_total', "Crypto jobs completed",
+                         callback=executor_stat('completed'))
+metrics_registry.counter('crypto_jobs_rejected_total', "Crypto jobs turned away with 503",
+                         callback=executor_stat('rejected'))
+metrics_registry.counter('gc_removed_total', "Files and records removed by garbage collection",
+                         ('reason',), callback=lambda: {
+                             (reason,): garbage_collector.removed[reason]
+                             for reason in retention.REASONS
+                         })
+metrics_registry.counter('gc_freed_bytes_total', "Disk bytes freed by garbage collection",
+                         callback=lambda: garbage_collector.freed_bytes)
+metrics_registry.counter('gc_compacted_packs_total', "Pack files compacted by garbage collection",
+                         callback=lambda: garbage_collector.compacted_packs)
+metrics_registry.counter('gc_sweeps_total', "Garbage collection sweeps completed",
+                         callback=lambda: garbage_collector.sweeps)
+metrics_registry.gauge('feed_clients', "Open image feed streams",
+                       callback=lambda: image_feed.clients)
+metrics_registry.counter('feed_events_sent_total', "Image events sent to feed clients",
+                         callback=lambda: image_feed.events_sent)
+metrics_registry.gauge('decrypt_cache_bytes', "Plaintext bytes in the decrypted image cache",
+                       callback=lambda: decrypt_cache.stats()["bytes"])
+metrics_registry.counter('decrypt_cache_hits_total', "Decrypted image cache hits",
+                         callback=lambda: decrypt_cache.stats()["hits"])
+metrics_registry.counter('decrypt_cache_misses_total', "Decrypted image cache misses",
+                         callback=lambda: decrypt_cache.stats()["misses"])
+metrics_registry.counter('capture_policy_total', "Uploads scaled down or rejected by the capture policy",
+                         ('action',), callback=lambda: {
+                             ('downscaled',): capture_policy.downscaled,
+                             ('rejected',): capture_policy.rejected
+                         })
+
+# Gauges of shared state (storage, catalog, ingest journal) are read by the
+# process being scraped only, not added up over the server's processes
+LOCAL_METRICS = (
+    'storage_images', 'storage_image_bytes', 'storage_free_bytes', 'storage_size_bytes',
+    'ingest_pending_jobs', 'dedup_duplicate_images', 'dedup_saved_bytes', 'dedup_ratio'
+)
+metrics_registry.gauge('storage_images', "Images in the catalog",
+                       callback=when_initialized(lambda: image_catalog.count()))
+metrics_registry.gauge('storage_image_bytes', "Ciphertext bytes of the catalogued images",
+                       callback=when_initialized(lambda: image_catalog.total_size()))
+metrics_registry.gauge('storage_free_bytes', "Free bytes on the storage volume",
+                       callback=when_initialized(lambda: shutil.disk_usage(STORAGE_DIR).free))
+metrics_registry.gauge('storage_size_bytes', "Size of the storage volume in bytes",
+                       callback=when_initialized(lambda: shutil.disk_usage(STORAGE_DIR).total))
+metrics_registry.gauge('ingest_pending_jobs', "Uploads journaled and not yet stored",
+                       callback=lambda: ingest_journal.count() if ingest_journal else {})
+metrics_registry.gauge('dedup_duplicate_images', "Images stored as links to an identical image",
+                       callback=when_initialized(lambda: image_catalog.dedup_stats()["duplicates"]))
+metrics_registry.gauge('dedup_saved_bytes', "Ciphertext bytes not written thanks to deduplication",
+                       callback=when_initialized(lambda: image_catalog.dedup_stats()["bytes_saved"]))
+metrics_registry.gauge('dedup_ratio', "Catalogued images per distinct stored ciphertext",
+                       callback=when_initialized(lambda: image_catalog.dedup_stats()["ratio"]))
+
+# With METRICS_DIR set the processes of a multi-process server share their
+# metrics through snapshot files there (serve.py sets this up)
+METRICS_DIR = os.environ.get('METRICS_DIR')
+metrics_exporter = None
+
+def share_metrics(directory=None):
+    """Aggregate /metrics over all worker processes; call before forking
+
+    Removes the snapshots of an earlier run from the directory.
+    """
+    global metrics_exporter
+    directory = directory or METRICS_DIR or os.path.join(STORAGE_DIR, '.metrics')
+    metrics.clear_directory(directory)
+    metrics_exporter = metrics.MultiProcessExporter(
+        metrics_registry, directory, local=LOCAL_METRICS
+    )
+
+if METRICS_DIR:
+    metrics_exporter = metrics.MultiProcessExporter(
+        metrics_registry, METRICS_DIR, local=LOCAL_METRICS
+    )
+
+app.wsgi_app = metrics.RequestMetrics(app.wsgi_app, HTTP_REQUESTS, HTTP_LATENCY, HTTP_RESPONSE_BYTES)
+app.wsgi_app = profiler.RequestProfiler(
+    app.wsgi_app, profiler_control, route_key=metrics.RequestMetrics.ROUTE_KEY
+)
+
+def observe_stored(result, receive_time=None):
+    """Record the stage times and sizes of one image stored by encrypt_job
+
+    Duplicates (see store_duplicate()) wrote no ciphertext of their own.
+    """
+    if receive_time is not None:
+        STAGE_SECONDS.observe(receive_time, 'receive')
+    IMAGES_STORED.inc()
+    STORED_BYTES.inc('plaintext', amount=result["image_bytes"])
+    if result.get("duplicate"):
+        return
+    STAGE_SECONDS.observe(result["encrypt_time"], 'encrypt')
+    STAGE_SECONDS.observe(result["write_time"], 'write')
+    STORED_BYTES.inc('ciphertext', amount=result["size"])
+
+def send_timed(chunks):
+    """Pass response chunks through, recording how long the server took to send them"""
+    sent = 0
+    waited = 0.0
+    try:
+        for chunk in chunks:
+            start = time.perf_counter()
+            yield chunk
+            waited += time.perf_counter() - start
+            sent += len(chunk)
+    finally:
+        STAGE_SECONDS.observe(waited, 'send')
+        IMAGE_BYTES_SENT.inc(amount=sent)
+
+def busy_response(e):
+    """503 response telling the client when to retry"""
+    response = jsonify({"error": str(e)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def encrypt_to_store(source, filename):
+    """Encrypt bytes or an upload stream for a new image on the crypto executor
+
+    A stream is read on this thread (see crypto_pool.encrypt_upload). With
+    the file backend the ciphertext goes straight into the image's file;
+    with packs it comes back in the result, for save_images().
+    """
+    target = image_store.target(filename)
+    if isinstance(source, bytes):
+        return crypto_executor.run(crypto_pool.encrypt_job, source, target)
+    return crypto_pool.encrypt_upload(crypto_executor, source, target)
+
+def open_encrypted(location):
+    """Read the header of a stored image on the crypto executor
+
+    Returns (opened, size): what crypto_pool.open_job returned and the
+    plaintext length.
+    """
+    with STAGE_SECONDS.time('unwrap'):
+        opened = crypto_executor.run(crypto_pool.open_job, location)
+    size = len(opened[1]) if opened[0] == 'whole' else opened[4]
+    return opened, size
+
+def decrypt_file_stream(location, opened, start=0, stop=None, block=False):
+    """Return an iterable of the decrypted bytes in [start, stop) of a stored image
+
+    opened comes from open_encrypted(). Segmented files are decrypted a few
+    segments per crypto job, starting at the segment that holds start, with
+    the next job submitted while the current one is being sent. The first
+    job runs before this returns so that key errors are reported before the
+    response starts; with block=True it waits for room on the crypto
+    executor instead of raising QueueFull. Nothing is written to disk.
+    """
+    if opened[0] == 'whole':
+        return [opened[1][start:stop]]
+    _, header, data_key, total, size = opened
+    stop = size if stop is None else min(stop, size)
+    if start >= stop:
+        return []
+
+    # Only decrypt the segments that cover the requested bytes
+    first_segment = start // header.segment_size
+    end_segment = (stop - 1) // header.segment_size + 1
+    offset = first_segment * header.segment_size
+
+    def submit(first, block):
+        count = min(SEGMENTS_PER_JOB, end_segment - first)
+        return crypto_executor.submit(
+            crypto_pool.decrypt_segments_job,
+            location, header, data_key, first, count, total,
+            block=block
         )
-        decrypted_chunks.append(decrypted_chunk)
+
+    # Time this response spends waiting for decryption
+    waited = [0.0]
+
+    def wait(future):
+        start = time.perf_counter()
+        result = future.result()
+        waited[0] += time.perf_counter() - start
+        return result
+
+    first = wait(submit(first_segment, block=block))
+
+    def trim(chunk, position):
+        # Cut the parts of the first and last chunk outside [start, stop)
+        if start <= position and position + len(chunk) <= stop:
+            return chunk
+        return chunk[max(start - position, 0):stop - position]
+
+    def generate():
+        position = offset
+        current = first
+        try:
+            for index in range(first_segment + SEGMENTS_PER_JOB, end_segment, SEGMENTS_PER_JOB):
+                future = submit(index, block=True)
+                yield trim(current, position)
+                position += len(current)
+                current = wait(future)
+            yield trim(current, position)
+        finally:
+            STAGE_SECONDS.observe(waited[0], 'decrypt')
+
+    return generate()
+
+def cache_while_streaming(chunks, key):
+    """Pass chunks through and cache their concatenation once all were sent"""
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    decrypt_cache.put(key, b''.join(parts))
+
+def image_metadata(filename, original_timestamp, server_timestamp, **fields):
+    """Metadata of a stored image, kept in its sidecar or pack record
+
+    fields are extra entries, such as the dedup digest.
+    """
+    return {
+        "original_timestamp": original_timestamp,
+        "server_timestamp": server_timestamp,
+        "filename": filename,
+        **fields
+    }
+
+def save_images(stored, sync=False):
+    """Commit encrypted images to the image store and the catalog
+
+    stored holds (filename, result, metadata) tuples, where result is what
+    encrypt_job returned. The store writes the metadata (and with packs the
+    ciphertext), sync=True flushes everything to stable storage, and the
+    images are added to the catalog in one transaction. If the catalog
+    can't be updated the images are deleted again, so the catalog and the
+    store never disagree.
+    """
+    try:
+        with STAGE_SECONDS.time('metadata'):
+            image_store.commit(stored)
+    except Exception:
+        for filename, _, _ in stored:
+            image_store.discard(filename)
+        raise
+    try:
+        if sync:
+            with STAGE_SECONDS.time('sync'):
+                image_store.sync([filename for filename, _, _ in stored])
+        with STAGE_SECONDS.time('catalog'):
+            image_catalog.add([
+                dict(metadata, size=result["size"], sha256=result["sha256"])
+                for _, result, metadata in stored
+            ])
+    except Exception:
+        for filename, _, _ in stored:
+            image_store.delete(filename)
+        raise
+    image_feed.notify()
+
+def schedule_renditions(filename):
+    """Make the ingest renditions of a stored image off the request path
+
+    They run on rendition_executor. When it is busy the renditions are
+    skipped; they are then made on their first request instead.
+    """
+    if not INGEST_RENDITIONS or not renditions.available():
+        return
+    # Duplicates already have the renditions of the image they share
+    names = [name for name in INGEST_RENDITIONS if image_store.locate(filename, name) is None]
+    location = image_store.locate(filename)
+    if not names or location is None:
+        return
+    try:
+        future = rendition_executor.submit(crypto_pool.rendition_job, location, names)
+    except QueueFull:
+        return
+
+    def store(future):
+        try:
+            image_store.put_renditions(filename, future.result())
+        except Exception as e:
+            print(f"Rendition error for {filename}: {str(e)}")
+
+    future.add_done_callback(store)
+
+def rendition_location(filename, location, name):
+    """Return where a rendition of a stored image is, making it if needed
+
+    Returns None if the image was deleted meanwhile. Raises ValueError if
+    the stored image can't be decoded as a picture.
+    """
+    rendition = image_store.locate(filename, name)
+    if rendition is None:
+        rendered = crypto_executor.run(crypto_pool.rendition_job, location, [name])
+        image_store.put_renditions(filename, rendered)
+        rendition = image_store.locate(filename, name)
+    return rendition
+
+# Asynchronous ingest: with INGEST_MODE=async uploads are journaled and
+# answered with 202, and background workers store them
+INGEST_MODE = os.environ.get('INGEST_MODE', 'sync').lower()
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', '2'))
+INGEST_DIR = os.environ.get('INGEST_DIR', os.path.join(STORAGE_DIR, '.ingest'))
+INGEST_KEY_FILE = os.path.join(INGEST_DIR, 'spool.key')
+
+def load_or_create_key(path):
+    """Load a 256-bit secret key from path, creating it on first use"""
+    with key_file_lock():
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+        key = AESGCM.generate_key(bit_length=256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        storage.write_atomic(path, key, fsync=True, permissions=0o600)
+        return key
+
+def get_spool_key():
+    """Load or create the key that seals journaled uploads"""
+    return load_or_create_key(INGEST_KEY_FILE)
+
+# Deduplication: with DEDUP=true an upload identical to a stored image is
+# stored as a hard link to that image's ciphertext instead of being
+# encrypted again. The link count is the reference count, so deleting any
+# one of the images never affects the others. Pack storage has no links and
+# stores duplicates again.
+DEDUP = os.environ.get('DEDUP', 'false').lower() == 'true'
+DEDUP_KEY_FILE = os.path.join(STORAGE_DIR, 'dedup.key')
+
+# Key of the content hash, loaded by initialize() when DEDUP is on. Keyed so
+# that the catalog doesn't reveal whether it holds a given picture
+dedup_key = None
+
+def content_digest(data):
+    """Keyed hash of an image's plaintext, as stored in the catalog"""
+    return hashlib.blake2b(data, key=dedup_key, digest_size=32).hexdigest()
+
+def store_duplicate(data, filename):
+    """Store data as a link to an identical stored image, if there is one
+
+    Returns (result, fields). result is shaped like encrypt_job's, or None
+    when the image still has to be encrypted; fields are the dedup columns
+    for its catalog record. Without DEDUP both are empty.
+    """
+    if not DEDUP or not data:
+        return None, {}
+    with STAGE_SECONDS.time('dedup'):
+        digest = content_digest(data)
+        row = image_catalog.find_digest(digest)
+        if row is None or not image_store.link(row["filename"], filename):
+            return None, {"digest": digest}
+    result = {
+        "image_bytes": len(data),
+        "size": blobstore.stat_location(image_store.locate(filename)).st_size,
+        "sha256": row["sha256"],
+        "duplicate": True
+    }
+    # Point at the image that was stored first, not at another duplicate
+    return result, {"digest": digest, "blob": row["blob"] or row["filename"]}
+
+def store_journaled(image_id, fields, payload):
+    """Store one journaled upload; runs on an ingest worker"""
+    filename = storage.image_filename(image_id)
+    result, dedup_fields = store_duplicate(payload, filename)
+    if result is None:
+        # Wait for room on the crypto executor rather than failing the job
+        result = crypto_executor.submit(
+            crypto_pool.encrypt_job, payload, image_store.target(filename), block=True
+        ).result()
+    metadata = image_metadata(
+        filename, fields["original_timestamp"], fields["server_timestamp"], **dedup_fields
+    )
+    save_images([(filename, result, metadata)])
+    observe_stored(result)
+    schedule_renditions(filename)
+
+# Set up by initialize()
+ingest_journal = ingest_workers = None
+
+_init_lock = threading.Lock()
+_initialized = False
+_background_init = None
+
+def initialize():
+    """Create the storage directory, keys, catalog and ingest journal
+
+    Safe to call more than once; only the first call does any work. On a
+    fresh volume this generates the RSA key pair, which takes a while.
+    """
+    global ingest_journal, ingest_workers, dedup_key, _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+        os.makedirs(STATIC_DIR, exist_ok=True)
+        os.makedirs(STORAGE_DIR, exist_ok=True)
+        crypto.load()
+        image_store.open()
+        image_catalog.open()
+        if DEDUP:
+            dedup_key = load_or_create_key(DEDUP_KEY_FILE)
+        # The journal is also opened in sync mode if it exists, so that jobs
+        # left from an earlier async run are still stored
+        if INGEST_MODE == 'async' or os.path.isdir(INGEST_DIR):
+            ingest_journal = IngestJournal(INGEST_DIR, get_spool_key())
+            ingest_workers = IngestWorkers(
+                ingest_journal, store_journaled, workers=INGEST_WORKERS,
+                transient=(OSError, QueueFull)
+            )
+        _initialized = True
+
+def initialize_in_background():
+    """Start initialize() on a thread unless it is done or already running"""
+    global _background_init
+    with _init_lock:
+        if _initialized or _background_init is not None:
+            return
+        _background_init = threading.Thread(target=initialize, name='initialize', daemon=True)
+        _background_init.start()
+
+def start_background_workers():
+    """Start this process's background threads
+
+    These are the ingest workers (which replay any queued jobs), metrics
+    flushing, the profiler's control file watcher and garbage collection.
+    """
+    if ingest_workers is not None:
+        ingest_workers.start()
+    if metrics_exporter is not None:
+        metrics_exporter.start()
+    profiler_control.start()
+    if GC_INTERVAL > 0:
+        garbage_collector.start(GC_INTERVAL)
+
+# Endpoints that must answer while the app is still initializing
+PROBE_ENDPOINTS = ('status', 'ready', 'export_metrics')
+
+@app.before_request
+def label_route():
+    # Route label for the request metrics: the URL rule, not the URL
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    request.environ[metrics.RequestMetrics.ROUTE_KEY] = rule
+
+@app.before_request
+def ensure_initialized():
+    if request.endpoint in PROBE_ENDPOINTS:
+        return
+    initialize()
+    # Covers servers other than serve.py, which starts them after fork
+    start_background_workers()
+
+# Content types accepted as a raw image body on /api/upload
+RAW_UPLOAD_TYPES = ('application/octet-stream', 'image/jpeg', 'image/png', 'image/webp')
+
+def upload_source(req):
+    """Return (mode, source) for an upload request
+
+    JSON bodies carry a base64 image and are decoded up front. Multipart and
+    raw bodies are wrapped so they are read straight from the request stream
+    while being encrypted.
+    """
+    if req.mimetype == 'multipart/form-data':
+        boundary = req.mimetype_params.get('boundary')
+        if not boundary:
+            return 'multipart', None
+        return 'multipart', MultipartImageReader(req.stream, boundary.encode('latin-1'))
+
+    if req.mimetype in RAW_UPLOAD_TYPES:
+        if not req.content_length and 'chunked' not in req.headers.get('Transfer-Encoding', ''):
+            return 'raw', None
+        return 'raw', MeteredStream(req.stream)
+
+    parse_start = time.perf_counter()
+    data = req.get_json(silent=True)
+    if not data or 'image' not in data:
+        return 'json', None
+    decode_start = time.perf_counter()
+    image_data = base64.b64decode(data['image'])
+    decoded = time.perf_counter()
+    STAGE_SECONDS.observe(decode_start - parse_start, 'receive')
+    STAGE_SECONDS.observe(decoded - decode_start, 'decode')
+    return 'json', DecodedBody(
+        image_data,
+        bytes_received=req.content_length or 0,
+        parse_time=decoded - parse_start,
+        fields={'timestamp': data.get('timestamp', '')}
+    )
+
+def capture_timestamp(source):
+    """Capture timestamp from the JSON body, a form field or a header"""
+    return source.fields.get(
+        'timestamp',
+        request.headers.get('X-Capture-Timestamp', request.args.get('timestamp', ''))
+    )
+
+def enqueue_upload(mode, source):
+    """Journal an upload for the ingest workers and answer 202 Accepted"""
+    payload = source.read()
+    if mode == 'multipart' and not source.found:
+        return jsonify({"error": "No image data provided"}), 400
+
+    UPLOAD_BYTES.inc(amount=source.bytes_received)
+    if mode != 'json':
+        STAGE_SECONDS.observe(source.parse_time, 'receive')
     
-    # Combine decrypted chunks
-    return b''.join(decrypted_chunks)
+    image_id = storage.new_image_id()
+    ingest_journal.append(image_id, payload, {
+        "original_timestamp": capture_timestamp(source),
+        "server_timestamp": int(time.time())
+    })
+    start_background_workers()
+    ingest_workers.notify()
 
-def save_temp_image(image_bytes):
-    """Save image to a temporary file and return its filename"""
-    temp_filename = f"temp_{int(time.time())}.jpg"
-    temp_path = os.path.join(STORAGE_DIR, temp_filename)
-    with open(temp_path, 'wb') as f:
-        f.write(image_bytes)
-    return temp_filename
+    status_url = f"/api/ingest/{image_id}"
+    response = jsonify({
+        "success": True,
+        "id": image_id,
+        "filename": storage.image_filename(image_id),
+        "status": "queued",
+        "status_url": status_url,
+        "upload": {
+            "mode": mode,
+            "bytes_received": source.bytes_received,
+            "image_bytes": len(payload),
+            "parse_ms": round(source.parse_time * 1000, 3)
+        }
+    })
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
 
 @app.route('/api/upload', methods=['POST'])
 def upload_image():
     try:
-        # Get data from request
-        data = request.json
-        if not data or 'image' not in data:
+        # Get image source from request (JSON, multipart or raw body)
+        mode, source = upload_source(request)
+        if source is None:
             return jsonify({"error": "No image data provided"}), 400
         
-        # Decode base64 image
-        image_data = base64.b64decode(data['image'])
+        # Hold the image to the capture policy, scaling it down if needed
+        source = capture_policy.apply(source)
         
-        # Encrypt image data
-        encrypted_data = encrypt_data(image_data)
+        # In async mode just journal the upload; a worker stores it
+        if INGEST_MODE == 'async':
+            return enqueue_upload(mode, source)
         
-        # Generate unique filename based on timestamp
+        # Generate a unique, time-ordered filename
         timestamp = int(time.time())
-        filename = f"image_{timestamp}.enc"
-        filepath = os.path.join(STORAGE_DIR, filename)
+        filename = storage.image_filename(storage.new_image_id())
         
-        # Save encrypted image
-        with open(filepath, 'wb') as f:
-            f.write(encrypted_data)
+        if DEDUP:
+            # The image has to be hashed before we know whether to encrypt it
+            data = source.read()
+            result, fields = store_duplicate(data, filename)
+            if result is None:
+                result = encrypt_to_store(data, filename)
+        else:
+            # Encrypt the image one segment at a time
+            result, fields = encrypt_to_store(source, filename), {}
         
-        # Save metadata (timestamp, etc.)
-        metadata = {
-            "original_timestamp": data.get('timestamp', ''),
-            "server_timestamp": timestamp,
-            "filename": filename
-        }
+        if mode == 'multipart' and not source.found:
+            image_store.discard(filename)
+            return jsonify({"error": "No image data provided"}), 400
+        
+        original_timestamp = capture_timestamp(source)
         
-        metadata_path = os.path.join(STORAGE_DIR, f"metadata_{timestamp}.json")
-        with open(metadata_path, 'w') as f:
-            json.dump(metadata, f)
+        # Save the image with its metadata (timestamp, etc.) and record it
+        # in the catalog
+        metadata = image_metadata(filename, original_timestamp, timestamp, **fields)
+        save_images([(filename, result, metadata)])
+        schedule_renditions(filename)
         
-        return jsonify({"success": True, "filename": filename}), 200
+        UPLOAD_BYTES.inc(amount=source.bytes_received)
+        observe_stored(result, None if mode == 'json' else source.parse_time)
+        
+        return jsonify({
+            "success": True,
+            "filename": filename,
+            "deduplicated": bool(result.get("duplicate")),
+            "upload": {
+                "mode": mode,
+                "bytes_received": source.bytes_received,
+                "image_bytes": result["image_bytes"],
+                "parse_ms": round(source.parse_time * 1000, 3)
+            }
+        }), 200
     
+    except MalformedUpload as e:
+        return jsonify({"error": str(e)}), 400
+    except capture.ImageRejected as e:
+        return jsonify({"error": str(e)}), 413
+    except QueueFull as e:
+        return busy_response(e)
     except Exception as e:
         print(f"Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '100'))
+
+def batch_items(req):
+    """Yield (image_bytes, original_timestamp, error) for each image in a batch request
+
+    error is None, or says why an item has no usable image (image_bytes is
+    then None), so that one bad item fails alone.
+    """
+    if req.mimetype == 'multipart/form-data':
+        boundary = req.mimetype_params.get('boundary')
+        if not boundary:
+            return
+        # Each image gets the timestamp field sent after it
+        for image_data, fields in iter_multipart_files(req.stream, boundary.encode('latin-1')):
+            timestamp = next((value for name, value in fields if name == 'timestamp'), '')
+            yield image_data, timestamp, None
+        return
+
+    data = req.get_json(silent=True)
+    if not data or not isinstance(data.get('images'), list):
+        return
+    for item in data['images']:
+        if not isinstance(item, dict) or 'image' not in item:
+            yield None, '', "Batch item has no 'image' field"
+            continue
+        decode_start = time.perf_counter()
+        try:
+            image_data = base64.b64decode(item['image'])
+        except (TypeError, ValueError):
+            # binascii.Error is a ValueError
+            yield None, item.get('timestamp', ''), "Image is not valid base64"
+            continue
+        STAGE_SECONDS.observe(time.perf_counter() - decode_start, 'decode')
+        yield image_data, item.get('timestamp', ''), None
+
+def discard_batch(items):
+    """Wait for submitted batch items and remove whatever they stored"""
+    for filename, _, future, _ in items:
+        try:
+            future.result()
+            if filename is not None:
+                image_store.discard(filename)
+        except Exception:
+            pass
+
+def batch_limit():
+    """Most images a batch may hold: never more than the crypto executor
+    takes at once, so that an admitted batch always fits in it
+    """
+    return min(MAX_BATCH_SIZE, crypto_executor.workers + crypto_executor.max_queue)
+
+@app.route('/api/upload/batch', methods=['POST'])
+def upload_batch():
+    try:
+        timestamp = int(time.time())
+        items = []
+        limit = batch_limit()
+        
+        # JSON batches can be turned away before any image is decoded
+        data = request.get_json(silent=True)
+        if isinstance(data, dict) and isinstance(data.get('images'), list):
+            if len(data['images']) > limit:
+                return jsonify({"error": f"Batch exceeds {limit} images"}), 413
+        
+        # Hand each image to the crypto executor as soon as it has been read.
+        # Only the first job may raise QueueFull; once the batch is admitted
+        # the rest wait for a slot, like the chunks of encrypt_upload
+        too_many = False
+        admitted = False
+        try:
+            for index, (image_data, original_timestamp, error) in enumerate(batch_items(request)):
+                if index == limit:
+                    too_many = True
+                    break
+                try:
+                    if error is not None:
+                        raise ValueError(error)
+                    image_data = capture_policy.apply_bytes(image_data)
+                except (ValueError, capture.ImageRejected) as e:
+                    # Reported as a failed item like any other
+                    future = Future()
+                    future.set_exception(e)
+                    items.append((None, original_timestamp, future, {}))
+                    continue
+                filename = storage.image_filename(storage.new_image_id())
+                result, fields = store_duplicate(image_data, filename)
+                if result is None:
+                    future = crypto_executor.submit(
+                        crypto_pool.encrypt_job, image_data, image_store.target(filename),
+                        block=admitted
+                    )
+                    admitted = True
+                else:
+                    future = Future()
+                    future.set_result(result)
+                items.append((filename, original_timestamp, future, fields))
+        except Exception:
+            discard_batch(items)
+            raise
+        
+        if too_many:
+            discard_batch(items)
+            return jsonify({"error": f"Batch exceeds {limit} images"}), 413
+        if not items:
+            return jsonify({"error": "No image data provided"}), 400
+        
+        results = []
+        stored = []
+        for index, (filename, original_timestamp, future, fields) in enumerate(items):
+            try:
+                result = future.result()
+                metadata = image_metadata(filename, original_timestamp, timestamp, **fields)
+                observe_stored(result)
+                stored.append((filename, result, metadata))
+                results.append({
+                    "index": index,
+                    "success": True,
+                    "filename": filename,
+                    "deduplicated": bool(result.get("duplicate"))
+                })
+            except Exception as e:
+                results.append({"index": index, "success": False, "error": str(e)})
+        
+        # One durability barrier and one catalog transaction for the whole
+        # batch instead of one per file
+        save_images(stored, sync=True)
+        UPLOAD_BYTES.inc(amount=request.content_length or 0)
+        for filename, _, _ in stored:
+            schedule_renditions(filename)
+        
+        stored = sum(1 for result in results if result["success"])
+        return jsonify({
+            "success": stored == len(results),
+            "stored": stored,
+            "failed": len(results) - stored,
+            "results": results
+        }), 200
+    
+    except MalformedUpload as e:
+        return jsonify({"error": str(e)}), 400
+    except QueueFull as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"Batch upload error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# Settings the capture page needs, such as the capture policy
+@app.route('/api/config', methods=['GET'])
+def config():
+    response = jsonify({"capture": capture_policy.to_json()})
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 # Utility endpoint to check if server is running
 @app.route('/api/status', methods=['GET'])
 def status():
-    return jsonify({"status": "running"})
+    return jsonify({
+        "status": "running",
+        "crypto": crypto_executor.stats(),
+        "key_id": crypto.active.key_id.hex() if crypto.loaded else None
+    })
+
+# Readiness: unlike /api/status (liveness) this fails until the keys are
+# loaded and the catalog and storage directory are usable
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    if not _initialized:
+        initialize_in_background()
+        return jsonify({"ready": False, "reason": "initializing"}), 503
+    
+    checks = {
+        "keys": crypto.loaded,
+        "storage": os.access(STORAGE_DIR, os.W_OK),
+        "catalog": True
+    }
+    try:
+        image_catalog.ping()
+    except Exception as e:
+        print(f"Catalog check failed: {str(e)}")
+        checks["catalog"] = False
+    if ingest_journal is not None:
+        checks["ingest"] = os.access(INGEST_DIR, os.W_OK)
+    
+    is_ready = all(checks.values())
+    return jsonify({"ready": is_ready, "checks": checks}), 200 if is_ready else 503
 
-# Optional: Endpoint to list saved images
+# Counters of the crypto and rendition executors, the decrypted image cache,
+# dedup, GC, the image store and the image feed
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        "crypto": crypto_executor.stats(),
+        "renditions": rendition_executor.stats(),
+        "decrypt_cache": decrypt_cache.stats(),
+        "ingest": ingest_workers.stats() if ingest_workers is not None else None,
+        "dedup": image_catalog.dedup_stats(),
+        "gc": garbage_collector.stats(),
+        "storage": image_store.stats(),
+        "feed": image_feed.stats()
+    })
+
+# Status of an upload accepted in async ingest mode
+@app.route('/api/ingest/<image_id>', methods=['GET'])
+def ingest_status(image_id):
+    if not storage.is_image_id(image_id):
+        return jsonify({"error": "Invalid upload id"}), 400
+    
+    filename = storage.image_filename(image_id)
+    status = ingest_journal.state(image_id) if ingest_journal is not None else None
+    if status is None and image_catalog.get(filename) is not None:
+        status = 'stored'
+    if status is None:
+        return jsonify({"error": "Unknown upload id"}), 404
+    
+    result = {"id": image_id, "filename": filename, "status": status}
+    if status == 'failed':
+        result["error"] = ingest_journal.error(image_id)
+    return jsonify(result)
+
+def image_filters(args):
+    """Catalog filters (time ranges) taken from the query string"""
+    return {name: args.get(name) for name in catalog.FILTERS}
+
+# List saved images from the catalog, one page at a time
 @app.route('/api/images', methods=['GET'])
 def list_images():
-    files = []
-    for filename in os.listdir(STORAGE_DIR):
-        if filename.endswith('.enc'):
-            files.append(filename)
-    return jsonify({"images": files})
+    try:
+        rows, next_cursor = image_catalog.list_images(
+            image_filters(request.args),
+            cursor=request.args.get('cursor'),
+            limit=int(request.args.get('limit', 100)),
+            descending=request.args.get('order', 'asc').lower() == 'desc'
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    details = request.args.get('details', 'false').lower() == 'true'
+    images = [catalog.public_record(row) if details else row['filename'] for row in rows]
+    return jsonify({"images": images, "next_cursor": next_cursor})
+
+# Number of saved images matching the same filters as /api/images
+@app.route('/api/images/count', methods=['GET'])
+def count_images():
+    try:
+        return jsonify({"count": image_catalog.count(image_filters(request.args))})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+# Push newly stored images to viewers as Server-Sent Events, resuming after
+# the Last-Event-ID header (sent by EventSource on reconnect) or ?cursor=
+@app.route('/api/images/events', methods=['GET'])
+def image_events():
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+    try:
+        events = image_feed.subscribe(cursor)
+    except ValueError:
+        return jsonify({"error": "cursor must be an event id"}), 400
+    except feed.FeedFull as e:
+        return busy_response(e)
+    response = Response(events, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Bulk export: archives are streamed while they are produced. Decrypted
+# exports keep the next EXPORT_WINDOW images decrypting on the crypto
+# executor while the current one is sent; images of up to
+# EXPORT_BUFFER_BYTES / EXPORT_WINDOW are decrypted whole, larger ones a few
+# segments at a time, so memory use doesn't grow with the export
+EXPORT_WINDOW = int(os.environ.get('EXPORT_WINDOW', CRYPTO_WORKERS * 2))
+EXPORT_BUFFER_BYTES = int(os.environ.get('EXPORT_BUFFER_BYTES', 32 * 1024 * 1024))
+EXPORT_CONTENTS = ('decrypted', 'encrypted')
+MAX_EXPORT_NAMES = 10000
+
+# File name extensions of decrypted images, by the type found in their header
+EXPORT_EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/webp': '.webp'}
+
+def export_rows(first_page, cursor, filters):
+    """Yield (filename, catalog row) for a filtered export, in catalog order"""
+    rows = first_page
+    while True:
+        for row in rows:
+            yield row["filename"], row
+        if cursor is None:
+            return
+        rows, cursor = image_catalog.list_images(filters, cursor=cursor, limit=catalog.MAX_PAGE_SIZE)
+
+def named_rows(filenames):
+    """Yield (filename, catalog row or None) for an export of named images"""
+    for filename in filenames:
+        yield filename, image_catalog.get(filename)
+
+def prefetch_exports(rows, content):
+    """Yield (filename, row, location, future) with the next images already in progress
+
+    future is the export_job of a decrypted export, None otherwise. At most
+    EXPORT_WINDOW jobs run ahead of the image being sent, and the results
+    come out in the order of rows.
+    """
+    window = collections.deque()
+    max_bytes = EXPORT_BUFFER_BYTES // max(EXPORT_WINDOW, 1)
+    for filename, row in rows:
+        location = image_store.locate(filename) if row is not None else None
+        future = None
+        if location is not None and content == 'decrypted':
+            future = crypto_executor.submit(crypto_pool.export_job, location, max_bytes, block=True)
+        window.append((filename, row, location, future))
+        if len(window) > EXPORT_WINDOW:
+            yield window.popleft()
+    while window:
+        yield window.popleft()
+
+# Bytes from the start of an image enough to tell its type
+SNIFF_BYTES = 32
+
+def image_mimetype(head):
+    """Content type of an image from its first decrypted bytes (JPEG if unknown)"""
+    dimensions = capture.image_dimensions(head)
+    return dimensions[0] if isinstance(dimensions, tuple) else 'image/jpeg'
+
+def export_member(filename, location, future):
+    """Return (archive name, size, chunks) of one exported image
+
+    Raises if the image can't be read, before anything of it is sent.
+    """
+    if future is None:
+        # Encrypted export: the stored container as it is
+        f = blobstore.open_location(location)
+
+        def chunks():
+            with f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    yield chunk
+
+        return filename, f.size, chunks()
+    opened = future.result()
+    if opened[0] == 'whole':
+        size, chunks = len(opened[1]), iter([opened[1]])
+    else:
+        size, chunks = opened[4], iter(decrypt_file_stream(location, opened, block=True))
+    # Name the file after the image type, read from the first chunk
+    first = next(chunks, b'')
+    name = filename[:-len(storage.IMAGE_SUFFIX)] + EXPORT_EXTENSIONS[image_mimetype(first)]
+    return name, size, itertools.chain([first], chunks)
+
+def generate_export(stream, rows, content):
+    """Yield the archive of an export: images, their metadata and a summary
+
+    Images that are missing or can't be read are left out and listed in
+    export.json at the end, since the response has started by then.
+    """
+    exported = 0
+    skipped = []
+
+    def member(name, data, mtime):
+        return stream.add(name, len(data), mtime, [data])
+
+    now = int(time.time())
+    if content == 'encrypted':
+        # Whoever holds the matching private keys can decrypt the export
+        yield from member('public_key.pem', crypto.public_pem, now)
+        for provider in crypto.retired:
+            yield from member(f"keys/{provider.key_id.hex()}.pem", provider.public_pem, now)
+    try:
+        for filename, row, location, future in prefetch_exports(rows, content):
+            if location is None:
+                skipped.append({"filename": filename, "error": "File not found"})
+                continue
+            try:
+                name, size, chunks = export_member(filename, location, future)
+            except Exception as e:
+                print(f"Export error for {filename}: {str(e)}")
+                skipped.append({"filename": filename, "error": str(e)})
+                continue
+            mtime = int(row["server_timestamp"])
+            yield from stream.add(name, size, mtime, chunks)
+            metadata = {key: row[key] for key in
+                        ("filename", "original_timestamp", "server_timestamp", "size", "sha256")}
+            yield from member(storage.metadata_filename(filename),
+                              json.dumps(metadata).encode('utf-8'), mtime)
+            exported += 1
+            IMAGES_EXPORTED.inc(content)
+        summary = {"content": content, "images": exported, "skipped": skipped}
+        yield from member('export.json', json.dumps(summary, indent=2).encode('utf-8'), now)
+        yield from stream.finish()
+    except Exception as e:
+        # Too late for an error response; the client sees a truncated archive
+        print(f"Export failed after {exported} images: {str(e)}")
+        raise
+
+# Stream a ZIP or tar archive of many images, decrypted or as stored
+@app.route('/api/export', methods=['GET', 'POST'])
+def export_images():
+    options = request.args.to_dict()
+    filenames = None
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        filenames = body.pop('filenames', None)
+        options.update(body)
+    
+    content = options.get('content', 'decrypted')
+    if content not in EXPORT_CONTENTS:
+        return jsonify({"error": f"Unknown content: {content}"}), 400
+    try:
+        stream = archive.open_archive(options.get('format', 'zip'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if filenames is not None:
+        # Named images (for example from /api/images), in the order given
+        if not isinstance(filenames, list) or not all(
+            isinstance(name, str) and storage.is_image_filename(name) for name in filenames
+        ):
+            return jsonify({"error": "filenames must be a list of image filenames"}), 400
+        if len(filenames) > MAX_EXPORT_NAMES:
+            return jsonify({"error": f"At most {MAX_EXPORT_NAMES} filenames per export"}), 400
+        rows = named_rows(list(dict.fromkeys(filenames)))
+    else:
+        # Everything matching the /api/images time filters
+        filters = image_filters(options)
+        try:
+            first_page, cursor = image_catalog.list_images(filters, limit=catalog.MAX_PAGE_SIZE)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        rows = export_rows(first_page, cursor, filters)
+    
+    response = Response(generate_export(stream, rows, content), mimetype=stream.content_type)
+    name = f"images-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}.{stream.extension}"
+    response.headers['Content-Disposition'] = f'attachment; filename="{name}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def image_etag(filename, location):
+    """Return the SHA-256 of a stored image's ciphertext, used as its ETag
+
+    Images catalogued before hashes were recorded are hashed on their first
+    request and the hash is stored in the catalog.
+    """
+    row = image_catalog.get(filename)
+    if row and row['sha256']:
+        return row['sha256']
+    digest = blobstore.location_sha256(location)
+    if row:
+        image_catalog.set_sha256(filename, digest)
+    return digest
+
+def requested_range(size, etag, last_modified):
+    """Return (start, stop) for a single-range request, or None for the whole image
+
+    Returns False when the range can't be satisfied. Multi-range requests and
+    requests whose If-Range no longer matches get the whole image.
+    """
+    byte_range = request.range
+    if byte_range is None or len(byte_range.ranges) != 1:
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and if_range.date != last_modified:
+        return None
+    return byte_range.range_for_length(size) or False
+
+def image_response(body, etag, last_modified, status=200, mimetype='image/jpeg'):
+    """Build an image response carrying the validators and caching headers"""
+    response = Response(body, status=status, mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
 
 # Decrypt and return an image
 @app.route('/api/decrypt/<filename>', methods=['GET'])
 def decrypt_image(filename):
     try:
         # Validate filename
-        if not filename.endswith('.enc'):
+        if not storage.is_image_filename(filename):
             return jsonify({"error": "Invalid file type"}), 400
         
-        # Construct full path
-        filepath = os.path.join(STORAGE_DIR, filename)
-        if not os.path.exists(filepath):
+        # Find the image in the image store (a pack, or the sharded or old
+        # flat file layout)
+        location = image_store.locate(filename)
+        if location is None:
             return jsonify({"error": "File not found"}), 404
         
-        # Read encrypted data
-        with open(filepath, 'rb') as f:
-            encrypted_data = f.read()
+        # Stored images never change, so the ciphertext hash and mtime
+        # validate every copy a client or proxy holds
+        etag = image_etag(filename, location)
+        
+        # Serve a reduced-size rendition instead of the original if asked to
+        size_name = request.args.get('size', 'full')
+        if size_name != 'full':
+            if size_name not in renditions.SIZES:
+                return jsonify({"error": f"Unknown size: {size_name}"}), 400
+            if not renditions.available():
+                return jsonify({"error": "Renditions are not available on this server"}), 404
+            try:
+                location = rendition_location(filename, location, size_name)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 422
+            if location is None:
+                return jsonify({"error": "File not found"}), 404
+            etag = f"{etag}-{size_name}"
+        
+        stat = blobstore.stat_location(location)
+        last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return image_response(None, etag, last_modified, status=304)
+        
+        # Serve recently decrypted images from the cache
+        cached_name = filename if size_name == 'full' else storage.rendition_path(filename, size_name)
+        key = cache_key(cached_name, stat)
+        cached = decrypt_cache.get(key) if decrypt_cache.enabled else None
+        if cached is not None:
+            size = len(cached)
+        else:
+            opened, size = open_encrypted(location)
         
-        # Decrypt the data
-        decrypted_data = decrypt_data(encrypted_data)
+        # Answer a single Range request with just those bytes
+        byte_range = requested_range(size, etag, last_modified)
+        if byte_range is False:
+            response = jsonify({"error": "Requested range not satisfiable"})
+            response.status_code = 416
+            response.headers['Content-Range'] = f"bytes */{size}"
+            return response
+        start, stop = byte_range or (0, size)
         
-        # Return the image data as response
-        return send_from_directory(
-            directory=STORAGE_DIR,
-            path=save_temp_image(decrypted_data),
-            mimetype='image/jpeg'
+        if cached is not None:
+            body = cached if byte_range is None else cached[start:stop]
+            mimetype = image_mimetype(cached)
+        else:
+            # Stream the decrypted image straight into the response
+            body = decrypt_file_stream(location, opened, start, stop)
+            if byte_range is None and decrypt_cache.accepts(size):
+                body = cache_while_streaming(body, key)
+            if start == 0:
+                # Read the image type from the first chunk
+                body = iter(body)
+                first = next(body, b'')
+                body = itertools.chain([first], body)
+            else:
+                # Ranges further in need the start of the image decrypted too
+                first = b''.join(decrypt_file_stream(location, opened, 0, min(size, SNIFF_BYTES)))
+            mimetype = image_mimetype(first)
+        
+        response = image_response(
+            send_timed([body] if isinstance(body, bytes) else body),
+            etag, last_modified, status=206 if byte_range else 200, mimetype=mimetype
         )
+        response.headers['Content-Length'] = str(stop - start)
+        if byte_range:
+            response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+        return response
+    except QueueFull as e:
+        return busy_response(e)
     except Exception as e:
         print(f"Decryption error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# Metrics of this process, or of all server processes when shared
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    if metrics_exporter is not None:
+        snapshot = metrics_exporter.collect()
+    else:
+        snapshot = metrics_registry.snapshot()
+    return Response(metrics.render(snapshot), content_type=metrics.CONTENT_TYPE)
+
+def admin_error():
+    """Error response for requests without the admin token, else None"""
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "Admin endpoints are disabled (set ADMIN_TOKEN)"}), 404
+    supplied = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(supplied.encode(), f"Bearer {ADMIN_TOKEN}".encode()):
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
+# Switch the sampling profiler on (POST), off (DELETE) or show its state (GET)
+@app.route('/api/admin/profiler', methods=['GET', 'POST', 'DELETE'])
+def admin_profiler():
+    error = admin_error()
+    if error is not None:
+        return error
+    try:
+        if request.method == 'POST':
+            options = request.get_json(silent=True) or {}
+            profiler_control.enable(
+                options.get('mode', 'requests'),
+                options.get('duration', 60),
+                fraction=options.get('fraction', 0.05),
+                interval=options.get('interval', profiler.DEFAULT_INTERVAL),
+                limit=options.get('limit', profiler.DEFAULT_REQUEST_LIMIT)
+            )
+        elif request.method == 'DELETE':
+            profiler_control.disable()
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Profiler error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+    return jsonify(profiler_control.status())
+
+# Show garbage collection counters (GET) or start a sweep now (POST)
+@app.route('/api/admin/gc', methods=['GET', 'POST'])
+def admin_gc():
+    error = admin_error()
+    if error is not None:
+        return error
+    if request.method == 'POST':
+        # Without a background worker in this process, sweep on a thread
+        if not garbage_collector.wake():
+            threading.Thread(target=garbage_collector.sweep, name='gc', daemon=True).start()
+        return jsonify(garbage_collector.stats()), 202
+    return jsonify(garbage_collector.stats())
+
 # Endpoint to download the public key
 @app.route('/api/public-key', methods=['GET'])
 def get_public_key():
     try:
-        with open(PUBLIC_KEY_FILE, 'rb') as f:
-            key_data = f.read()
-        return key_data, 200, {'Content-Type': 'application/x-pem-file'}
+        # Serialized once at startup instead of read from disk per request
+        response = Response(crypto.public_pem, mimetype='application/x-pem-file')
+        response.set_etag(crypto.public_pem_sha256)
+        return response.make_conditional(request)
     except Exception as e:
         print(f"Error retrieving public key: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -249,400 +1455,49 @@ def index():
 def index_html():
     return index()  # Reuse the index route function
 
-if __name__ == '__main__':
-    # Check if index.html exists, if not create it
-    root_dir = os.path.dirname(os.path.abspath(__file__))
-    index_path = os.path.join(root_dir, 'index.html')
+def get_tls_files():
+    """Return (cert_file, key_file) when USE_HTTPS is enabled, otherwise None
+
+    A self-signed certificate is generated in CERT_DIR if none exists yet.
+    """
+    use_https = os.environ.get('USE_HTTPS', 'false').lower() == 'true'
+    if not use_https:
+        return None
     
-    if not os.path.exists(index_path):
-        print(f"Creating index.html in {root_dir}")
-        with open(index_path, 'w') as f:
-            f.write('''<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Secure Webcam Capture App</title>
-    <style>
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            max-width: 800px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: #f5f7fa;
-            color: #333;
-        }
-        h1 {
-            color: #2c3e50;
-            text-align: center;
-            margin-bottom: 30px;
-        }
-        .container {
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            gap: 20px;
-        }
-        .camera-select {
-            width: 100%;
-            max-width: 640px;
-            margin-bottom: 10px;
-        }
-        select {
-            width: 100%;
-            padding: 10px;
-            border-radius: 6px;
-            border: 1px solid #ddd;
-            background-color: white;
-            font-size: 16px;
-        }
-        .video-container {
-            position: relative;
-            width: 100%;
-            max-width: 640px;
-            border-radius: 8px;
-            overflow: hidden;
-            box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);
-        }
-        #video {
-            width: 100%;
-            height: auto;
-            background-color: #000;
-            display: block;
-        }
-        #canvas {
-            display: none;
-        }
-        .preview {
-            width: 100%;
-            max-width: 640px;
-            border-radius: 8px;
-            overflow: hidden;
-            box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);
-            display: none;
-        }
-        #capturedImage {
-            width: 100%;
-            height: auto;
-        }
-        .controls {
-            display: flex;
-            gap: 15px;
-            margin-top: 10px;
-        }
-        button {
-            padding: 12px 20px;
-            font-size: 16px;
-            border: none;
-            border-radius: 6px;
-            cursor: pointer;
-            transition: all 0.3s ease;
-            font-weight: 500;
-        }
-        #captureBtn {
-            background-color: #3498db;
-            color: white;
-        }
-        #captureBtn:hover {
-            background-color: #2980b9;
-        }
-        #sendBtn {
-            background-color: #2ecc71;
-            color: white;
-            display: none;
-        }
-        #sendBtn:hover {
-            background-color: #27ae60;
-        }
-        #retakeBtn {
-            background-color: #e74c3c;
-            color: white;
-            display: none;
-        }
-        #retakeBtn:hover {
-            background-color: #c0392b;
-        }
-        .status {
-            margin-top: 20px;
-            padding: 10px;
-            border-radius: 4px;
-            text-align: center;
-            font-weight: 500;
-        }
-        .success {
-            background-color: #d5f5e3;
-            color: #27ae60;
-            display: none;
-        }
-        .error {
-            background-color: #fadbd8;
-            color: #e74c3c;
-            display: none;
-        }
-        .security-info {
-            margin-top: 30px;
-            padding: 15px;
-            background-color: #eaf2f8;
-            border-radius: 8px;
-            border-left: 4px solid #3498db;
-        }
-        .security-info h3 {
-            margin-top: 0;
-            color: #2980b9;
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>Secure Webcam Capture</h1>
-        
-        <div class="camera-select">
-            <select id="cameraSelect">
-                <option value="">Loading cameras...</option>
-            </select>
-        </div>
-        
-        <div class="video-container">
-            <video id="video" autoplay playsinline></video>
-            <canvas id="canvas"></canvas>
-        </div>
-        
-        <div class="preview">
-            <img id="capturedImage" alt="Captured image">
-        </div>
-        
-        <div class="controls">
-            <button id="captureBtn">Take Photo</button>
-            <button id="retakeBtn">Retake</button>
-            <button id="sendBtn">Save Securely</button>
-        </div>
-        
-        <div class="status success" id="successMessage">
-            Image securely saved to server!
-        </div>
-        
-        <div class="status error" id="errorMessage">
-            Error: Could not save image.
-        </div>
-        
-        <div class="security-info">
-            <h3>Security Information</h3>
-            <p>This application uses RSA asymmetric encryption to secure your images. Images are encrypted with a public key before transmission, and can only be decrypted with the private key stored securely on the server.</p>
-            <p><a href="/api/public-key" download="public_key.pem">Download Public Key</a></p>
-        </div>
-    </div>
-
-    <script>
-        // DOM elements
-        const video = document.getElementById('video');
-        const canvas = document.getElementById('canvas');
-        const capturedImage = document.getElementById('capturedImage');
-        const captureBtn = document.getElementById('captureBtn');
-        const retakeBtn = document.getElementById('retakeBtn');
-        const sendBtn = document.getElementById('sendBtn');
-        const successMessage = document.getElementById('successMessage');
-        const errorMessage = document.getElementById('errorMessage');
-        const videoContainer = document.querySelector('.video-container');
-        const preview = document.querySelector('.preview');
-        const cameraSelect = document.getElementById('cameraSelect');
-        
-        // Global variables
-        let currentStream = null;
-        
-        // Get list of available cameras
-        async function getCameras() {
-            try {
-                const devices = await navigator.mediaDevices.enumerateDevices();
-                const videoDevices = devices.filter(device => device.kind === 'videoinput');
-                
-                // Clear the dropdown
-                cameraSelect.innerHTML = '';
-                
-                if (videoDevices.length === 0) {
-                    const option = document.createElement('option');
-                    option.text = 'No cameras found';
-                    cameraSelect.add(option);
-                    errorMessage.textContent = "No cameras detected on your device.";
-                    errorMessage.style.display = "block";
-                    return;
-                }
-                
-                // Add cameras to dropdown
-                videoDevices.forEach((device, index) => {
-                    const option = document.createElement('option');
-                    option.value = device.deviceId;
-                    option.text = device.label || `Camera ${index + 1}`;
-                    cameraSelect.add(option);
-                });
-                
-                // Select first camera by default
-                startCamera(videoDevices[0].deviceId);
-            } catch (err) {
-                console.error("Error enumerating devices:", err);
-                errorMessage.textContent = "Error detecting cameras. Please ensure permissions are granted.";
-                errorMessage.style.display = "block";
-            }
-        }
-        
-        // Get access to webcam
-        async function startCamera(deviceId = null) {
-            try {
-                // Stop any existing stream
-                if (currentStream) {
-                    currentStream.getTracks().forEach(track => {
-                        track.stop();
-                    });
-                }
-                
-                // Set constraints based on selected device
-                const constraints = {
-                    video: deviceId ? { deviceId: { exact: deviceId } } : true,
-                    audio: false
-                };
-                
-                const stream = await navigator.mediaDevices.getUserMedia(constraints);
-                video.srcObject = stream;
-                currentStream = stream;
-                
-                // Hide error message if it was displayed
-                errorMessage.style.display = "none";
-            } catch (err) {
-                console.error("Error accessing webcam:", err);
-                errorMessage.textContent = "Error: Cannot access webcam. Please ensure you've granted camera permissions.";
-                errorMessage.style.display = "block";
-            }
-        }
-        
-        // Listen for camera selection changes
-        cameraSelect.addEventListener('change', function() {
-            if (this.value) {
-                startCamera(this.value);
-            }
-        });
-
-        // Capture image from webcam
-        captureBtn.addEventListener('click', function() {
-            // Set canvas dimensions to match video
-            canvas.width = video.videoWidth;
-            canvas.height = video.videoHeight;
-            
-            // Draw current video frame to canvas
-            const context = canvas.getContext('2d');
-            context.drawImage(video, 0, 0, canvas.width, canvas.height);
-            
-            // Convert canvas to image
-            const imageDataUrl = canvas.toDataURL('image/jpeg');
-            capturedImage.src = imageDataUrl;
-            
-            // Show preview and controls
-            videoContainer.style.display = 'none';
-            preview.style.display = 'block';
-            captureBtn.style.display = 'none';
-            retakeBtn.style.display = 'inline-block';
-            sendBtn.style.display = 'inline-block';
-            
-            // Reset status messages
-            successMessage.style.display = 'none';
-            errorMessage.style.display = 'none';
-        });
-
-        // Retake photo
-        retakeBtn.addEventListener('click', function() {
-            // Hide preview, show video
-            videoContainer.style.display = 'block';
-            preview.style.display = 'none';
-            
-            // Show/hide buttons
-            captureBtn.style.display = 'inline-block';
-            retakeBtn.style.display = 'none';
-            sendBtn.style.display = 'none';
-            
-            // Reset status messages
-            successMessage.style.display = 'none';
-            errorMessage.style.display = 'none';
-        });
-
-        // Send image to server
-        sendBtn.addEventListener('click', async function() {
-            try {
-                // Get base64 image data without "data:image/jpeg;base64," prefix
-                const imageData = capturedImage.src.split(',')[1];
-                
-                // Send to server
-                const response = await fetch('/api/upload', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({ 
-                        image: imageData,
-                        timestamp: new Date().toISOString()
-                    })
-                });
-                
-                if (response.ok) {
-                    successMessage.style.display = 'block';
-                    errorMessage.style.display = 'none';
-                } else {
-                    throw new Error('Server error: ' + response.status);
-                }
-            } catch (err) {
-                console.error("Error sending image:", err);
-                errorMessage.textContent = "Error: Failed to save image. Please try again.";
-                errorMessage.style.display = 'block';
-                successMessage.style.display = 'none';
-            }
-        });
-
-        // Initialize
-        async function init() {
-            try {
-                // First request camera permissions
-                await navigator.mediaDevices.getUserMedia({ video: true });
-                // Then get camera list
-                await getCameras();
-            } catch (err) {
-                console.error("Initialization error:", err);
-                errorMessage.textContent = "Error initializing camera. Please grant camera permissions and refresh.";
-                errorMessage.style.display = "block";
-            }
-        }
+    cert_dir = os.environ.get('CERT_DIR', '/app/certs')
+    cert_file = os.path.join(cert_dir, 'cert.pem')
+    key_file = os.path.join(cert_dir, 'key.pem')
+    
+    # Check if certificate files exist, if not, create self-signed certificate
+    if not (os.path.exists(cert_file) and os.path.exists(key_file)):
+        if not os.path.exists(cert_dir):
+            os.makedirs(cert_dir)
         
-        // Start the application
-        init();
-    </script>
-</body>
-</html>''')
-        print(f"Index.html created successfully!")
+        # Create self-signed certificate (P-256 keys generate in milliseconds,
+        # RSA-4096 keys in seconds)
+        print("Generating self-signed certificate...")
+        subprocess.run([
+            'openssl', 'req', '-x509', '-newkey', 'ec',
+            '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+            '-out', cert_file, '-keyout', key_file,
+            '-days', '365', '-subj', '/CN=localhost'
+        ], check=True)
+        print(f"Certificate generated at {cert_file}")
     
+    return cert_file, key_file
+
+if __name__ == '__main__':
     # Use 0.0.0.0 to make the server accessible from outside the container
     # Check if we should use HTTPS
-    use_https = os.environ.get('USE_HTTPS', 'false').lower() == 'true'
+    tls_files = get_tls_files()
     
-    if use_https:
-        # For HTTPS mode
-        cert_dir = os.environ.get('CERT_DIR', '/app/certs')
-        cert_file = os.path.join(cert_dir, 'cert.pem')
-        key_file = os.path.join(cert_dir, 'key.pem')
-        
-        # Check if certificate files exist, if not, create self-signed certificate
-        if not (os.path.exists(cert_file) and os.path.exists(key_file)):
-            if not os.path.exists(cert_dir):
-                os.makedirs(cert_dir)
-            
-            # Create self-signed certificate
-            print("Generating self-signed certificate...")
-            import subprocess
-            subprocess.run([
-                'openssl', 'req', '-x509', '-newkey', 'rsa:4096', '-nodes',
-                '-out', cert_file, '-keyout', key_file,
-                '-days', '365', '-subj', '/CN=localhost'
-            ])
-            print(f"Certificate generated at {cert_file}")
-        
+    # The Werkzeug debugger runs arbitrary code for anyone who can reach it,
+    # so it is only turned on when asked for
+    debug = os.environ.get('FLASK_DEBUG', 'false').lower() in ('1', 'true')
+    
+    if tls_files:
         # Run with HTTPS
-        app.run(host='0.0.0.0', port=5000, ssl_context=(cert_file, key_file), debug=True)
+        app.run(host='0.0.0.0', port=5000, ssl_context=tls_files, debug=debug)
     else:
         # Run with HTTP (default)
-        app.run(host='0.0.0.0', port=5000, debug=True)
-    
\ No newline at end of file
+        app.run(host='0.0.0.0', port=5000, debug=debug)
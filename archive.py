@@ -0,0 +1,129 @@
+"""Streaming ZIP and tar writers for bulk exports.
+
+Both produce an archive as an iterable of byte strings while it is being
+written, without seeking and without holding more than the chunk being
+added, so an export of any size can go straight into a response:
+
+    stream = open_archive('zip')
+    for data in stream.add('image.jpg', size, mtime, chunks):
+        send(data)
+    for data in stream.finish():
+        send(data)
+
+The size of every member must be known before its data. ZIP members are
+stored uncompressed (images are compressed already) with their sizes and
+CRC in a data descriptor after the data, and switch to ZIP64 when needed.
+Tar members use the POSIX pax format, which has no size or name limits.
+"""
+import tarfile
+import time
+import zipfile
+
+# Earliest time a ZIP member can have (1980-01-01)
+_ZIP_EPOCH = 315532800
+
+
+class _Sink:
+    """Write-only file collecting what zipfile writes, until drained"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+class ZipStream:
+    """ZIP archive written to an iterable of bytes"""
+
+    content_type = 'application/zip'
+    extension = 'zip'
+
+    def __init__(self):
+        self._sink = _Sink()
+        # Without tell() and seek() zipfile writes data descriptors
+        self._zip = zipfile.ZipFile(self._sink, 'w', zipfile.ZIP_STORED)
+
+    def add(self, name, size, mtime, chunks):
+        """Yield the archive bytes of a member holding chunks (size bytes in all)"""
+        info = zipfile.ZipInfo(name, time.localtime(max(mtime, _ZIP_EPOCH))[:6])
+        info.file_size = size
+        info.external_attr = 0o644 << 16
+        with self._zip.open(info, 'w') as member:
+            for chunk in chunks:
+                member.write(chunk)
+                data = self._sink.drain()
+                if data:
+                    yield data
+        data = self._sink.drain()
+        if data:
+            yield data
+
+    def finish(self):
+        """Yield the central directory that ends the archive"""
+        self._zip.close()
+        yield self._sink.drain()
+
+
+class TarStream:
+    """pax tar archive written to an iterable of bytes"""
+
+    content_type = 'application/x-tar'
+    extension = 'tar'
+
+    def __init__(self):
+        self._written = 0
+
+    def _emit(self, data):
+        self._written += len(data)
+        return data
+
+    def add(self, name, size, mtime, chunks):
+        """Yield the archive bytes of a member holding chunks (size bytes in all)"""
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = 0o644
+        yield self._emit(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+        sent = 0
+        for chunk in chunks:
+            sent += len(chunk)
+            if sent > size:
+                raise ValueError(f"{name} is larger than the {size} bytes announced")
+            if chunk:
+                yield self._emit(chunk)
+        if sent != size:
+            raise ValueError(f"{name} is smaller than the {size} bytes announced")
+        # Members are padded to whole blocks
+        padding = -size % tarfile.BLOCKSIZE
+        if padding:
+            yield self._emit(tarfile.NUL * padding)
+
+    def finish(self):
+        """Yield the end-of-archive blocks, padded to a whole record"""
+        end = 2 * tarfile.BLOCKSIZE
+        end += -(self._written + end) % tarfile.RECORDSIZE
+        yield self._emit(tarfile.NUL * end)
+
+
+FORMATS = {
+    'zip': ZipStream,
+    'tar': TarStream,
+}
+
+
+def open_archive(format):
+    """Return a new streaming archive writer for 'zip' or 'tar'"""
+    try:
+        return FORMATS[format]()
+    except KeyError:
+        raise ValueError(f"Unknown archive format: {format}")
@@ -0,0 +1,105 @@
+"""Microbenchmark of per-operation crypto overhead.
+
+    python bench_crypto.py [--sizes 50000,250000,1000000,3000000] [--repeat 50]
+
+Compares what a request paid before the CryptoProvider existed ("before":
+an OAEP padding object built per RSA operation and public_key.pem read from
+disk per /api/public-key request) with what it pays now ("after": padding,
+keys and public key bytes built once). The envelope rows then show the
+whole encrypt and decrypt time at typical webcam JPEG sizes. They show how
+much of each operation the removed overhead accounted for.
+
+Uses a throwaway 2048-bit key pair; nothing under secure_images is touched.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from crypto_provider import CryptoProvider
+
+# 640x480, 1280x720 and 1920x1080 webcam JPEGs, and a large still
+DEFAULT_SIZES = '50000,250000,1000000,3000000'
+
+
+def build_oaep():
+    return padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),
+        label=None
+    )
+
+
+def measure(fn, repeat):
+    """Return the median wall time of fn() in microseconds"""
+    fn()  # warm up
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e6
+
+
+def run(sizes, repeat, log=print):
+    private_key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend()
+    )
+    provider = CryptoProvider(private_key, private_key.public_key())
+    data_key = AESGCM.generate_key(bit_length=256)
+    wrapped = provider.wrap_key(data_key)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pem_file = os.path.join(tmp, 'public_key.pem')
+        with open(pem_file, 'wb') as f:
+            f.write(provider.public_pem)
+
+        def read_pem():
+            with open(pem_file, 'rb') as f:
+                return f.read()
+
+        rows = [
+            ("padding object", measure(build_oaep, repeat),
+             measure(lambda: provider.padding, repeat)),
+            ("public key request", measure(read_pem, repeat),
+             measure(lambda: provider.public_pem, repeat)),
+            ("wrap data key", measure(lambda: provider.public_key.encrypt(data_key, build_oaep()), repeat),
+             measure(lambda: provider.wrap_key(data_key), repeat)),
+            ("unwrap data key", measure(lambda: private_key.decrypt(wrapped, build_oaep()), repeat),
+             measure(lambda: private_key.decrypt(wrapped, provider.padding), repeat)),
+        ]
+
+    log(f"{'operation':<22}{'before us':>12}{'after us':>12}{'saved us':>12}")
+    for name, before, after in rows:
+        log(f"{name:<22}{before:>12.1f}{after:>12.1f}{before - after:>12.1f}")
+
+    # The padding overhead is paid once per wrap and once per unwrap
+    saved = rows[0][1] - rows[0][2]
+    log("")
+    log(f"{'image bytes':<14}{'encrypt us':>12}{'decrypt us':>12}{'overhead %':>12}")
+    for size in sizes:
+        data = os.urandom(size)
+        sealed = provider.encrypt(data)
+        encrypt = measure(lambda: provider.encrypt(data), repeat)
+        decrypt = measure(lambda: provider.decrypt(sealed), repeat)
+        share = 100 * saved / (encrypt + saved)
+        log(f"{size:<14}{encrypt:>12.1f}{decrypt:>12.1f}{share:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help="comma-separated image sizes in bytes")
+    parser.add_argument('--repeat', type=int, default=50, help="samples per measurement")
+    args = parser.parse_args()
+    run([int(size) for size in args.sizes.split(',')], args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Benchmark of app import and startup time.
+
+    python bench_startup.py [--repeat 5] [--max-import-ms N] [--max-ready-ms N]
+
+Each measurement runs in a fresh interpreter inside an empty temporary
+directory:
+
+- import: `import app`, which must not touch the disk;
+- initialize (fresh volume): the first initialize(), including RSA key generation;
+- initialize (existing volume): initialize() with keys and catalog already there;
+- ready: import plus initialize on an existing volume, until /api/ready answers 200.
+
+Also fails if importing the app created any file. With --max-import-ms or
+--max-ready-ms the exit status is 1 when the median exceeds the limit, so the
+script can be used to catch startup regressions.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROBE = r'''
+import json, os, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+created = sorted(os.listdir('.'))
+result = {"import": imported - start, "created": created}
+if sys.argv[1] != 'import':
+    app.initialize()
+    result["initialize"] = time.perf_counter() - imported
+    response = app.app.test_client().get('/api/ready')
+    result["ready"] = time.perf_counter() - start if response.status_code == 200 else None
+print(json.dumps(result))
+'''
+
+
+def probe(workdir, mode):
+    env = dict(os.environ, PYTHONPATH=APP_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE, mode], cwd=workdir, env=env,
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(repeat, log=print):
+    """Return {measurement: median milliseconds}; raises if import has side effects"""
+    samples = {"import": [], "initialize (fresh volume)": [],
+               "initialize (existing volume)": [], "ready": []}
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as workdir:
+            result = probe(workdir, 'import')
+            if result["created"]:
+                raise RuntimeError(f"Importing app created files: {result['created']}")
+            samples["import"].append(result["import"])
+
+            result = probe(workdir, 'initialize')
+            samples["initialize (fresh volume)"].append(result["initialize"])
+
+            result = probe(workdir, 'initialize')
+            samples["initialize (existing volume)"].append(result["initialize"])
+            if result["ready"] is None:
+                raise RuntimeError("/api/ready did not answer 200 after initialize()")
+            samples["ready"].append(result["ready"])
+
+    medians = {name: statistics.median(values) * 1000 for name, values in samples.items()}
+    log(f"{'measurement':<32}{'median ms':>12}")
+    for name, value in medians.items():
+        log(f"{name:<32}{value:>12.1f}")
+    return medians
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5, help="runs per measurement")
+    parser.add_argument('--max-import-ms', type=float, help="fail if import is slower")
+    parser.add_argument('--max-ready-ms', type=float, help="fail if ready is slower")
+    args = parser.parse_args()
+
+    medians = run(args.repeat)
+    failed = False
+    for name, limit in (("import", args.max_import_ms), ("ready", args.max_ready_ms)):
+        if limit is not None and medians[name] > limit:
+            print(f"{name} took {medians[name]:.1f} ms, over the {limit:.1f} ms limit")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,441 @@
+"""Benchmark suite for the crypto layer and the upload, list and decrypt endpoints.
+
+    python bench_suite.py [--scenarios crypto,upload,decrypt,list] [--output bench.json]
+                          [--compare previous.json] [--url http://localhost:5000]
+
+Scenarios:
+
+- crypto: encrypt and decrypt in memory at image sizes from 50 KB to 10 MB;
+- upload: concurrent raw-body uploads to /api/upload;
+- decrypt: /api/decrypt of freshly uploaded images, first while the
+  decrypted image cache is cold and then again while it is warm;
+- list: /api/images (first page, a deep page by cursor, a time filter) and
+  /api/images/count with 10k and 100k catalogued images.
+
+Every scenario reports throughput, p50/p95/p99 latency and the peak RSS of
+the process that ran it. Each scenario runs in its own interpreter with its
+own temporary storage directory, so results don't depend on the order they
+run in. Without --url the app is driven in-process through Flask's test
+client (one client per thread). With --url requests go over HTTP to a
+running server, and peak RSS is the client's. The list scenario can only seed
+its images in-process. It seeds catalog rows directly (listing never reads
+the image files).
+
+Results are written as JSON (--output). --compare prints the change of every
+throughput, latency and memory figure against an earlier results file.
+Renditions are disabled while benchmarking (RENDITIONS is empty) unless set
+in the environment.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = ('crypto', 'upload', 'decrypt', 'list')
+CRYPTO_SIZES = '50000,250000,1000000,5000000,10000000'
+LIST_SIZES = '10000,100000'
+
+# Figures compared by --compare, with whether higher is better
+COMPARED = {
+    'throughput_rps': True,
+    'mb_per_s': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'peak_rss_mb': False,
+}
+
+
+# Measurement helpers
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed, errors=0, payload_bytes=0):
+    """Throughput and latency figures for one batch of operations"""
+    values = sorted(latencies)
+    result = {
+        "count": len(values),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_rps": round(len(values) / elapsed, 2) if elapsed else None,
+        "mean_ms": round(statistics.mean(values) * 1000, 3) if values else None,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3) if values else None,
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3) if values else None,
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3) if values else None,
+        "max_ms": round(values[-1] * 1000, 3) if values else None,
+    }
+    if payload_bytes:
+        result["mb_per_s"] = round(payload_bytes * len(values) / elapsed / 1e6, 2) if elapsed else None
+    return result
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def timed(fn, repeat):
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - begin)
+    return latencies, time.perf_counter() - start
+
+
+# Clients
+
+class TestClient:
+    """Drives the app in-process; one Flask test client per thread"""
+
+    def __init__(self, app_module):
+        self._app = app_module.app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._app.test_client()
+        response = client.open(path, method=method, data=body, headers=headers or {})
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    """Drives a running server; one keep-alive connection per thread"""
+
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self._https = parts.scheme == 'https'
+        self._host = parts.netloc
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+            conn = self._local.conn = cls(self._host, timeout=120)
+        return conn
+
+    def request(self, method, path, body=None, headers=None):
+        try:
+            conn = self._connection()
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self._local.conn = None
+            raise
+
+
+def run_load(client, requests, concurrency):
+    """Send (method, path, body, headers) requests from `concurrency` threads
+
+    Returns (latencies, elapsed, errors, responses) with responses in request
+    order; a response is None for requests that failed.
+    """
+    latencies = []
+    responses = [None] * len(requests)
+    errors = [0]
+    lock = threading.Lock()
+    position = [0]
+
+    def worker():
+        while True:
+            with lock:
+                index = position[0]
+                position[0] += 1
+            if index >= len(requests):
+                return
+            method, path, body, headers = requests[index]
+            begin = time.perf_counter()
+            try:
+                status, data = client.request(method, path, body, headers)
+                ok = status < 400
+            except Exception:
+                ok, data = False, None
+            elapsed = time.perf_counter() - begin
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                    responses[index] = data
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start, errors[0], responses
+
+
+def make_client(config):
+    if config.get('url'):
+        return HttpClient(config['url']), None
+    import app
+    app.initialize()
+    return TestClient(app), app
+
+
+def upload_requests(count, size):
+    headers = {'Content-Type': 'application/octet-stream'}
+    return [('POST', '/api/upload', os.urandom(size), headers) for _ in range(count)]
+
+
+# Scenarios; each runs in a child process whose cwd is a fresh directory
+
+def scenario_crypto(config):
+    import keystore
+    keyring = keystore.open_keyring('.')
+    results = {}
+    for size in config['crypto_sizes']:
+        data = os.urandom(size)
+        sealed = keyring.encrypt(data)
+        # Fewer samples for large images, at least 5
+        repeat = max(5, min(config['repeat'], int(config['repeat'] * 250000 / size)))
+        encrypt, encrypt_elapsed = timed(lambda: keyring.encrypt(data), repeat)
+        decrypt, decrypt_elapsed = timed(lambda: keyring.decrypt(sealed), repeat)
+        results[str(size)] = {
+            "encrypt": summarize(encrypt, encrypt_elapsed, payload_bytes=size),
+            "decrypt": summarize(decrypt, decrypt_elapsed, payload_bytes=size),
+        }
+    return results
+
+
+def scenario_upload(config):
+    client, _ = make_client(config)
+    requests = upload_requests(config['requests'], config['image_size'])
+    latencies, elapsed, errors, _ = run_load(client, requests, config['concurrency'])
+    return summarize(latencies, elapsed, errors, payload_bytes=config['image_size'])
+
+
+def scenario_decrypt(config):
+    client, app = make_client(config)
+    count = max(1, config['requests'] // 4)
+    _, _, _, responses = run_load(
+        client, upload_requests(count, config['image_size']), config['concurrency']
+    )
+    filenames = [json.loads(data)['filename'] for data in responses if data]
+    if app is not None:
+        app.decrypt_cache.clear()
+
+    fetches = [('GET', f'/api/decrypt/{name}', None, None) for name in filenames]
+    cold = run_load(client, fetches, config['concurrency'])
+    warm = run_load(client, fetches * 3, config['concurrency'])
+    result = {
+        "images": len(filenames),
+        "cold": summarize(cold[0], cold[1], cold[2], payload_bytes=config['image_size']),
+        "warm": summarize(warm[0], warm[1], warm[2], payload_bytes=config['image_size']),
+    }
+    if app is not None:
+        result["decrypt_cache"] = app.decrypt_cache.stats()
+    return result
+
+
+def seed_catalog(app, total):
+    """Catalog `total` images (rows only) spread over the last 30 days"""
+    import storage
+    now = int(time.time())
+    existing = app.image_catalog.count()
+    batch = []
+    for i in range(existing, total):
+        batch.append({
+            "filename": storage.image_filename(storage.new_image_id()),
+            "original_timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now - i)),
+            "server_timestamp": now - (i * 30 * 86400) // total,
+            "size": 250000,
+        })
+        if len(batch) >= 10000:
+            app.image_catalog.add(batch)
+            batch = []
+    if batch:
+        app.image_catalog.add(batch)
+
+
+def scenario_list(config):
+    client, app = make_client(config)
+    repeat = config['repeat']
+    results = {}
+    for total in (config['list_sizes'] if app is not None else [None]):
+        if app is not None:
+            seed_catalog(app, total)
+
+        # A cursor about 90% of the way through the newest-first listing
+        status, data = client.request('GET', '/api/images?order=desc&limit=1000')
+        cursor = json.loads(data).get('next_cursor') if status == 200 else None
+        for _ in range(int((total or 0) * 0.9) // 1000 - 1):
+            if not cursor:
+                break
+            status, data = client.request(
+                'GET', f'/api/images?order=desc&limit=1000&cursor={cursor}'
+            )
+            cursor = json.loads(data).get('next_cursor')
+
+        week_ago = int(time.time()) - 7 * 86400
+        paths = {
+            "first_page": '/api/images?limit=100',
+            "first_page_details": '/api/images?limit=100&details=true',
+            "filtered": f'/api/images?limit=100&server_from={week_ago}',
+            "count": '/api/images/count',
+        }
+        if cursor:
+            paths["deep_page"] = f'/api/images?order=desc&limit=100&cursor={cursor}'
+        label = str(total) if total else 'server'
+        results[label] = {}
+        for name, path in paths.items():
+            requests = [('GET', path, None, None)] * repeat
+            latencies, elapsed, errors, _ = run_load(client, requests, config['concurrency'])
+            results[label][name] = summarize(latencies, elapsed, errors)
+    return results
+
+
+SCENARIO_FUNCTIONS = {
+    'crypto': scenario_crypto,
+    'upload': scenario_upload,
+    'decrypt': scenario_decrypt,
+    'list': scenario_list,
+}
+
+
+def run_child(name, config):
+    result = SCENARIO_FUNCTIONS[name](config)
+    if isinstance(result, dict):
+        result["peak_rss_mb"] = peak_rss_mb()
+    print(json.dumps(result))
+
+
+def run_scenario(name, config):
+    """Run one scenario in a fresh interpreter and temporary directory"""
+    env = dict(os.environ, PYTHONPATH=APP_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    env.setdefault('RENDITIONS', '')
+    with tempfile.TemporaryDirectory() as workdir:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', name, json.dumps(config)],
+            cwd=workdir, env=env, capture_output=True, text=True
+        )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Scenario {name} failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+# Reporting
+
+def flatten(results, prefix=''):
+    """Yield (dotted path, value) for every compared figure"""
+    for key, value in results.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from flatten(value, path)
+        elif key in COMPARED and value is not None:
+            yield path, value
+
+
+def compare(previous, current, log=print):
+    old = dict(flatten(previous.get('results', {})))
+    log(f"{'figure':<52}{'before':>12}{'after':>12}{'change':>10}")
+    for path, value in flatten(current.get('results', {})):
+        if path not in old or not old[path]:
+            continue
+        change = (value - old[path]) / old[path] * 100
+        better = change >= 0 if COMPARED[path.rsplit('.', 1)[1]] else change <= 0
+        marker = '' if abs(change) < 5 else (' +' if better else ' -')
+        log(f"{path:<52}{old[path]:>12}{value:>12}{change:>9.1f}%{marker}")
+
+
+def print_summary(results, log=print):
+    for path, value in flatten(results):
+        log(f"{path:<52}{value:>12}")
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], json.loads(sys.argv[3]))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--url', help="benchmark a running server instead of the in-process app")
+    parser.add_argument('--requests', type=int, default=200, help="requests per load test")
+    parser.add_argument('--concurrency', type=int, default=8, help="client threads")
+    parser.add_argument('--image-size', type=int, default=250000, help="upload size in bytes")
+    parser.add_argument('--repeat', type=int, default=50, help="samples per measurement")
+    parser.add_argument('--crypto-sizes', default=CRYPTO_SIZES, help="comma-separated bytes")
+    parser.add_argument('--list-sizes', default=LIST_SIZES, help="comma-separated image counts")
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    config = {
+        "url": args.url,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "image_size": args.image_size,
+        "repeat": args.repeat,
+        "crypto_sizes": [int(size) for size in args.crypto_sizes.split(',')],
+        "list_sizes": [int(size) for size in args.list_sizes.split(',')],
+    }
+    report = {
+        "meta": {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "config": config,
+        },
+        "results": {},
+    }
+    for name in args.scenarios.split(','):
+        if name not in SCENARIO_FUNCTIONS:
+            parser.error(f"unknown scenario {name!r}")
+        print(f"Running {name}...", file=sys.stderr)
+        report["results"][name] = run_scenario(name, config)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    else:
+        print_summary(report["results"])
+
+
+if __name__ == '__main__':
+    main()
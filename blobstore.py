@@ -0,0 +1,812 @@
+"""Storage backends holding the ciphertext of stored images and renditions.
+
+- FileStore (the default) keeps one file per image with a JSON metadata
+  sidecar next to it, in the sharded layout of storage.py.
+- PackStore appends images to large pack files, so that an image doesn't
+  cost two inodes of its own:
+
+      secure_images/packs/pack-000001.dat, pack-000002.dat, ...
+      secure_images/packs/index.db
+
+  Every record in a pack carries its name, a sequence number (the time it
+  was written, in nanoseconds), the image metadata and the ciphertext. A new
+  pack is started once the active one reaches pack_bytes. The SQLite index
+  maps each name to the offset of its record and can always be rebuilt by
+  scanning the packs (rebuild_index()). Deleting appends a tombstone record;
+  compact() copies the live records of packs that are mostly garbage into
+  the active pack and removes the old pack an hour later, once no request
+  can still be reading it.
+
+Both backends have the same interface, which the app uses for uploads,
+listings (iter_records() fills the catalog) and decryption:
+
+    target(filename)         path for encrypt_job to write, or None to get
+                             the ciphertext back in its result
+    commit(entries)          store [(filename, result, metadata)] for good
+    sync(filenames)          flush committed images to stable storage
+    locate(filename, name)   location of an image (or rendition), or None
+    put_renditions(...)      store encrypted renditions of an image
+    link(source, filename)   share a stored image's ciphertext (dedup)
+    delete(filename)         remove an image with its renditions
+    discard(filename)        remove a target that was never committed
+
+A location is a path (files) or a Slice of a pack; open_location() returns
+a reader for either that reads with pread(), so concurrent readers of one
+pack never share a file position. Locations can be pickled and handed to
+crypto jobs in another process.
+"""
+import collections
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import renditions
+import storage
+from catalog import iter_sidecar_records
+from sqlite_util import ThreadConnections, Transaction
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single process appends to the packs
+    fcntl = None
+
+BACKENDS = ('files', 'packs')
+
+PACK_DIR = 'packs'
+INDEX_FILE = 'index.db'
+LOCK_FILE = '.lock'
+DEFAULT_PACK_BYTES = 256 * 1024 * 1024
+# Share of a pack that must be garbage before compact() rewrites it
+DEFAULT_COMPACT_RATIO = 0.5
+# Compacted packs are kept this long for requests that already located an image in them
+RETIRED_GRACE = 3600
+
+# Record: magic, header length, body length, CRC-32 of the header; then the
+# JSON header and the body
+RECORD_MAGIC = b'PKR1'
+_RECORD = struct.Struct('>4sIQI')
+
+# Where the ciphertext of an image is in a pack; mtime_ns is when it was stored
+Slice = collections.namedtuple('Slice', 'path offset length mtime_ns')
+
+# What stat_location() returns for a Slice
+SliceStat = collections.namedtuple('SliceStat', 'st_size st_mtime st_mtime_ns')
+
+INDEX_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS entries (
+        name TEXT PRIMARY KEY,
+        pack TEXT NOT NULL,
+        record_offset INTEGER NOT NULL,
+        record_length INTEGER NOT NULL,
+        body_offset INTEGER NOT NULL,
+        body_length INTEGER NOT NULL,
+        seq INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS entries_pack ON entries (pack, record_offset)",
+    # Tombstones are kept (and moved by compaction) so that a rebuilt index
+    # doesn't bring deleted images back
+    """CREATE TABLE IF NOT EXISTS tombstones (
+        name TEXT NOT NULL,
+        pack TEXT NOT NULL,
+        record_offset INTEGER NOT NULL,
+        record_length INTEGER NOT NULL,
+        seq INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS tombstones_pack ON tombstones (pack, record_offset)",
+    """CREATE TABLE IF NOT EXISTS retired (
+        pack TEXT PRIMARY KEY,
+        retired_at REAL NOT NULL
+    )""",
+]
+
+
+class SliceReader:
+    """Read-only file object over a byte range of a file, read with pread()"""
+
+    def __init__(self, path, offset=0, length=None):
+        self._fd = os.open(path, os.O_RDONLY)
+        self._offset = offset
+        self.size = os.fstat(self._fd).st_size - offset if length is None else length
+        self._position = 0
+
+    def read(self, size=-1):
+        remaining = self.size - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        data = os.pread(self._fd, size, self._offset + self._position)
+        self._position += len(data)
+        return data
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self._position
+        elif whence == os.SEEK_END:
+            position += self.size
+        self._position = max(0, position)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_location(location):
+    """Open the ciphertext at a location (path or Slice) for reading"""
+    if isinstance(location, Slice):
+        return SliceReader(location.path, location.offset, location.length)
+    return SliceReader(location)
+
+
+def stat_location(location):
+    """os.stat() of a path, or the same fields for a Slice"""
+    if isinstance(location, Slice):
+        return SliceStat(location.length, location.mtime_ns / 1e9, location.mtime_ns)
+    return os.stat(location)
+
+
+def location_sha256(location):
+    """Return the hex SHA-256 of the ciphertext at a location"""
+    if not isinstance(location, Slice):
+        return storage.file_sha256(location)
+    digest = hashlib.sha256()
+    with open_location(location) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sync_files(paths):
+    """Flush files and their directories to stable storage in one pass"""
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    # Persist the new directory entries as well
+    for directory in set(os.path.dirname(path) for path in paths):
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def open_store(root, backend=None, **options):
+    """Return the store of a storage directory
+
+    Without a backend, PackStore is chosen if the directory has packs.
+    """
+    if backend is None:
+        backend = 'packs' if os.path.isdir(os.path.join(root, PACK_DIR)) else 'files'
+    if backend == 'files':
+        return FileStore(root)
+    if backend == 'packs':
+        return PackStore(root, **options)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+class FileStore:
+    """One file per image, with its metadata sidecar and renditions next to it"""
+
+    kind = 'files'
+
+    def __init__(self, root):
+        self.root = root
+
+    def open(self):
+        os.makedirs(self.root, exist_ok=True)
+
+    def target(self, filename):
+        return storage.image_path(self.root, filename, create=True)
+
+    def commit(self, entries):
+        for filename, _, metadata in entries:
+            storage.write_atomic(storage.metadata_path(self.root, filename), json.dumps(metadata))
+
+    def sync(self, filenames):
+        paths = []
+        for filename in filenames:
+            paths.append(storage.image_path(self.root, filename))
+            paths.append(storage.metadata_path(self.root, filename))
+        sync_files(paths)
+
+    def locate(self, filename, rendition=None):
+        path = storage.resolve_path(self.root, filename)
+        if path is None or rendition is None:
+            return path
+        path = storage.rendition_path(path, rendition)
+        return path if os.path.exists(path) else None
+
+    def put_renditions(self, filename, rendered):
+        path = storage.resolve_path(self.root, filename)
+        if path is None:
+            # Deleted while the renditions were made
+            return
+        for name, data in rendered.items():
+            storage.write_atomic(storage.rendition_path(path, name), data)
+
+    def link(self, source_name, filename):
+        """Make filename (and its renditions) a hard link to a stored image
+
+        Returns False if the stored image can't be linked, for example
+        because it was deleted in the meantime.
+        """
+        source = storage.resolve_path(self.root, source_name)
+        if source is None:
+            return False
+        path = self.target(filename)
+        try:
+            os.link(source, path)
+        except OSError:
+            return False
+        for name in renditions.SIZES:
+            try:
+                os.link(storage.rendition_path(source, name), storage.rendition_path(path, name))
+            except OSError:
+                pass
+        return True
+
+    def delete(self, filename, dry_run=False, throttle=None):
+        """Delete an image with its sidecar and renditions
+
+        Returns the bytes this freed on disk (hard links shared with a
+        deduplicated image free nothing), or None if there was no image.
+        throttle is called before every file operation.
+        """
+        path = storage.resolve_path(self.root, filename)
+        if path is None:
+            return None
+        sidecar = os.path.join(os.path.dirname(path), storage.metadata_filename(filename))
+        # The image goes first: a delete stopped halfway leaves orphans for
+        # the garbage collector rather than an image without its sidecar
+        paths = [path, sidecar] + [storage.rendition_path(path, name) for name in renditions.SIZES]
+        freed = [remove_file(p, dry_run, throttle) for p in paths]
+        if freed[0] is None:
+            return None
+        return sum(f for f in freed if f)
+
+    def discard(self, filename):
+        path = storage.image_path(self.root, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def iter_records(self):
+        return iter_sidecar_records(self.root)
+
+    def stats(self):
+        return {"backend": self.kind}
+
+
+def remove_file(path, dry_run=False, throttle=None):
+    """Remove a file; returns the bytes this freed on disk, or None if it was gone"""
+    if throttle is not None:
+        throttle()
+    try:
+        stat = os.stat(path)
+        if not dry_run:
+            os.remove(path)
+    except FileNotFoundError:
+        return None
+    # Other hard links keep a deduplicated file's data on disk
+    return stat.st_size if stat.st_nlink == 1 else 0
+
+
+class PackStore:
+    """Images appended to pack files, found through an SQLite offset index
+
+    Images stored as files before the switch to packs are still read and
+    deleted through a FileStore.
+    """
+
+    kind = 'packs'
+
+    def __init__(self, root, pack_bytes=DEFAULT_PACK_BYTES):
+        self.root = root
+        self.directory = os.path.join(root, PACK_DIR)
+        self.pack_bytes = pack_bytes
+        self.files = FileStore(root)
+        self._connections = ThreadConnections(os.path.join(self.directory, INDEX_FILE))
+        self._append_lock = threading.Lock()
+        self._active = None
+
+    def _connection(self):
+        return self._connections.get()
+
+    def _transaction(self):
+        return Transaction(self._connection())
+
+    def open(self):
+        """Create the pack directory and index, rebuilding a missing index"""
+        os.makedirs(self.directory, exist_ok=True)
+        conn = self._connection()
+        if conn.execute('PRAGMA user_version').fetchone()[0] == 0:
+            with self._transaction() as conn:
+                for statement in INDEX_SCHEMA:
+                    conn.execute(statement)
+            self.rebuild_index()
+
+    def _pack_path(self, pack):
+        return os.path.join(self.directory, pack)
+
+    def pack_names(self):
+        """Names of the pack files, oldest first"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if _pack_number(name) is not None)
+
+    def _active_pack(self):
+        # Called with the pack lock held. Other processes may have moved on
+        # to a newer pack since we last appended
+        if self._active is None:
+            packs = self.pack_names()
+            self._active = _pack_number(packs[-1]) if packs else 1
+        while os.path.exists(self._pack_path(_pack_name(self._active + 1))):
+            self._active += 1
+        path = self._pack_path(_pack_name(self._active))
+        if os.path.exists(path) and os.path.getsize(path) >= self.pack_bytes:
+            self._active += 1
+        return _pack_name(self._active)
+
+    def _append(self, records, sync=False):
+        """Append (header, body) records to the active pack
+
+        Returns the (pack, offset, length) of each record. Appends from all
+        threads and processes are serialized with a lock.
+        """
+        positions = []
+        with self._append_lock, _locked(os.path.join(self.directory, LOCK_FILE)):
+            pack = self._active_pack()
+            fd = os.open(self._pack_path(pack), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                offset = os.fstat(fd).st_size
+                for header, body in records:
+                    prefix = _encode_prefix(header, len(body))
+                    _write_all(fd, prefix)
+                    _write_all(fd, body)
+                    positions.append((pack, offset, len(prefix) + len(body)))
+                    offset += len(prefix) + len(body)
+                if sync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+        return positions
+
+    def _index(self, conn, header, position, body_length):
+        """Point a name at a record just appended, unless a newer one exists"""
+        pack, offset, length = position
+        conn.execute(
+            'INSERT INTO entries'
+            ' (name, pack, record_offset, record_length, body_offset, body_length, seq)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)'
+            ' ON CONFLICT (name) DO UPDATE SET pack = excluded.pack,'
+            ' record_offset = excluded.record_offset, record_length = excluded.record_length,'
+            ' body_offset = excluded.body_offset, body_length = excluded.body_length,'
+            ' seq = excluded.seq WHERE excluded.seq >= entries.seq',
+            (header["name"], pack, offset, length, offset + length - body_length,
+             body_length, header["seq"])
+        )
+
+    def _put(self, items, sync=False):
+        """Append and index (name, metadata, ciphertext) items"""
+        records = [
+            ({"op": "put", "name": name, "seq": time.time_ns(), "metadata": metadata}, body)
+            for name, metadata, body in items
+        ]
+        positions = self._append(records, sync=sync)
+        with self._transaction() as conn:
+            for (header, body), position in zip(records, positions):
+                self._index(conn, header, position, len(body))
+
+    def target(self, filename):
+        return None
+
+    def commit(self, entries):
+        self._put([(filename, metadata, result["ciphertext"]) for filename, result, metadata in entries])
+
+    def sync(self, filenames):
+        """Flush the packs holding these images"""
+        names = list(filenames)
+        packs = set()
+        conn = self._connection()
+        for name in names:
+            row = conn.execute('SELECT pack FROM entries WHERE name = ?', (name,)).fetchone()
+            if row is not None:
+                packs.add(self._pack_path(row[0]))
+        if packs:
+            sync_files(sorted(packs))
+
+    def _entry(self, name):
+        return self._connection().execute(
+            'SELECT pack, body_offset, body_length, seq FROM entries WHERE name = ?', (name,)
+        ).fetchone()
+
+    def locate(self, filename, rendition=None):
+        name = filename if rendition is None else storage.rendition_path(filename, rendition)
+        row = self._entry(name)
+        if row is None:
+            return self.files.locate(filename, rendition)
+        pack, offset, length, seq = row
+        return Slice(self._pack_path(pack), offset, length, seq)
+
+    def put_renditions(self, filename, rendered):
+        location = self.locate(filename)
+        if location is None:
+            return
+        if not isinstance(location, Slice):
+            # An image stored before the switch to packs
+            return self.files.put_renditions(filename, rendered)
+        self._put([
+            (storage.rendition_path(filename, name), None, data)
+            for name, data in rendered.items()
+        ])
+
+    def link(self, source_name, filename):
+        # Packs have no reference counts; duplicates are stored again
+        return False
+
+    def delete(self, filename, dry_run=False, throttle=None):
+        """Delete an image and its renditions by appending tombstones
+
+        Returns the ciphertext bytes released (reclaimed on disk by
+        compact()), or None if there was no image.
+        """
+        names = [filename] + [storage.rendition_path(filename, name) for name in renditions.SIZES]
+        conn = self._connection()
+        rows = {}
+        for name in names:
+            row = conn.execute('SELECT body_length, seq FROM entries WHERE name = ?', (name,)).fetchone()
+            if row is not None:
+                rows[name] = row
+        if filename not in rows:
+            return self.files.delete(filename, dry_run, throttle)
+        if throttle is not None:
+            throttle()
+        released = sum(length for length, _ in rows.values())
+        if dry_run:
+            return released
+        # A tombstone must sort after the record it deletes
+        records = [
+            ({"op": "delete", "name": name, "seq": max(time.time_ns(), seq + 1)}, b'')
+            for name, (_, seq) in rows.items()
+        ]
+        positions = self._append(records)
+        with self._transaction() as conn:
+            for (header, _), (pack, offset, length) in zip(records, positions):
+                conn.execute('DELETE FROM entries WHERE name = ?', (header["name"],))
+                conn.execute(
+                    'INSERT INTO tombstones (name, pack, record_offset, record_length, seq)'
+                    ' VALUES (?, ?, ?, ?, ?)',
+                    (header["name"], pack, offset, length, header["seq"])
+                )
+        return released
+
+    def discard(self, filename):
+        # Nothing is written before commit()
+        pass
+
+    def _read_header(self, pack, offset):
+        with SliceReader(self._pack_path(pack), offset) as f:
+            prefix = f.read(_RECORD.size)
+            _, header_length, _, _ = _RECORD.unpack(prefix)
+            return json.loads(f.read(header_length))
+
+    def iter_records(self):
+        """Catalog records of the images in the packs (and of older files)"""
+        yield from self.files.iter_records()
+        conn = self._connection()
+        last = ''
+        while True:
+            rows = conn.execute(
+                'SELECT name, pack, record_offset, body_length, seq FROM entries'
+                ' WHERE name > ? ORDER BY name LIMIT 1000', (last,)
+            ).fetchall()
+            if not rows:
+                return
+            for name, pack, offset, length, seq in rows:
+                if not storage.is_image_filename(name):
+                    continue
+                try:
+                    metadata = self._read_header(pack, offset).get("metadata") or {}
+                except (OSError, ValueError, struct.error):
+                    metadata = {}
+                yield {
+                    'filename': name,
+                    'original_timestamp': metadata.get('original_timestamp', ''),
+                    'server_timestamp': metadata.get('server_timestamp') or seq // 10**9,
+                    'size': length,
+                    'digest': metadata.get('digest', ''),
+                    'blob': metadata.get('blob', ''),
+                }
+            last = rows[-1][0]
+
+    def scan(self, pack):
+        """Yield (offset, header, body_offset, body_length, record_length) for a pack
+
+        A torn or corrupt record (for example from a crash in the middle of
+        an append) is skipped by searching for the next record.
+        """
+        with SliceReader(self._pack_path(pack)) as f:
+            size = f.size
+            offset = 0
+            while offset + _RECORD.size <= size:
+                f.seek(offset)
+                magic, header_length, body_length, crc = _RECORD.unpack(f.read(_RECORD.size))
+                header = None
+                end = offset + _RECORD.size + header_length + body_length
+                if magic == RECORD_MAGIC and end <= size:
+                    raw = f.read(header_length)
+                    if zlib.crc32(raw) == crc:
+                        try:
+                            header = json.loads(raw)
+                        except ValueError:
+                            header = None
+                if header is None:
+                    offset = _find_magic(f, offset + 1)
+                    continue
+                yield offset, header, end - body_length, body_length, end - offset
+                offset = end
+
+    def rebuild_index(self):
+        """Replace the index with what the packs contain; returns the live entries
+
+        Of several records for a name the one with the highest sequence
+        number wins, and of equal ones (copies made by compaction) the later.
+        """
+        latest = {}
+        tombstones = []
+        for pack in self.pack_names():
+            for offset, header, body_offset, body_length, length in self.scan(pack):
+                name, seq = header["name"], header["seq"]
+                if header["op"] == 'delete':
+                    tombstones.append((name, pack, offset, length, seq))
+                    entry = None
+                else:
+                    entry = (name, pack, offset, length, body_offset, body_length, seq)
+                current = latest.get(name)
+                if current is None or seq >= current[0]:
+                    latest[name] = (seq, entry)
+        with self._transaction() as conn:
+            for statement in INDEX_SCHEMA:
+                conn.execute(statement)
+            conn.execute('DELETE FROM entries')
+            conn.execute('DELETE FROM tombstones')
+            conn.executemany(
+                'INSERT INTO entries'
+                ' (name, pack, record_offset, record_length, body_offset, body_length, seq)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [entry for _, entry in latest.values() if entry is not None]
+            )
+            conn.executemany(
+                'INSERT INTO tombstones (name, pack, record_offset, record_length, seq)'
+                ' VALUES (?, ?, ?, ?, ?)', tombstones
+            )
+            conn.execute('PRAGMA user_version=1')
+        return sum(1 for _, entry in latest.values() if entry is not None)
+
+    def _live_bytes(self, conn, pack):
+        return sum(
+            conn.execute(f'SELECT COALESCE(SUM(record_length), 0) FROM {table} WHERE pack = ?',
+                         (pack,)).fetchone()[0]
+            for table in ('entries', 'tombstones')
+        )
+
+    def compact(self, min_ratio=DEFAULT_COMPACT_RATIO, dry_run=False, throttle=None):
+        """Rewrite packs of which at least min_ratio is garbage
+
+        The live records of such a pack are copied to the active pack and
+        the pack is retired; retired packs are deleted after RETIRED_GRACE
+        seconds. Returns (packs compacted, bytes reclaimed).
+        """
+        if not dry_run:
+            self._remove_retired()
+        conn = self._connection()
+        retired = {row[0] for row in conn.execute('SELECT pack FROM retired')}
+        packs = self.pack_names()
+        compacted = reclaimed = 0
+        # The newest pack is still being appended to
+        for pack in packs[:-1]:
+            if pack in retired:
+                continue
+            size = os.path.getsize(self._pack_path(pack))
+            garbage = size - self._live_bytes(conn, pack)
+            if size == 0 or garbage < min_ratio * size:
+                continue
+            compacted += 1
+            reclaimed += garbage
+            if dry_run:
+                continue
+            self._move_live_records(pack, throttle)
+            with self._transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO retired (pack, retired_at) VALUES (?, ?)',
+                             (pack, time.time()))
+        return compacted, reclaimed
+
+    def _move_live_records(self, pack, throttle=None):
+        conn = self._connection()
+        live = conn.execute(
+            "SELECT 'entries', name, record_offset, record_length FROM entries WHERE pack = ?"
+            " UNION ALL SELECT 'tombstones', rowid, record_offset, record_length"
+            " FROM tombstones WHERE pack = ? ORDER BY record_offset", (pack, pack)
+        ).fetchall()
+        with SliceReader(self._pack_path(pack)) as f:
+            for table, key, offset, length in live:
+                if throttle is not None:
+                    throttle()
+                f.seek(offset)
+                data = f.read(length)
+                header_length = _RECORD.unpack(data[:_RECORD.size])[1]
+                header = json.loads(data[_RECORD.size:_RECORD.size + header_length])
+                # Copied unchanged, sequence number included
+                new_pack, new_offset, _ = self._append(
+                    [(header, data[_RECORD.size + header_length:])]
+                )[0]
+                with self._transaction() as conn:
+                    # Entries deleted or replaced meanwhile no longer match
+                    if table == 'entries':
+                        conn.execute(
+                            'UPDATE entries SET pack = ?, record_offset = ?,'
+                            ' body_offset = ? + body_offset - record_offset'
+                            ' WHERE name = ? AND pack = ? AND record_offset = ?',
+                            (new_pack, new_offset, new_offset, key, pack, offset)
+                        )
+                    else:
+                        conn.execute(
+                            'UPDATE tombstones SET pack = ?, record_offset = ? WHERE rowid = ?',
+                            (new_pack, new_offset, key)
+                        )
+
+    def _remove_retired(self):
+        conn = self._connection()
+        cutoff = time.time() - RETIRED_GRACE
+        for (pack,) in conn.execute('SELECT pack FROM retired WHERE retired_at < ?',
+                                    (cutoff,)).fetchall():
+            if self._live_bytes(conn, pack):
+                # Written to again somehow; keep it
+                continue
+            try:
+                os.remove(self._pack_path(pack))
+            except FileNotFoundError:
+                pass
+            with self._transaction() as conn:
+                conn.execute('DELETE FROM retired WHERE pack = ?', (pack,))
+
+    def rewrite(self, name, location, data):
+        """Replace the ciphertext of a stored name, keeping its metadata
+
+        location is where the name was read from; if the name has been
+        deleted or replaced since, nothing changes. Returns True if the new
+        ciphertext is in place.
+        """
+        pack = os.path.basename(location.path)
+        conn = self._connection()
+        row = conn.execute(
+            'SELECT record_offset FROM entries WHERE name = ? AND pack = ? AND body_offset = ?',
+            (name, pack, location.offset)
+        ).fetchone()
+        if row is None:
+            return False
+        metadata = self._read_header(pack, row[0]).get("metadata")
+        header = {"op": "put", "name": name, "seq": time.time_ns(), "metadata": metadata}
+        position = self._append([(header, data)], sync=True)[0]
+        with self._transaction() as conn:
+            # Only if nothing happened to the name while we were writing
+            cursor = conn.execute(
+                'UPDATE entries SET pack = ?, record_offset = ?, record_length = ?,'
+                ' body_offset = ?, body_length = ?, seq = ?'
+                ' WHERE name = ? AND pack = ? AND body_offset = ?',
+                (position[0], position[1], position[2], position[1] + position[2] - len(data),
+                 len(data), header["seq"], name, pack, location.offset)
+            )
+            replaced = cursor.rowcount == 1
+        if not replaced and self._entry(name) is None:
+            # Deleted meanwhile: make sure a rebuilt index doesn't revive it
+            self.delete_record(name, header["seq"] + 1)
+        return replaced
+
+    def delete_record(self, name, seq):
+        """Append a tombstone for a name that has no entry any more"""
+        header = {"op": "delete", "name": name, "seq": seq}
+        pack, offset, length = self._append([(header, b'')])[0]
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO tombstones (name, pack, record_offset, record_length, seq)'
+                ' VALUES (?, ?, ?, ?, ?)', (name, pack, offset, length, seq)
+            )
+
+    def iter_entries(self):
+        """Yield (name, location) of every name in the packs"""
+        conn = self._connection()
+        last = ''
+        while True:
+            rows = conn.execute(
+                'SELECT name, pack, body_offset, body_length, seq FROM entries'
+                ' WHERE name > ? ORDER BY name LIMIT 1000', (last,)
+            ).fetchall()
+            if not rows:
+                return
+            for name, pack, offset, length, seq in rows:
+                yield name, Slice(self._pack_path(pack), offset, length, seq)
+            last = rows[-1][0]
+
+    def stats(self):
+        conn = self._connection()
+        packs = self.pack_names()
+        size = sum(os.path.getsize(self._pack_path(pack)) for pack in packs)
+        live = sum(self._live_bytes(conn, pack) for pack in packs)
+        return {
+            "backend": self.kind,
+            "packs": len(packs),
+            "bytes": size,
+            "garbage_bytes": size - live,
+            "retired": conn.execute('SELECT COUNT(*) FROM retired').fetchone()[0]
+        }
+
+
+def _pack_name(number):
+    return f"pack-{number:06d}.dat"
+
+
+def _pack_number(name):
+    if name.startswith('pack-') and name.endswith('.dat') and name[5:-4].isdigit():
+        return int(name[5:-4])
+    return None
+
+
+def _encode_prefix(header, body_length):
+    raw = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return _RECORD.pack(RECORD_MAGIC, len(raw), body_length, zlib.crc32(raw)) + raw
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _find_magic(f, offset, chunk_size=1024 * 1024):
+    """Offset of the next RECORD_MAGIC at or after offset, or the end of f"""
+    while offset < f.size:
+        f.seek(offset)
+        chunk = f.read(chunk_size + len(RECORD_MAGIC) - 1)
+        index = chunk.find(RECORD_MAGIC)
+        if index >= 0:
+            return offset + index
+        offset += chunk_size
+    return f.size
+
+
+class _locked:
+    """Exclusive flock on a lock file for the duration of a block"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()
+        return False
@@ -0,0 +1,248 @@
+"""Capture policy: the image size and format uploads are expected to have.
+
+The server publishes the policy at /api/config and the capture page encodes
+its pictures to match it, so upload sizes (and with them encryption time)
+are predictable. Uploads are still checked here:
+
+- an upload larger than max_bytes is rejected;
+- an image whose dimensions don't fit the policy is scaled down (with
+  Pillow), or rejected when oversize is 'reject' or Pillow is missing.
+
+Dimensions are read from the image header (JPEG, PNG or WebP) at the start
+of the upload, so images that fit are still streamed straight into the
+encryption without being buffered. Data that isn't one of those formats is
+only held to max_bytes. Limits apply in either orientation: with the default
+1920x1080 a 1080x1920 portrait picture fits as well.
+"""
+import io
+import struct
+import threading
+
+import renditions
+
+FORMATS = ('image/jpeg', 'image/webp')
+OVERSIZE_ACTIONS = ('downscale', 'reject')
+
+# How much of an upload is read looking for the image dimensions; JPEG
+# headers can carry large EXIF blocks before the frame header
+PEEK_SIZE = 64 * 1024
+HEADER_LIMIT = 512 * 1024
+
+# Returned by image_dimensions() when the header continues past the data
+INCOMPLETE = 'incomplete'
+
+# Leading bytes of the formats image_dimensions() reads
+_SIGNATURES = (b'\xff\xd8', b'\x89PNG\r\n\x1a\n', b'RIFF')
+
+# JPEG start-of-frame markers (all but DHT, JPG and DAC in C0-CF)
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class ImageRejected(Exception):
+    """Raised for uploads outside the capture policy; served as 413"""
+
+
+def image_dimensions(data):
+    """Return (mime type, width, height) from the start of an image
+
+    Returns INCOMPLETE if data ends before the dimensions, and None if it is
+    not a JPEG, PNG or WebP image.
+    """
+    if data[:2] == b'\xff\xd8':
+        return _jpeg_dimensions(data)
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(data) < 24:
+            return INCOMPLETE
+        width, height = struct.unpack('>II', data[16:24])
+        return 'image/png', width, height
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return _webp_dimensions(data)
+    if len(data) < 12 and any(sig.startswith(data[:len(sig)]) for sig in _SIGNATURES):
+        return INCOMPLETE
+    return None
+
+
+def _jpeg_dimensions(data):
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Markers without a length
+            i += 2
+            continue
+        if marker in _JPEG_SOF:
+            if i + 9 > len(data):
+                return INCOMPLETE
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return 'image/jpeg', width, height
+        if marker == 0xDA:
+            # Start of scan without a frame header
+            return None
+        i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return INCOMPLETE
+
+
+def _webp_dimensions(data):
+    if len(data) < 30:
+        return INCOMPLETE
+    chunk = data[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', data[26:30])
+        return 'image/webp', width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L':
+        b0, b1, b2, b3 = data[21:25]
+        width = 1 + (((b1 & 0x3F) << 8) | b0)
+        height = 1 + (((b3 & 0x0F) << 10) | (b2 << 2) | ((b1 & 0xC0) >> 6))
+        return 'image/webp', width, height
+    if chunk == b'VP8X':
+        width = 1 + int.from_bytes(data[24:27], 'little')
+        height = 1 + int.from_bytes(data[27:30], 'little')
+        return 'image/webp', width, height
+    return None
+
+
+class CapturePolicy:
+    """Limits and encoding settings for captured images
+
+    quality is the encoder quality from 0 to 1, as taken by the browser's
+    canvas.toBlob().
+    """
+
+    def __init__(self, max_width=1920, max_height=1080, max_bytes=16 * 1024 * 1024,
+                 format='image/jpeg', quality=0.85, oversize='downscale'):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown capture format {format!r}")
+        if oversize not in OVERSIZE_ACTIONS:
+            raise ValueError(f"Unknown oversize action {oversize!r}")
+        if not 0 < quality <= 1:
+            raise ValueError("Capture quality must be between 0 and 1")
+        self.max_width = max_width
+        self.max_height = max_height
+        self.max_bytes = max_bytes
+        self.format = format
+        self.quality = quality
+        self.oversize = oversize
+        self.downscaled = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def _reject(self, message):
+        with self._lock:
+            self.rejected += 1
+        return ImageRejected(message)
+
+    def to_json(self):
+        return {
+            "max_width": self.max_width,
+            "max_height": self.max_height,
+            "max_bytes": self.max_bytes,
+            "format": self.format,
+            "quality": self.quality,
+            "oversize": self.oversize
+        }
+
+    def fits(self, width, height):
+        """True if an image of this size fits, in either orientation"""
+        return (max(width, height) <= max(self.max_width, self.max_height)
+                and min(width, height) <= min(self.max_width, self.max_height))
+
+    def apply(self, source):
+        """Check an upload stream against the policy
+
+        Returns a readable to encrypt in place of source: the same bytes, or
+        the scaled-down image. Attributes of source (fields, bytes_received,
+        ...) stay available on it. Raises ImageRejected, also later from
+        read() if the upload turns out to be larger than max_bytes.
+        """
+        prefix = b''
+        dimensions = INCOMPLETE
+        while dimensions is INCOMPLETE and len(prefix) < HEADER_LIMIT:
+            chunk = source.read(PEEK_SIZE)
+            if not chunk:
+                break
+            prefix += chunk
+            dimensions = image_dimensions(prefix)
+
+        reader = PolicyReader(source, prefix, self)
+        if dimensions in (None, INCOMPLETE) or self.fits(dimensions[1], dimensions[2]):
+            return reader
+        data = self.resize(reader.read(), dimensions[1], dimensions[2])
+        return PolicyReader(source, data, None)
+
+    def apply_bytes(self, data):
+        """Same as apply() for an image already in memory; returns bytes"""
+        if self.max_bytes and len(data) > self.max_bytes:
+            raise self._reject(f"Image exceeds {self.max_bytes} bytes")
+        dimensions = image_dimensions(data)
+        if dimensions in (None, INCOMPLETE) or self.fits(dimensions[1], dimensions[2]):
+            return data
+        return self.resize(data, dimensions[1], dimensions[2])
+
+    def resize(self, data, width, height):
+        """Scale an oversized image down to the policy, or raise ImageRejected"""
+        if self.oversize == 'reject' or not renditions.available():
+            raise self._reject(
+                f"Image is {width}x{height}, larger than {self.max_width}x{self.max_height}"
+            )
+        try:
+            data = renditions.fit(data, self.max_width, self.max_height,
+                                  self.format, round(self.quality * 100))
+        except ValueError as e:
+            raise self._reject(str(e)) from e
+        with self._lock:
+            self.downscaled += 1
+        return data
+
+
+class PolicyReader:
+    """Reader that replays buffered bytes, then continues with the source
+
+    With a policy the rest of the source is read too, and ImageRejected is
+    raised once more than the policy's max_bytes have been read; without
+    one only the buffered bytes are returned. Unknown attributes are looked
+    up on the source.
+    """
+
+    def __init__(self, source, buffered, policy):
+        self._source = source
+        self._buffer = io.BytesIO(buffered)
+        self._policy = policy
+        self._read = 0
+
+    def read(self, size=-1):
+        if size < 0 and self._policy is not None:
+            return self._read_all()
+        data = self._buffer.read(size)
+        if self._policy is None:
+            return data
+        if size < 0 or len(data) < size:
+            more = self._source.read(-1 if size < 0 else size - len(data))
+            data = data + more if data else more
+        self._read += len(data)
+        max_bytes = self._policy.max_bytes
+        if max_bytes and self._read > max_bytes:
+            raise self._policy._reject(f"Image exceeds {max_bytes} bytes")
+        return data
+
+    def _read_all(self):
+        # In chunks of at most one byte past max_bytes, so that an oversized
+        # upload is rejected instead of being buffered whole
+        max_bytes = self._policy.max_bytes
+        chunks = []
+        while True:
+            size = PEEK_SIZE
+            if max_bytes:
+                size = min(size, max_bytes + 1 - self._read)
+            chunk = self.read(size)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def __getattr__(self, name):
+        return getattr(self._source, name)
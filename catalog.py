@@ -0,0 +1,374 @@
+"""SQLite catalog of stored images.
+
+The catalog holds one row per image with the fields of its metadata sidecar,
+so listing, filtering and counting images are index lookups instead of
+directory scans. It runs in WAL mode, which lets readers proceed while an
+upload is being recorded.
+
+The sidecar files stay the source of truth: rebuild() recreates the catalog
+from them (see rebuild_catalog.py).
+"""
+import base64
+import json
+import os
+import sqlite3
+
+import storage
+from sqlite_util import ThreadConnections, Transaction
+
+SCHEMA_VERSION = 4
+
+# seq numbers images in the order they were recorded and is never reused,
+# not even after the newest image is deleted (see recorded_since()). digest
+# is the keyed content hash of images stored in dedup mode; blob names the
+# image whose ciphertext a duplicate shares ('' if it has its own)
+IMAGES_COLUMNS = """(
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename TEXT NOT NULL UNIQUE,
+        original_timestamp TEXT NOT NULL DEFAULT '',
+        server_timestamp INTEGER NOT NULL,
+        size INTEGER NOT NULL DEFAULT 0,
+        sha256 TEXT NOT NULL DEFAULT '',
+        digest TEXT NOT NULL DEFAULT '',
+        blob TEXT NOT NULL DEFAULT ''
+    )"""
+
+SCHEMA = [
+    f"CREATE TABLE IF NOT EXISTS images {IMAGES_COLUMNS}",
+    """CREATE INDEX IF NOT EXISTS images_server_timestamp
+        ON images (server_timestamp, filename)""",
+    """CREATE INDEX IF NOT EXISTS images_original_timestamp
+        ON images (original_timestamp, filename)""",
+    """CREATE INDEX IF NOT EXISTS images_digest
+        ON images (digest) WHERE digest != ''""",
+]
+
+# Columns added since the first schema version, by the version adding them
+MIGRATIONS = {
+    2: ["ALTER TABLE images ADD COLUMN sha256 TEXT NOT NULL DEFAULT ''"],
+    3: ["ALTER TABLE images ADD COLUMN digest TEXT NOT NULL DEFAULT ''",
+        "ALTER TABLE images ADD COLUMN blob TEXT NOT NULL DEFAULT ''"],
+    # The table is copied to add seq, keeping the rowids that were the feed's
+    # event ids before
+    4: [f"CREATE TABLE images_v4 {IMAGES_COLUMNS}",
+        "INSERT INTO images_v4"
+        " (seq, filename, original_timestamp, server_timestamp, size, sha256, digest, blob)"
+        " SELECT rowid, filename, original_timestamp, server_timestamp, size, sha256,"
+        " digest, blob FROM images ORDER BY rowid",
+        "DROP TABLE images",
+        "ALTER TABLE images_v4 RENAME TO images"],
+}
+
+# Fields of an image that API clients see
+PUBLIC_FIELDS = ('filename', 'original_timestamp', 'server_timestamp', 'size')
+
+# Filters accepted by list_images() and count(): name -> SQL condition
+FILTERS = {
+    'server_from': 'server_timestamp >= ?',
+    'server_to': 'server_timestamp < ?',
+    'original_from': 'original_timestamp >= ?',
+    'original_to': 'original_timestamp < ?',
+}
+
+MAX_PAGE_SIZE = 1000
+
+
+class Catalog:
+    """Image catalog stored in an SQLite database file
+
+    records, if given, is called to list the stored images when the catalog
+    is backfilled or rebuilt; by default the sidecars in storage_dir are read.
+    """
+
+    def __init__(self, path, storage_dir, records=None):
+        self.path = path
+        self.storage_dir = storage_dir
+        self.records = records
+        self._connections = ThreadConnections(path, row_factory=sqlite3.Row)
+
+    def _connection(self):
+        return self._connections.get()
+
+    def _transaction(self):
+        return Transaction(self._connection())
+
+    def open(self):
+        """Create the schema, backfilling from the sidecars on first use"""
+        with self._transaction() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version == 0:
+                _create_schema(conn)
+                self._backfill(conn)
+            elif version < SCHEMA_VERSION:
+                for target in range(version + 1, SCHEMA_VERSION + 1):
+                    for statement in MIGRATIONS[target]:
+                        conn.execute(statement)
+                _create_schema(conn)
+            if version != SCHEMA_VERSION:
+                conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+
+    def add(self, records):
+        """Record stored images; records are dicts with the metadata fields"""
+        with self._transaction() as conn:
+            _insert(conn, [_row(record) for record in records])
+
+    def remove(self, filenames):
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM images WHERE filename = ?',
+                             [(filename,) for filename in filenames])
+
+    def set_sha256(self, filename, sha256):
+        """Record the ciphertext hash of an image catalogued without one"""
+        with self._transaction() as conn:
+            conn.execute('UPDATE images SET sha256 = ? WHERE filename = ?', (sha256, filename))
+
+    def update_file(self, filename, size, sha256):
+        """Record new ciphertext details of an image rewritten in place"""
+        with self._transaction() as conn:
+            conn.execute('UPDATE images SET size = ?, sha256 = ? WHERE filename = ?',
+                         (size, sha256, filename))
+
+    def find_digest(self, digest):
+        """Return an image whose content has this keyed hash, or None"""
+        row = self._connection().execute(
+            'SELECT * FROM images WHERE digest = ? LIMIT 1', (digest,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def dedup_stats(self):
+        """Images stored as duplicates and the ciphertext bytes they saved
+
+        Images are grouped by the ciphertext they share, so the numbers stay
+        right after the first image of a group has been deleted.
+        """
+        images, distinct, total, stored = self._connection().execute(
+            "SELECT COALESCE(SUM(n), 0), COUNT(*), COALESCE(SUM(total), 0),"
+            " COALESCE(SUM(one), 0) FROM ("
+            "  SELECT COUNT(*) AS n, SUM(size) AS total, MAX(size) AS one FROM images"
+            "  GROUP BY CASE WHEN blob != '' THEN blob ELSE filename END)"
+        ).fetchone()
+        return {
+            "images": images,
+            "duplicates": images - distinct,
+            "bytes_saved": total - stored,
+            "ratio": round(images / distinct, 4) if distinct else 1.0
+        }
+
+    def ping(self):
+        """Run a trivial query; raises if the database can't be read"""
+        self._connection().execute('SELECT 1 FROM images LIMIT 1').fetchall()
+
+    def get(self, filename):
+        row = self._connection().execute(
+            'SELECT * FROM images WHERE filename = ?', (filename,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def last_seq(self):
+        """Sequence number of the most recently recorded image, 0 if none"""
+        return self._connection().execute(
+            'SELECT COALESCE(MAX(seq), 0) FROM images'
+        ).fetchone()[0]
+
+    def recorded_since(self, seq, limit=100):
+        """Rows of the images recorded after sequence number seq, in that order
+
+        Writers are serialized and sequence numbers are never reused, so an
+        image recorded after seq is always found here, also across rebuild().
+        """
+        rows = self._connection().execute(
+            'SELECT * FROM images WHERE seq > ? ORDER BY seq LIMIT ?',
+            (seq, max(1, min(int(limit), MAX_PAGE_SIZE)))
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def list_images(self, filters=None, cursor=None, limit=100, descending=False):
+        """Return (rows, next_cursor) for one page of images
+
+        Pages are ordered by (server_timestamp, filename) and continue after
+        the position encoded in cursor (keyset pagination), so every page is a
+        single index range scan no matter how deep it is.
+        """
+        conditions, params = _conditions(filters)
+        if cursor:
+            timestamp, filename = decode_cursor(cursor)
+            op = '<' if descending else '>'
+            conditions.append(f'(server_timestamp, filename) {op} (?, ?)')
+            params.extend([timestamp, filename])
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        order = 'DESC' if descending else 'ASC'
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        rows = self._connection().execute(
+            f'SELECT * FROM images {where}'
+            f' ORDER BY server_timestamp {order}, filename {order} LIMIT ?',
+            params + [limit + 1]
+        ).fetchall()
+
+        rows = [dict(row) for row in rows]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1])
+        return rows, next_cursor
+
+    def count(self, filters=None):
+        conditions, params = _conditions(filters)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self._connection().execute(
+            f'SELECT COUNT(*) FROM images {where}', params
+        ).fetchone()[0]
+
+    def total_size(self):
+        """Total ciphertext bytes of all catalogued images"""
+        return self._connection().execute(
+            'SELECT COALESCE(SUM(size), 0) FROM images'
+        ).fetchone()[0]
+
+    def rebuild(self):
+        """Replace the catalog contents with what the store holds"""
+        with self._transaction() as conn:
+            last = _last_seq(conn)
+            # Recreated rather than emptied, so that older schemas are upgraded
+            conn.execute('DROP TABLE IF EXISTS images')
+            _create_schema(conn)
+            # Numbered on from the old table, so feed clients resuming from
+            # before the rebuild get everything again rather than nothing
+            count = self._backfill(conn, first_seq=last + 1)
+            conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+        return count
+
+    def _backfill(self, conn, first_seq=None):
+        count = 0
+        batch = []
+        if self.records is not None:
+            records = self.records()
+        else:
+            records = iter_sidecar_records(self.storage_dir)
+        for index, record in enumerate(records):
+            row = _row(record)
+            if first_seq is not None:
+                row['seq'] = first_seq + index
+            batch.append(row)
+            if len(batch) >= 1000:
+                count += _insert(conn, batch)
+                batch = []
+        count += _insert(conn, batch)
+        return count
+
+
+def _create_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def _insert(conn, rows):
+    # Rows carry a seq only when backfilled into a rebuilt table
+    if rows and 'seq' in rows[0]:
+        conn.executemany(
+            'INSERT OR REPLACE INTO images'
+            ' (seq, filename, original_timestamp, server_timestamp, size, sha256, digest, blob)'
+            ' VALUES (:seq, :filename, :original_timestamp, :server_timestamp, :size, :sha256,'
+            ' :digest, :blob)',
+            rows
+        )
+        return len(rows)
+    conn.executemany(
+        'INSERT OR REPLACE INTO images'
+        ' (filename, original_timestamp, server_timestamp, size, sha256, digest, blob)'
+        ' VALUES (:filename, :original_timestamp, :server_timestamp, :size, :sha256,'
+        ' :digest, :blob)',
+        rows
+    )
+    return len(rows)
+
+
+def _last_seq(conn):
+    """Highest sequence number handed out so far, deleted images included"""
+    last = 0
+    for query in ("SELECT seq FROM sqlite_sequence WHERE name = 'images'",
+                  'SELECT MAX(rowid) FROM images'):
+        try:
+            row = conn.execute(query).fetchone()
+        except sqlite3.OperationalError:
+            # No such table yet
+            continue
+        if row is not None and row[0]:
+            last = max(last, row[0])
+    return last
+
+
+def public_record(row):
+    """The PUBLIC_FIELDS of a catalog row"""
+    return {name: row[name] for name in PUBLIC_FIELDS}
+
+
+def _row(record):
+    return {
+        'filename': record['filename'],
+        'original_timestamp': str(record.get('original_timestamp') or ''),
+        'server_timestamp': int(record.get('server_timestamp') or 0),
+        'size': int(record.get('size') or 0),
+        'sha256': str(record.get('sha256') or ''),
+        'digest': str(record.get('digest') or ''),
+        'blob': str(record.get('blob') or ''),
+    }
+
+
+def _conditions(filters):
+    conditions = []
+    params = []
+    for name, value in (filters or {}).items():
+        if value is None or value == '':
+            continue
+        conditions.append(FILTERS[name])
+        params.append(int(value) if name.startswith('server_') else str(value))
+    return conditions, params
+
+
+def iter_sidecar_records(storage_dir):
+    """Yield the metadata records of the image files in a storage directory"""
+    for filename, path in storage.iter_image_files(storage_dir):
+        try:
+            yield read_sidecar(path, filename)
+        except FileNotFoundError:
+            # Deleted while we were scanning
+            continue
+
+
+def read_sidecar(image_path, filename):
+    """Return the metadata record for a stored image
+
+    Falls back to the file's modification time when the sidecar is missing
+    or unreadable.
+    """
+    stat = os.stat(image_path)
+    sidecar = os.path.join(os.path.dirname(image_path), storage.metadata_filename(filename))
+    try:
+        with open(sidecar) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        metadata = {}
+    return {
+        'filename': filename,
+        'original_timestamp': metadata.get('original_timestamp', ''),
+        'server_timestamp': metadata.get('server_timestamp') or int(stat.st_mtime),
+        'size': stat.st_size,
+        'digest': metadata.get('digest', ''),
+        'blob': metadata.get('blob', ''),
+    }
+
+
+def encode_cursor(row):
+    raw = json.dumps([row['server_timestamp'], row['filename']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (server_timestamp, filename) from a cursor, or raise ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, filename = json.loads(raw)
+        return int(timestamp), str(filename)
+    except Exception:
+        raise ValueError("Invalid cursor")
@@ -0,0 +1,42 @@
+"""Delete plaintext temp_*.jpg files left in the storage directory.
+
+    python cleanup_temp_images.py [--storage-dir secure_images] [--dry-run]
+
+Older versions decrypted images into temp_<timestamp>.jpg files before
+sending them and never removed them. Decrypted images are now streamed from
+memory, so every such file is an unencrypted leftover and can be deleted.
+"""
+import argparse
+import os
+import re
+
+TEMP_IMAGE_RE = re.compile(r'^temp_\d+\.jpg$')
+
+
+def cleanup(root, dry_run=False):
+    """Remove leftover plaintext images under root; returns (count, bytes)"""
+    count = 0
+    freed = 0
+    for entry in os.scandir(root):
+        if entry.is_file() and TEMP_IMAGE_RE.match(entry.name):
+            size = entry.stat().st_size
+            if not dry_run:
+                os.remove(entry.path)
+            count += 1
+            freed += size
+    return count, freed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--storage-dir', default='secure_images')
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be deleted")
+    args = parser.parse_args()
+
+    count, freed = cleanup(args.storage_dir, dry_run=args.dry_run)
+    action = "Would delete" if args.dry_run else "Deleted"
+    print(f"{action} {count} temporary plaintext images ({freed} bytes)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+"""Bounded executor for encryption and decryption work.
+
+Request handlers submit crypto jobs here instead of running them inline, so
+the amount of concurrent crypto work is capped and a burst of requests is
+turned away with a QueueFull error (served as 503) instead of piling up.
+
+The executor is either a thread pool (the default: OpenSSL releases the GIL,
+and uploads are encrypted a segment at a time as they arrive, see
+encrypt_upload) or a process pool, which isolates the remaining Python-level
+work from the web workers at the cost of shipping image bytes between
+processes.
+
+Jobs are module-level functions so they can be pickled for the process pool.
+They use the Keyring installed with set_provider() (thread pool) or opened
+by the process pool's initializer, which like the app's picks up a rotated
+key (see keystore.LazyKeyring).
+"""
+import contextlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import blobstore
+import envelope
+import keystore
+import profiler
+import renditions
+import storage
+
+EXECUTOR_KINDS = ('thread', 'process')
+
+# Keys used by the jobs in this process
+_provider = None
+
+
+class QueueFull(Exception):
+    """Raised when the crypto executor has no room for more work"""
+
+    def __init__(self, retry_after):
+        super().__init__("Crypto queue is full, retry later")
+        self.retry_after = retry_after
+
+
+def set_provider(provider):
+    """Install the CryptoProvider or Keyring used by jobs running in this process"""
+    global _provider
+    _provider = provider
+
+
+def _load_provider(storage_dir, profile_dir=None):
+    """Process pool initializer: open the keyring in storage_dir
+
+    With profile_dir the worker also follows the profiler's control file, so
+    profiling windows cover the crypto processes too.
+    """
+    keyring = keystore.LazyKeyring(storage_dir)
+    keyring.load()
+    set_provider(keyring)
+    if profile_dir:
+        profiler.ProfilerControl(profile_dir, label='crypto').start()
+
+
+class CryptoExecutor:
+    """Thread or process pool with a bounded number of in-flight jobs
+
+    At most `workers + max_queue` jobs may be submitted and not yet finished;
+    submit() raises QueueFull beyond that. prepare, if given, is called once
+    before the pool is created. key_dir (holding the key files) and
+    profile_dir are passed on to the process pool's workers (see
+    _load_provider).
+    """
+
+    def __init__(self, kind='thread', workers=None, max_queue=None, retry_after=1,
+                 key_dir=None, prepare=None, profile_dir=None):
+        if kind not in EXECUTOR_KINDS:
+            raise ValueError(f"Unknown crypto executor: {kind}")
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = self.workers * 16 if max_queue is None else max_queue
+        self.retry_after = retry_after
+        self._key_dir = key_dir
+        self._prepare = prepare
+        self._profile_dir = profile_dir
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_queue)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def _get_executor(self):
+        # Pools are created on first use so that importing the app (or
+        # forking server workers) doesn't start threads or processes
+        with self._lock:
+            if self._executor is None:
+                # e.g. make sure the key files exist before workers load them
+                if self._prepare is not None:
+                    self._prepare()
+                if self.kind == 'process':
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        initializer=_load_provider,
+                        initargs=(self._key_dir, self._profile_dir)
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix='crypto'
+                    )
+            return self._executor
+
+    def _release(self, future):
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+        self._slots.release()
+
+    def submit(self, fn, *args, block=False):
+        """Submit a job, or raise QueueFull if the queue is at capacity
+
+        With block=True the call waits for a free slot instead. That is meant
+        for follow-up jobs of a request that was already admitted, such as
+        the remaining segments of a response that has started streaming.
+        """
+        sampler = profiler.current_sampler()
+        if sampler is not None and self.kind == 'thread':
+            # Include the worker thread in the request's profile
+            fn, args = _sampled, (sampler, fn) + args
+        if not self._slots.acquire(blocking=block):
+            with self._lock:
+                self._rejected += 1
+            raise QueueFull(self.retry_after)
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_flight += 1
+        future.add_done_callback(self._release)
+        return future
+
+    def run(self, fn, *args):
+        """Submit a job and wait for its result"""
+        return self.submit(fn, *args).result()
+
+    def stats(self):
+        with self._lock:
+            in_flight = self._in_flight
+            return {
+                "executor": self.kind,
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": in_flight,
+                "queue_depth": max(0, in_flight - self.workers),
+                "completed": self._completed,
+                "rejected": self._rejected
+            }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+# Jobs
+
+def _sampled(sampler, fn, *args):
+    with profiler.sampled_by(sampler):
+        return fn(*args)
+
+
+class _TimedReader:
+    """Pass-through reader that adds up the time spent in read()"""
+
+    def __init__(self, source):
+        self._source = source
+        self.read_time = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self._source.read(size)
+        self.read_time += time.perf_counter() - start
+        return data
+
+
+def encrypt_job(source, filepath):
+    """Encrypt source (bytes or a readable stream) into filepath
+
+    The file is written under a temporary name and renamed into place when
+    complete, so readers never see a partial image. Returns a dict with the
+    plaintext length (image_bytes), the ciphertext length (size), the
+    ciphertext's SHA-256 (sha256), and the seconds spent encrypting
+    (encrypt_time) and writing the file (write_time). Time spent waiting for
+    a streamed source is in neither.
+
+    With filepath None (see blobstore.PackStore.target) nothing is written
+    and the result carries the ciphertext itself instead.
+    """
+    start = time.perf_counter()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    source = _TimedReader(source)
+    if filepath is None:
+        buffer = io.BytesIO()
+        out = storage.HashingWriter(buffer)
+        image_bytes = _provider.encrypt_stream(source, out)
+        write_start = time.perf_counter()
+    else:
+        with storage.atomic_open(filepath) as f:
+            out = storage.HashingWriter(f)
+            image_bytes = _provider.encrypt_stream(source, out)
+            write_start = time.perf_counter()
+    # Closing and renaming the file count as writing it
+    write_time = out.write_time + time.perf_counter() - write_start
+    result = {
+        "image_bytes": image_bytes,
+        "size": out.size,
+        "sha256": out.hexdigest(),
+        "encrypt_time": time.perf_counter() - start - write_time - source.read_time,
+        "write_time": write_time
+    }
+    if filepath is None:
+        result["ciphertext"] = buffer.getvalue()
+    return result
+
+
+class _UploadEncryption:
+    """An image encrypted by several jobs, one chunk of plaintext each
+
+    The jobs run one after the other; the caller waits for each before
+    submitting the next. finish() returns what encrypt_job would have.
+    """
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._files = contextlib.ExitStack()
+        self._writer = None
+        self._time = 0.0
+        self.image_bytes = 0
+
+    def _open(self):
+        if self._filepath is None:
+            self._buffer = io.BytesIO()
+            target = self._buffer
+        else:
+            target = self._files.enter_context(storage.atomic_open(self._filepath))
+        self._out = storage.HashingWriter(target)
+        self._writer = _provider.encrypting_writer(self._out)
+
+    def write(self, chunk):
+        start = time.perf_counter()
+        if self._writer is None:
+            self._open()
+        self._writer.write(chunk)
+        self.image_bytes += len(chunk)
+        self._time += time.perf_counter() - start
+
+    def finish(self):
+        start = time.perf_counter()
+        if self._writer is None:
+            self._open()
+        self._writer.close()
+        write_start = time.perf_counter()
+        # Closing and renaming the file count as writing it
+        self._files.close()
+        now = time.perf_counter()
+        self._time += now - start
+        write_time = self._out.write_time + now - write_start
+        result = {
+            "image_bytes": self.image_bytes,
+            "size": self._out.size,
+            "sha256": self._out.hexdigest(),
+            "encrypt_time": self._time - write_time,
+            "write_time": write_time
+        }
+        if self._filepath is None:
+            result["ciphertext"] = self._buffer.getvalue()
+        return result
+
+    def abort(self, error):
+        """Remove the partial file"""
+        self._files.__exit__(type(error), error, error.__traceback__)
+
+
+def encrypt_upload(executor, source, filepath, chunk_size=envelope.DEFAULT_SEGMENT_SIZE):
+    """Encrypt a request stream into filepath like encrypt_job, on executor
+
+    The stream is read on the calling thread and the crypto workers get one
+    chunk at a time, so a slow uploader holds its own request thread and
+    never a crypto worker. The next chunk is read while the last one is
+    encrypted. Only the first job may raise QueueFull; the rest wait for a
+    slot, as the upload was admitted. Process pools can't share the file
+    between jobs, so there the upload is read whole and given to encrypt_job.
+    """
+    if executor.kind == 'process':
+        return executor.run(encrypt_job, source.read(), filepath)
+    encryption = _UploadEncryption(filepath)
+    chunk = source.read(chunk_size)
+    pending = executor.submit(encryption.write, chunk)
+    try:
+        while chunk:
+            chunk = source.read(chunk_size)
+            pending.result()
+            if chunk:
+                pending = executor.submit(encryption.write, chunk, block=True)
+        pending = executor.submit(encryption.finish, block=True)
+        return pending.result()
+    except BaseException as e:
+        wait([pending])
+        encryption.abort(e)
+        raise
+
+
+def rendition_job(location, names):
+    """Decrypt a stored image and encrypt the named renditions of it
+
+    Returns {name: ciphertext}, for the store's put_renditions().
+    """
+    with blobstore.open_location(location) as f:
+        plaintext = _provider.decrypt(f.read())
+    rendered = {}
+    for name, data in renditions.render(plaintext, names).items():
+        out = io.BytesIO()
+        _provider.encrypt_stream(io.BytesIO(data), out)
+        rendered[name] = out.getvalue()
+    return rendered
+
+
+def open_job(location):
+    """Prepare a stored image for decryption
+
+    Returns ('segments', header, data_key, total, size) for segmented files,
+    whose segments can then be decrypted with decrypt_segments_job; size is
+    the plaintext length. Older formats can only be decrypted whole and
+    return ('whole', plaintext).
+    """
+    with blobstore.open_location(location) as f:
+        header = envelope.read_header(f)
+        if header is None or header.version == envelope.VERSION_1:
+            f.seek(0)
+            return 'whole', _provider.decrypt(f.read())
+        file_size = f.size
+    total = envelope.segment_count(header, file_size)
+    size = envelope.plaintext_size(header, file_size)
+    return 'segments', header, _provider.unwrap_key(header), total, size
+
+
+def decrypt_segments_job(location, header, data_key, first, count, total):
+    """Decrypt a run of segments; returns them joined into one bytes object"""
+    with blobstore.open_location(location) as f:
+        return b''.join(envelope.decrypt_segments(f, header, data_key, first, count, total))
+
+
+def export_job(location, max_bytes):
+    """open_job() that also decrypts images of up to max_bytes right away
+
+    Returns ('whole', plaintext) for those, so that several small images
+    can be decrypted in parallel, and what open_job() returns otherwise.
+    """
+    opened = open_job(location)
+    if opened[0] == 'segments' and opened[4] <= max_bytes:
+        _, header, data_key, total, _ = opened
+        return 'whole', decrypt_segments_job(location, header, data_key, 0, total, total)
+    return opened
@@ -0,0 +1,66 @@
+"""Loaded RSA keys and everything derived from them, built once per process.
+
+A CryptoProvider holds the key objects, the OAEP padding used to wrap data
+keys and the serialized public key, so requests never parse PEM files, read
+key files from disk or rebuild padding objects. The app creates one at
+startup; process pool workers load their own copy from the key files (see
+crypto_pool). Several providers are combined into a keystore.Keyring when
+old keys must stay available for decryption.
+"""
+import hashlib
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+import envelope
+
+
+class CryptoProvider:
+    """RSA key pair plus the envelope operations that use it"""
+
+    def __init__(self, private_key, public_key):
+        self.private_key = private_key
+        self.public_key = public_key
+        self.padding = envelope.OAEP
+        self.public_pem = public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        self.public_pem_sha256 = hashlib.sha256(self.public_pem).hexdigest()
+        # Recorded in every container this key encrypts (see keystore)
+        self.key_id = hashlib.sha256(public_key.public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )).digest()[:envelope.KEY_ID_SIZE]
+
+    @classmethod
+    def from_files(cls, private_key_file, public_key_file):
+        """Load the key pair from PEM files"""
+        with open(private_key_file, 'rb') as f:
+            private_key = serialization.load_pem_private_key(
+                f.read(), password=None, backend=default_backend()
+            )
+        with open(public_key_file, 'rb') as f:
+            public_key = serialization.load_pem_public_key(f.read(), backend=default_backend())
+        return cls(private_key, public_key)
+
+    def wrap_key(self, data_key):
+        return self.public_key.encrypt(data_key, self.padding)
+
+    def unwrap_key(self, header):
+        """Recover the data key of a container from its header"""
+        return self.private_key.decrypt(header.wrapped_key, self.padding)
+
+    def encrypt(self, data):
+        return envelope.encrypt(data, self.public_key, self.key_id)
+
+    def decrypt(self, data):
+        return envelope.decrypt(data, self.private_key)
+
+    def encrypt_stream(self, source, fileobj):
+        """Encrypt a readable stream into fileobj; returns the plaintext length"""
+        return envelope.encrypt_stream(source, fileobj, self.public_key, self.key_id)
+
+    def encrypting_writer(self, fileobj):
+        """Return an envelope.EncryptingWriter into fileobj"""
+        return envelope.EncryptingWriter(fileobj, self.public_key, self.key_id)
@@ -0,0 +1,361 @@
+"""Container format for encrypted images.
+
+Every image is encrypted with a fresh AES-256-GCM data key, and only that
+data key is encrypted (wrapped) with the RSA public key. That costs one RSA
+operation per image instead of one per 190 bytes.
+
+Version 1 layout (whole image in one AEAD message):
+
+    MAGIC (4) | version (1) | wrapped key length (2) | wrapped key | nonce (12) | ciphertext + tag
+
+Version 2 layout (segmented, written and read incrementally):
+
+    MAGIC (4) | version (1) | segment size (4) | wrapped key length (2) | wrapped key | nonce prefix (7)
+    segment 0 | segment 1 | ... | last segment
+
+Each segment holds `segment size` bytes of plaintext (the last one holds
+0..segment size bytes) and is sealed on its own with the nonce
+`prefix | segment index (4) | last flag (1)`. The index stops segments from
+being reordered and the last flag stops the file from being truncated on a
+segment boundary.
+
+Version 3 layout (segmented like version 2, and names the RSA key):
+
+    MAGIC (4) | version (1) | segment size (4) | key id (8) | wrapped key length (2) | wrapped key | nonce prefix (7)
+    segment 0 | segment 1 | ... | last segment
+
+In versions 1 and 2 all header bytes are authenticated as associated data, so
+a tampered header fails decryption. Version 3 authenticates the magic,
+version, segment size and nonce prefix, but not the key id and wrapped key,
+so those can be replaced to move a file to another RSA key without touching
+its segments (see rewrap_header). Tampering with them still fails: the data
+key no longer unwraps, or it no longer matches the segment tags.
+
+Files without the magic prefix are treated as the legacy format: a sequence
+of 4-byte big-endian lengths followed by RSA-OAEP chunks.
+"""
+import collections
+import io
+import os
+import struct
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+MAGIC = b'SIMG'
+VERSION_1 = 1
+VERSION_2 = 2
+VERSION_3 = 3
+
+DATA_KEY_SIZE = 32  # AES-256
+KEY_ID_SIZE = 8
+NONCE_SIZE = 12
+NONCE_PREFIX_SIZE = 7
+TAG_SIZE = 16
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+
+# Legacy format: RSA-OAEP over 190 byte chunks (fits a 2048-bit key)
+LEGACY_CHUNK_SIZE = 190
+
+_MAGIC_VERSION = struct.Struct('>4sB')
+_V1_FIELDS = struct.Struct('>H')
+_V2_FIELDS = struct.Struct('>IH')
+_V3_FIELDS = struct.Struct(f'>I{KEY_ID_SIZE}sH')
+_SEGMENT_NONCE = struct.Struct('>IB')
+
+# raw is the complete header and aad the part of it authenticated with every
+# segment; key_id is None before version 3
+Header = collections.namedtuple(
+    'Header', ['version', 'raw', 'wrapped_key', 'nonce', 'segment_size', 'key_id', 'aad']
+)
+
+
+# RSA-OAEP padding for wrapping data keys (and the legacy format). Padding
+# objects are immutable, so one instance is shared by every operation.
+OAEP = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+
+
+def _read_exact(fileobj, size):
+    """Read exactly size bytes unless the stream ends first"""
+    parts = []
+    while size > 0:
+        part = fileobj.read(size)
+        if not part:
+            break
+        parts.append(part)
+        size -= len(part)
+    return b''.join(parts)
+
+
+def _segment_nonce(prefix, index, last):
+    return prefix + _SEGMENT_NONCE.pack(index, 1 if last else 0)
+
+
+def is_legacy(data):
+    """Return True if the data is in the legacy chunked RSA format"""
+    return not data.startswith(MAGIC)
+
+
+def read_header(fileobj):
+    """Read and parse a container header, or return None for legacy files"""
+    prefix = _read_exact(fileobj, _MAGIC_VERSION.size)
+    if len(prefix) < _MAGIC_VERSION.size or is_legacy(prefix):
+        return None
+    _, version = _MAGIC_VERSION.unpack(prefix)
+
+    key_id = None
+    if version == VERSION_1:
+        fields = _read_exact(fileobj, _V1_FIELDS.size)
+        if len(fields) < _V1_FIELDS.size:
+            raise ValueError("Truncated header")
+        (wrapped_len,) = _V1_FIELDS.unpack(fields)
+        segment_size = None
+        nonce_size = NONCE_SIZE
+    elif version == VERSION_2:
+        fields = _read_exact(fileobj, _V2_FIELDS.size)
+        if len(fields) < _V2_FIELDS.size:
+            raise ValueError("Truncated header")
+        segment_size, wrapped_len = _V2_FIELDS.unpack(fields)
+        nonce_size = NONCE_PREFIX_SIZE
+    elif version == VERSION_3:
+        fields = _read_exact(fileobj, _V3_FIELDS.size)
+        if len(fields) < _V3_FIELDS.size:
+            raise ValueError("Truncated header")
+        segment_size, key_id, wrapped_len = _V3_FIELDS.unpack(fields)
+        nonce_size = NONCE_PREFIX_SIZE
+    else:
+        raise ValueError(f"Unsupported container version: {version}")
+    if segment_size == 0:
+        raise ValueError("Invalid segment size")
+
+    rest = _read_exact(fileobj, wrapped_len + nonce_size)
+    if len(rest) < wrapped_len + nonce_size:
+        raise ValueError("Truncated header")
+    raw = prefix + fields + rest
+    nonce = rest[wrapped_len:]
+    if version == VERSION_3:
+        aad = _v3_aad(segment_size, nonce)
+    else:
+        aad = raw
+    return Header(
+        version=version,
+        raw=raw,
+        wrapped_key=rest[:wrapped_len],
+        nonce=nonce,
+        segment_size=segment_size,
+        key_id=key_id,
+        aad=aad
+    )
+
+
+def _v3_header(segment_size, key_id, wrapped_key, nonce_prefix):
+    if len(key_id) != KEY_ID_SIZE:
+        raise ValueError(f"Key id must be {KEY_ID_SIZE} bytes")
+    return (
+        _MAGIC_VERSION.pack(MAGIC, VERSION_3)
+        + _V3_FIELDS.pack(segment_size, key_id, len(wrapped_key))
+        + wrapped_key
+        + nonce_prefix
+    )
+
+
+def _v3_aad(segment_size, nonce_prefix):
+    return _MAGIC_VERSION.pack(MAGIC, VERSION_3) + struct.pack('>I', segment_size) + nonce_prefix
+
+
+def rewrap_header(header, wrapped_key, key_id):
+    """Return the raw header of a version 3 container re-addressed to another key
+
+    wrapped_key is the container's data key wrapped with the new key. The
+    segments that follow the header stay valid as they are.
+    """
+    if header.version != VERSION_3:
+        raise ValueError("Only version 3 containers can be rewrapped")
+    return _v3_header(header.segment_size, key_id, wrapped_key, header.nonce)
+
+
+def encrypt(data, public_key, key_id):
+    """Encrypt data with a fresh data key wrapped by the RSA public key"""
+    out = io.BytesIO()
+    writer = EncryptingWriter(out, public_key, key_id)
+    writer.write(data)
+    writer.close()
+    return out.getvalue()
+
+
+def decrypt(data, private_key):
+    """Decrypt a container held in memory, including legacy files"""
+    return b''.join(iter_decrypt(io.BytesIO(data), private_key))
+
+
+class EncryptingWriter:
+    """File-like writer that encrypts into the segmented (version 3) format
+
+    key_id names the RSA key pair of public_key (see keystore). Plaintext is
+    buffered until a full segment is available, so at most one segment is
+    held in memory besides the caller's own buffer. close() must be called to
+    seal the final segment; it does not close the underlying file.
+    """
+
+    def __init__(self, fileobj, public_key, key_id, segment_size=DEFAULT_SEGMENT_SIZE):
+        self._fileobj = fileobj
+        self._segment_size = segment_size
+        self._buffer = bytearray()
+        self._index = 0
+        self._closed = False
+        self.bytes_written = 0
+
+        data_key = AESGCM.generate_key(bit_length=DATA_KEY_SIZE * 8)
+        wrapped_key = public_key.encrypt(data_key, OAEP)
+        self._aead = AESGCM(data_key)
+        self._nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+        self._aad = _v3_aad(segment_size, self._nonce_prefix)
+        self._emit(_v3_header(segment_size, key_id, wrapped_key, self._nonce_prefix))
+
+    def _emit(self, data):
+        self._fileobj.write(data)
+        self.bytes_written += len(data)
+
+    def _seal(self, plaintext, last):
+        nonce = _segment_nonce(self._nonce_prefix, self._index, last)
+        self._emit(self._aead.encrypt(nonce, bytes(plaintext), self._aad))
+        self._index += 1
+
+    def write(self, data):
+        if self._closed:
+            raise ValueError("Write to closed EncryptingWriter")
+        view = memoryview(data)
+        # Keep at least one byte back so the final segment is sealed by close()
+        while len(self._buffer) + len(view) > self._segment_size:
+            take = self._segment_size - len(self._buffer)
+            self._seal(self._buffer + view[:take], last=False)
+            self._buffer = bytearray()
+            view = view[take:]
+        self._buffer += view
+        return len(data)
+
+    def close(self):
+        if not self._closed:
+            self._seal(self._buffer, last=True)
+            self._buffer = bytearray()
+            self._closed = True
+
+
+def encrypt_stream(source, fileobj, public_key, key_id, segment_size=DEFAULT_SEGMENT_SIZE):
+    """Encrypt everything readable from source into fileobj
+
+    Returns the number of plaintext bytes consumed.
+    """
+    writer = EncryptingWriter(fileobj, public_key, key_id, segment_size)
+    total = 0
+    while True:
+        chunk = source.read(segment_size)
+        if not chunk:
+            break
+        writer.write(chunk)
+        total += len(chunk)
+    writer.close()
+    return total
+
+
+def iter_decrypt(fileobj, private_key):
+    """Yield decrypted plaintext from an open container file
+
+    Segmented files are decrypted one segment at a time. Version 1 and legacy
+    files can only be authenticated as a whole, so they are yielded in one piece.
+    """
+    start = fileobj.tell()
+    header = read_header(fileobj)
+    if header is None:
+        fileobj.seek(start)
+        yield decrypt_legacy(fileobj.read(), private_key)
+        return
+    yield from iter_decrypt_body(fileobj, header, unwrap_key(header, private_key))
+
+
+def iter_decrypt_body(fileobj, header, data_key):
+    """Yield the plaintext of a container whose header has already been read"""
+    aead = AESGCM(data_key)
+
+    if header.version == VERSION_1:
+        yield aead.decrypt(header.nonce, fileobj.read(), header.aad)
+        return
+
+    sealed_size = header.segment_size + TAG_SIZE
+    index = 0
+    current = _read_exact(fileobj, sealed_size)
+    while True:
+        following = _read_exact(fileobj, sealed_size) if len(current) == sealed_size else b''
+        last = not following
+        nonce = _segment_nonce(header.nonce, index, last)
+        yield aead.decrypt(nonce, current, header.aad)
+        if last:
+            return
+        current = following
+        index += 1
+
+
+def unwrap_key(header, private_key):
+    """Recover the data key of a container from its header"""
+    return private_key.decrypt(header.wrapped_key, OAEP)
+
+
+def segment_count(header, file_size):
+    """Return the number of segments in a segmented container"""
+    body = file_size - len(header.raw)
+    return max(1, -(-body // (header.segment_size + TAG_SIZE)))
+
+
+def decrypt_segments(fileobj, header, data_key, first, count, total):
+    """Decrypt `count` segments starting at index `first` of a segmented container
+
+    `total` is the segment count of the whole file (see segment_count), which
+    tells which segment must carry the last flag. Returns a list of plaintext
+    segments.
+    """
+    aead = AESGCM(data_key)
+    sealed_size = header.segment_size + TAG_SIZE
+    fileobj.seek(len(header.raw) + first * sealed_size)
+    segments = []
+    for index in range(first, min(first + count, total)):
+        sealed = _read_exact(fileobj, sealed_size)
+        nonce = _segment_nonce(header.nonce, index, index == total - 1)
+        segments.append(aead.decrypt(nonce, sealed, header.aad))
+    return segments
+
+
+def plaintext_size(header, file_size):
+    """Return the plaintext length of a container from its header and file size"""
+    body = file_size - len(header.raw)
+    if header.version == VERSION_1:
+        return body - TAG_SIZE
+    return body - segment_count(header, file_size) * TAG_SIZE
+
+
+def encrypt_legacy(data, public_key):
+    """Encrypt data in the legacy chunked RSA format (kept for compatibility)"""
+    result = []
+    for i in range(0, len(data), LEGACY_CHUNK_SIZE):
+        chunk = public_key.encrypt(data[i:i + LEGACY_CHUNK_SIZE], OAEP)
+        # Store the length (4 bytes) followed by the encrypted chunk
+        result.append(len(chunk).to_bytes(4, byteorder='big') + chunk)
+    return b''.join(result)
+
+
+def decrypt_legacy(encrypted_data, private_key):
+    """Decrypt data stored in the legacy chunked RSA format"""
+    data = io.BytesIO(encrypted_data)
+    decrypted_chunks = []
+
+    while data.tell() < len(encrypted_data):
+        # Read the length (4 bytes) followed by the chunk
+        chunk_length = int.from_bytes(data.read(4), byteorder='big')
+        encrypted_chunk = data.read(chunk_length)
+        decrypted_chunks.append(private_key.decrypt(encrypted_chunk, OAEP))
+
+    return b''.join(decrypted_chunks)
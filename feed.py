@@ -0,0 +1,166 @@
+"""Server-Sent Events feed of newly stored images.
+
+Viewers open /api/images/events with an EventSource instead of polling
+/api/images. Every image recorded in the catalog is sent as one event:
+
+    id: 1234
+    event: image
+    data: {"filename": "image_01HZX....enc", "original_timestamp": ...,
+           "server_timestamp": ..., "size": ...}
+
+The id is the image's sequence number in the catalog (the order in which
+images were recorded, which in async ingest mode can differ from their
+timestamps). A client that reconnects sends the last id it saw as
+Last-Event-ID, or passes it as ?cursor=, and gets exactly the images it
+missed. Without either it only gets images stored from then on.
+
+The catalog is the only source of events, so the feed works across server
+processes: uploads in this process wake the waiting streams at once, and one
+watcher thread per process polls the catalog's latest sequence number every
+poll_interval seconds for uploads stored by the others.
+"""
+import json
+import os
+import threading
+import time
+
+from catalog import public_record
+
+# Events read from the catalog per query
+PAGE_SIZE = 100
+
+
+class FeedFull(Exception):
+    """Raised by ImageFeed.subscribe() when max_clients streams are open"""
+
+    def __init__(self, max_clients, retry_after):
+        super().__init__(f"At most {max_clients} feed clients per process, retry later")
+        self.retry_after = retry_after
+
+
+class ImageFeed:
+    """Streams catalog additions to subscribers as Server-Sent Events
+
+    Each open stream holds a web server thread, so at most max_clients may
+    be open per process, and each is closed after max_seconds; EventSource
+    clients reconnect and resume on their own. A comment line is sent every
+    keepalive seconds so idle connections aren't dropped by proxies.
+    """
+
+    def __init__(self, image_catalog, max_clients=4, max_seconds=300, keepalive=15,
+                 poll_interval=0.5, retry=3):
+        self.catalog = image_catalog
+        self.max_clients = max_clients
+        self.max_seconds = max_seconds
+        self.keepalive = keepalive
+        self.poll_interval = poll_interval
+        self.retry = retry
+        self.clients = 0
+        self.events_sent = 0
+        self._latest = 0
+        self._changed = threading.Condition()
+        self._pid = None
+
+    def notify(self):
+        """Wake the streams after images were recorded by this process"""
+        if not self.clients:
+            return
+        latest = self.catalog.last_seq()
+        with self._changed:
+            if latest > self._latest:
+                self._latest = latest
+                self._changed.notify_all()
+
+    def _watch(self):
+        # Picks up images recorded by other server processes
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.notify()
+            except Exception as e:
+                print(f"Image feed watcher error: {str(e)}")
+
+    def _start_watcher(self):
+        with self._changed:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._latest = 0
+        threading.Thread(target=self._watch, name='image-feed', daemon=True).start()
+
+    def _wait(self, seq, timeout):
+        """Wait until an image after seq is known; returns False on timeout"""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._latest > seq, timeout)
+
+    def subscribe(self, cursor=None):
+        """Return an iterable of SSE text for a new stream; close() ends it
+
+        cursor is the last sequence number the client has seen, or None for
+        only new images. Raises FeedFull when max_clients streams are open
+        and ValueError for a malformed cursor.
+        """
+        after = self.catalog.last_seq() if cursor in (None, '') else int(cursor)
+        if after < 0:
+            raise ValueError("cursor must not be negative")
+        with self._changed:
+            if self.clients >= self.max_clients:
+                raise FeedFull(self.max_clients, self.retry)
+            self.clients += 1
+        try:
+            self._start_watcher()
+            self.notify()
+        except Exception:
+            self._unsubscribe()
+            raise
+        return _Subscription(self._stream(after), self._unsubscribe)
+
+    def _unsubscribe(self):
+        with self._changed:
+            self.clients -= 1
+
+    def _stream(self, after):
+        deadline = time.monotonic() + self.max_seconds
+        yield f"retry: {self.retry * 1000}\n\n"
+        while True:
+            # Everything up to the latest known image is in this query, even
+            # if the newest were deleted since
+            known = self._latest
+            rows = self.catalog.recorded_since(after, PAGE_SIZE)
+            for row in rows:
+                after = row["seq"]
+                self.events_sent += 1
+                data = json.dumps(public_record(row))
+                yield f"id: {after}\nevent: image\ndata: {data}\n\n"
+            if len(rows) == PAGE_SIZE:
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not self._wait(max(after, known), min(self.keepalive, remaining)):
+                yield ": keepalive\n\n"
+
+    def stats(self):
+        return {
+            "clients": self.clients,
+            "max_clients": self.max_clients,
+            "events_sent": self.events_sent,
+            "latest": self._latest
+        }
+
+
+class _Subscription:
+    """Response iterable of one stream; the WSGI server's close() releases it"""
+
+    def __init__(self, events, release):
+        self._events = events
+        self._release = release
+
+    def __iter__(self):
+        return self._events
+
+    def close(self):
+        if self._release is not None:
+            self._events.close()
+            self._release()
+            self._release = None
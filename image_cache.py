@@ -0,0 +1,115 @@
+"""In-process LRU cache of decrypted images.
+
+Entries are keyed by (filename, mtime, size) of the stored ciphertext, so a
+rewritten file never serves stale plaintext. The cache is bounded by the
+total number of plaintext bytes it holds: inserting evicts least recently
+used entries until the new one fits, and items larger than max_item_bytes
+are never cached. Entries can also expire after a TTL.
+"""
+import collections
+import threading
+import time
+
+
+def cache_key(filename, stat):
+    """Cache key for a stored file from its os.stat() result"""
+    return filename, stat.st_mtime_ns, stat.st_size
+
+
+class DecryptedImageCache:
+    """Thread-safe LRU cache bounded by total bytes"""
+
+    def __init__(self, max_bytes, max_item_bytes=None, ttl=None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = min(max_item_bytes or max_bytes, max_bytes)
+        self.ttl = ttl or None
+        self._entries = collections.OrderedDict()  # key -> (data, expires)
+        self._keys = {}  # filename -> current key
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def accepts(self, size):
+        """Return True if an item of this size may be cached"""
+        return self.enabled and size <= self.max_item_bytes
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            data, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if not self.accepts(len(data)):
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            # Replace the entry for this key, and any entry for an older
+            # version of the same file
+            if key in self._entries:
+                self._remove(key)
+            old_key = self._keys.get(key[0])
+            if old_key is not None and old_key in self._entries:
+                self._remove(old_key)
+
+            while self._entries and self._bytes + len(data) > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+            self._entries[key] = (data, expires)
+            self._keys[key[0]] = key
+            self._bytes += len(data)
+
+    def invalidate(self, filename):
+        """Drop whatever is cached for filename"""
+        with self._lock:
+            key = self._keys.get(filename)
+            if key is not None and key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        data, _ = self._entries.pop(key)
+        self._bytes -= len(data)
+        if self._keys.get(key[0]) == key:
+            del self._keys[key[0]]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "max_item_bytes": self.max_item_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
@@ -0,0 +1,294 @@
+"""Durable journal of accepted uploads that are stored in the background.
+
+In asynchronous ingest mode an upload is only appended to the journal before
+the server answers 202; worker threads then encrypt it into the image store,
+write its metadata and record it in the catalog. Every journal entry is one
+file, written atomically and fsynced before the upload is acknowledged:
+
+    secure_images/.ingest/<image id>.job
+
+The image payload in a job file is sealed with AES-GCM under a local spool
+key, so plaintext images never reach the disk. A job file is removed once the
+image is stored. Jobs left behind by a crash are picked up again when the
+workers start; storing is idempotent, so replaying a job that had already
+been stored just stores it again under the same name. Jobs that fail are
+renamed to <image id>.failed, with the error in <image id>.error, and can be
+requeued by renaming them back. Jobs that fail with a transient error (see
+IngestWorkers) stay queued and are retried.
+
+Workers in several server processes share the journal: a job is claimed with
+an exclusive flock on its file, which the kernel releases if the process
+dies.
+"""
+import collections
+import json
+import os
+import struct
+import threading
+import time
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import storage
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single process owns the journal
+    fcntl = None
+
+JOB_SUFFIX = '.job'
+FAILED_SUFFIX = '.failed'
+ERROR_SUFFIX = '.error'
+KEY_SIZE = 32
+NONCE_SIZE = 12
+
+# Job file: header length, JSON header (also the AAD), nonce, sealed payload
+_HEADER_LEN = struct.Struct('>I')
+
+# Temporary files older than this are left over from a crash
+STALE_TEMP_SECONDS = 3600
+
+
+class IngestJournal:
+    """Directory of pending upload jobs"""
+
+    def __init__(self, directory, key):
+        self.directory = directory
+        self._aead = AESGCM(key)
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id, suffix=JOB_SUFFIX):
+        return os.path.join(self.directory, job_id + suffix)
+
+    def append(self, job_id, payload, fields):
+        """Durably add a job; fields is a JSON-serialisable dict"""
+        header = json.dumps(dict(fields, id=job_id), sort_keys=True).encode('utf-8')
+        nonce = os.urandom(NONCE_SIZE)
+        sealed = self._aead.encrypt(nonce, bytes(payload), header)
+        with storage.atomic_open(self._path(job_id), fsync=True, permissions=0o600) as f:
+            f.write(_HEADER_LEN.pack(len(header)))
+            f.write(header)
+            f.write(nonce)
+            f.write(sealed)
+        _fsync_dir(self.directory)
+
+    def pending(self):
+        """Return the ids of queued jobs, oldest first"""
+        with os.scandir(self.directory) as entries:
+            ids = [entry.name[:-len(JOB_SUFFIX)] for entry in entries
+                   if entry.name.endswith(JOB_SUFFIX)]
+        # Image ids are ULIDs, so name order is arrival order
+        return sorted(ids)
+
+    def count(self):
+        """Return the number of queued jobs"""
+        with os.scandir(self.directory) as entries:
+            return sum(1 for entry in entries if entry.name.endswith(JOB_SUFFIX))
+
+    def claim(self, job_id):
+        """Lock a queued job; returns a Claim, or None if it's taken or gone"""
+        try:
+            f = open(self._path(job_id), 'rb')
+        except FileNotFoundError:
+            return None
+        if not _try_lock(f):
+            f.close()
+            return None
+        if os.fstat(f.fileno()).st_nlink == 0:
+            # Finished by another worker between open() and the lock
+            f.close()
+            return None
+        return Claim(self, job_id, f)
+
+    def state(self, job_id):
+        """Return 'queued', 'processing', 'failed' or None for a job id"""
+        try:
+            with open(self._path(job_id), 'rb') as f:
+                if not _try_lock(f):
+                    return 'processing'
+                return 'queued'
+        except FileNotFoundError:
+            pass
+        if os.path.exists(self._path(job_id, FAILED_SUFFIX)):
+            return 'failed'
+        return None
+
+    def error(self, job_id):
+        """Return the recorded error of a failed job"""
+        try:
+            with open(self._path(job_id, ERROR_SUFFIX)) as f:
+                return json.load(f).get('error')
+        except (OSError, ValueError):
+            return None
+
+    def remove_stale_temp_files(self):
+        """Delete partial job files left by a crash while appending"""
+        cutoff = time.time() - STALE_TEMP_SECONDS
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.tmp') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+
+    def _open(self, f):
+        header_len, = _HEADER_LEN.unpack(f.read(_HEADER_LEN.size))
+        header = f.read(header_len)
+        nonce = f.read(NONCE_SIZE)
+        payload = self._aead.decrypt(nonce, f.read(), header)
+        return json.loads(header), payload
+
+
+class Claim:
+    """A job locked by this process; finish with done() or fail()"""
+
+    def __init__(self, journal, job_id, f):
+        self.journal = journal
+        self.job_id = job_id
+        self._file = f
+
+    def read(self):
+        """Return (fields, payload) of the job"""
+        self._file.seek(0)
+        return self.journal._open(self._file)
+
+    def done(self):
+        os.remove(self.journal._path(self.job_id))
+        self.release()
+
+    def fail(self, error):
+        storage.write_atomic(self.journal._path(self.job_id, ERROR_SUFFIX),
+                             json.dumps({"error": str(error)}))
+        os.replace(self.journal._path(self.job_id),
+                   self.journal._path(self.job_id, FAILED_SUFFIX))
+        self.release()
+
+    def release(self):
+        """Unlock the job; it stays queued unless done() or fail() was called"""
+        self._file.close()
+
+
+class IngestWorkers:
+    """Threads that store the jobs of an IngestJournal
+
+    process(job_id, fields, payload) stores one job and raises on failure.
+    Exceptions of the transient types leave the job queued to be retried
+    after poll_interval; any other marks it failed. Workers are woken when
+    this process appends a job and otherwise poll the journal every
+    poll_interval seconds, which also picks up jobs appended by other
+    processes. start() may be called again after fork().
+    """
+
+    def __init__(self, journal, process, workers=2, poll_interval=1.0, transient=(OSError,)):
+        self.journal = journal
+        self.process = process
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.transient = transient
+        self._wakeup = threading.Condition()
+        self._pid = None
+        self._threads = []
+        # Job ids from the last scan of the journal, shared by the workers
+        self._batch = collections.deque()
+        self._batch_lock = threading.Lock()
+        self.stored = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        """Start the worker threads in this process, if not running yet"""
+        with self._wakeup:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._batch.clear()
+            self.journal.remove_stale_temp_files()
+            self._threads = [
+                threading.Thread(target=self._run, name=f"ingest-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def running(self):
+        return self._pid == os.getpid()
+
+    def notify(self):
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _run(self):
+        while True:
+            if not self._work_once():
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+
+    def _next_job(self, rescan):
+        """Pop the next job id to try, or None; an empty batch is refilled if rescan"""
+        with self._batch_lock:
+            if not self._batch and rescan:
+                self._batch.extend(self.journal.pending())
+            return self._batch.popleft() if self._batch else None
+
+    def _work_once(self):
+        """Store one pending job; returns False if there was nothing to do
+
+        Also returns False after a transient error, so that the worker waits
+        before the job is tried again.
+        """
+        # The journal is scanned at most once per call; jobs taken by other
+        # workers are skipped
+        scanned = False
+        while True:
+            job_id = self._next_job(rescan=not scanned)
+            if job_id is None:
+                if scanned:
+                    return False
+                scanned = True
+                continue
+            claim = self.journal.claim(job_id)
+            if claim is None:
+                continue
+            try:
+                fields, payload = claim.read()
+                self.process(job_id, fields, payload)
+            except self.transient as e:
+                print(f"Ingest error for {job_id}, will retry: {str(e)}")
+                claim.release()
+                self.retried += 1
+                return False
+            except Exception as e:
+                print(f"Ingest error for {job_id}: {str(e)}")
+                claim.fail(e)
+                self.failed += 1
+            else:
+                claim.done()
+                self.stored += 1
+            return True
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "workers": self.workers,
+            "pending": self.journal.count(),
+            "stored": self.stored,
+            "failed": self.failed,
+            "retried": self.retried
+        }
+
+
+def _try_lock(f):
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,27 @@
+"""Prepare the storage directory ahead of the first server start.
+
+    python init_storage.py
+
+Creates secure_images, generates the RSA key pair if there is none, and
+creates or backfills the image catalog. The server does the same before its
+first request, so running this is optional. As a separate step (for example
+a container init command) it keeps key generation and catalog backfills out
+of the server's startup time.
+"""
+import argparse
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.parse_args()
+
+    start = time.perf_counter()
+    import app
+    app.initialize()
+    print(f"Initialized {app.STORAGE_DIR} (key {app.crypto.active.key_id.hex()}) "
+          f"in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
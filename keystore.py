@@ -0,0 +1,256 @@
+"""RSA key pairs that wrap the data keys of stored images.
+
+The active key pair lives in private_key.pem and public_key.pem in the
+storage directory, and every new image is encrypted for it. rotate_key.py
+replaces it with a fresh pair and moves the old private key to
+keys/<key id>.pem. Retired keys are only used to decrypt images that were
+written before the rotation, until rewrap_keys.py has moved those to the
+active key. Running servers notice the changed key files and reload them
+(see LazyKeyring).
+
+A key id is the first 8 bytes of the SHA-256 of the public key (DER
+SubjectPublicKeyInfo). It is recorded in the header of every container
+written since format version 3. Older containers carry no key id and are
+opened by trying each key in turn, oldest first.
+"""
+import contextlib
+import io
+import os
+import threading
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import envelope
+import storage
+from crypto_provider import CryptoProvider
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+PRIVATE_KEY_NAME = 'private_key.pem'
+PUBLIC_KEY_NAME = 'public_key.pem'
+RETIRED_DIR_NAME = 'keys'
+
+# Seconds between checks of the key files for a rotation
+RELOAD_INTERVAL = 1.0
+
+
+def key_files(storage_dir):
+    """Return (private key file, public key file, retired key directory)"""
+    return (
+        os.path.join(storage_dir, PRIVATE_KEY_NAME),
+        os.path.join(storage_dir, PUBLIC_KEY_NAME),
+        os.path.join(storage_dir, RETIRED_DIR_NAME),
+    )
+
+
+@contextlib.contextmanager
+def key_file_lock(storage_dir):
+    """Hold an exclusive lock while the key files are checked or changed
+
+    Several server worker processes may start at once on a fresh volume; the
+    lock makes sure only one of them generates the key pair.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(storage_dir, ".keys.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class Keyring:
+    """The active CryptoProvider plus retired, decrypt-only ones
+
+    Offers the same operations as a CryptoProvider: encryption uses the
+    active key, decryption uses whichever key the container names.
+    """
+
+    def __init__(self, active, retired=()):
+        self.active = active
+        self.retired = list(retired)
+        self._providers = {provider.key_id: provider for provider in self.retired}
+        self._providers[active.key_id] = active
+
+    @property
+    def public_pem(self):
+        return self.active.public_pem
+
+    @property
+    def public_pem_sha256(self):
+        return self.active.public_pem_sha256
+
+    def get(self, key_id):
+        try:
+            return self._providers[key_id]
+        except KeyError:
+            raise ValueError(f"Unknown key id {key_id.hex()}")
+
+    def _untagged_candidates(self):
+        # Containers without a key id predate rotation, so start with the oldest key
+        return self.retired + [self.active]
+
+    def unwrap_key(self, header):
+        """Recover the data key of a container from its header"""
+        if header.key_id is not None:
+            return self.get(header.key_id).unwrap_key(header)
+        for provider in self._untagged_candidates():
+            try:
+                return provider.unwrap_key(header)
+            except ValueError:
+                continue
+        raise ValueError("No key in the keyring can open this file")
+
+    def encrypt(self, data):
+        return self.active.encrypt(data)
+
+    def encrypt_stream(self, source, fileobj):
+        """Encrypt a readable stream into fileobj; returns the plaintext length"""
+        return self.active.encrypt_stream(source, fileobj)
+
+    def encrypting_writer(self, fileobj):
+        """Return an envelope.EncryptingWriter into fileobj"""
+        return self.active.encrypting_writer(fileobj)
+
+    def decrypt(self, data):
+        fileobj = io.BytesIO(data)
+        header = envelope.read_header(fileobj)
+        if header is None:
+            for provider in self._untagged_candidates():
+                try:
+                    return envelope.decrypt_legacy(data, provider.private_key)
+                except ValueError:
+                    continue
+            raise ValueError("No key in the keyring can open this file")
+        return b''.join(envelope.iter_decrypt_body(fileobj, header, self.unwrap_key(header)))
+
+
+class LazyKeyring:
+    """A Keyring that is opened, creating the first key pair if needed, on first use
+
+    Attribute access is forwarded to the loaded Keyring, so it can be used
+    wherever a Keyring is expected. load() opens it ahead of time. The key
+    files are checked at most every reload_interval seconds, and the
+    keyring is loaded again once rotate_key.py (or anything else) has
+    changed them.
+    """
+
+    def __init__(self, storage_dir, reload_interval=RELOAD_INTERVAL):
+        self.storage_dir = storage_dir
+        self.reload_interval = reload_interval
+        self._keyring = None
+        self._signature = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._keyring is not None
+
+    def _due(self):
+        return self._keyring is None or time.monotonic() - self._checked >= self.reload_interval
+
+    def load(self):
+        if self._due():
+            with self._lock:
+                if self._due():
+                    self._checked = time.monotonic()
+                    # Taken first, so a rotation during the load is caught next time
+                    signature = key_files_signature(self.storage_dir)
+                    if self._keyring is None or signature != self._signature:
+                        self._keyring = open_keyring(self.storage_dir)
+                        self._signature = signature
+        return self._keyring
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
+def key_files_signature(storage_dir):
+    """Identity and modification time of the key files, which a rotation changes"""
+    signature = []
+    for path in key_files(storage_dir):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            signature.append(None)
+        else:
+            signature.append((stat.st_ino, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+def _load_private_key(path):
+    with open(path, 'rb') as f:
+        return serialization.load_pem_private_key(
+            f.read(), password=None, backend=default_backend()
+        )
+
+
+def _private_pem(private_key):
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+
+def _write_active(storage_dir, private_key):
+    private_file, public_file, _ = key_files(storage_dir)
+    storage.write_atomic(private_file, _private_pem(private_key), fsync=True, permissions=0o600)
+    storage.write_atomic(public_file, private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ), fsync=True)
+
+
+def _generate_private_key():
+    return rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=2048,
+        backend=default_backend()
+    )
+
+
+def load_keyring(private_key_file, public_key_file, retired_dir):
+    """Load the active key pair and every retired key"""
+    active = CryptoProvider.from_files(private_key_file, public_key_file)
+    retired = []
+    if os.path.isdir(retired_dir):
+        entries = [entry for entry in os.scandir(retired_dir) if entry.name.endswith('.pem')]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            private_key = _load_private_key(entry.path)
+            retired.append(CryptoProvider(private_key, private_key.public_key()))
+    return Keyring(active, retired)
+
+
+def open_keyring(storage_dir):
+    """Load the keyring, generating the first key pair if there is none"""
+    private_file, public_file, retired_dir = key_files(storage_dir)
+    with key_file_lock(storage_dir):
+        if not (os.path.exists(private_file) and os.path.exists(public_file)):
+            _write_active(storage_dir, _generate_private_key())
+        return load_keyring(private_file, public_file, retired_dir)
+
+
+def rotate(storage_dir):
+    """Retire the active key pair and make a new one; returns (old id, new id)"""
+    private_file, public_file, retired_dir = key_files(storage_dir)
+    with key_file_lock(storage_dir):
+        old = CryptoProvider.from_files(private_file, public_file)
+        os.makedirs(retired_dir, exist_ok=True)
+        # Keep the old private key before the active files are replaced
+        storage.write_atomic(
+            os.path.join(retired_dir, f"{old.key_id.hex()}.pem"),
+            _private_pem(old.private_key), fsync=True, permissions=0o600
+        )
+        new_key = _generate_private_key()
+        _write_active(storage_dir, new_key)
+    return old.key_id.hex(), CryptoProvider(new_key, new_key.public_key()).key_id.hex()
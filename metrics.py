@@ -0,0 +1,363 @@
+"""Counters, gauges and histograms exported in the Prometheus text format.
+
+Metrics are plain in-process objects: updating one takes a lock and touches a
+dict, cheap enough to leave on for every request. Label values are passed
+positionally in the order the metric's labels were declared:
+
+    REQUESTS = registry.counter('http_requests_total', "Requests", ('route', 'status'))
+    REQUESTS.inc('/api/upload', '200')
+
+Counters and gauges can instead be read from a callback at scrape time.
+
+Under a multi-process server every worker has its own metrics. When a
+directory is given (METRICS_DIR), each process writes a snapshot of its
+metrics there once per flush interval and whenever it is scraped, and
+collect() merges the snapshots of all processes. Counters and histograms of
+processes that have exited are still counted; gauges only of live processes.
+The directory should be emptied when the server starts (clear_directory()).
+"""
+import bisect
+import json
+import math
+import os
+import threading
+import time
+
+import storage
+
+# Latency buckets in seconds, from 1 ms to 30 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Metric:
+    """Base class; callback, if given, supplies the values at scrape time
+
+    The callback returns a number for an unlabelled metric, or a dict of
+    {label values tuple: number}. It is meant for values another object
+    already counts, such as the crypto executor's completed jobs.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        if self.callback is not None:
+            value = self.callback()
+            return value if isinstance(value, dict) else {(): value}
+        with self._lock:
+            return dict(self._values)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        # Non-cumulative count per bucket, plus +Inf; cumulated when rendered
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                key: [list(counts), total, count]
+                for key, (counts, total, count) in self._values.items()
+            }
+
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self._histogram = histogram
+        self._label_values = label_values
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start, *self._label_values)
+
+
+class Registry:
+    """The metrics of one process"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=(), callback=None):
+        return self._add(Counter(name, documentation, labels, callback))
+
+    def gauge(self, name, documentation, labels=(), callback=None):
+        return self._add(Gauge(name, documentation, labels, callback))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def snapshot(self, include=None):
+        """Serializable state of every metric (or those include() accepts)
+
+        Metrics whose callback fails are left out rather than failing the
+        whole scrape.
+        """
+        result = {}
+        for metric in self._metrics:
+            if include is not None and not include(metric):
+                continue
+            try:
+                values = metric.snapshot()
+            except Exception as e:
+                print(f"Metric {metric.name} failed: {str(e)}")
+                continue
+            result[metric.name] = {
+                "kind": metric.kind,
+                "help": metric.documentation,
+                "labels": list(metric.labels),
+                "buckets": list(getattr(metric, 'buckets', ())),
+                "values": [[list(key), value] for key, value in values.items()],
+            }
+        return result
+
+
+def merge(snapshots):
+    """Add up snapshots of the same metrics taken in different processes"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, dict(metric, values={}))
+            for key, value in metric["values"]:
+                key = tuple(key)
+                current = target["values"].get(key)
+                if current is None:
+                    target["values"][key] = value
+                elif metric["kind"] == 'histogram':
+                    counts = [a + b for a, b in zip(current[0], value[0])]
+                    target["values"][key] = [counts, current[1] + value[1], current[2] + value[2]]
+                else:
+                    target["values"][key] = current + value
+    for metric in merged.values():
+        metric["values"] = list(metric["values"].items())
+    return merged
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def render(snapshot):
+    """Render a snapshot in the Prometheus text exposition format"""
+    lines = []
+    for name, metric in snapshot.items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        labels = metric["labels"]
+        for key, value in sorted(metric["values"], key=lambda item: [str(v) for v in item[0]]):
+            if metric["kind"] != 'histogram':
+                lines.append(f"{name}{_format_labels(labels, key)} {_format_value(value)}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(list(metric["buckets"]) + [math.inf], counts):
+                cumulative += bucket_count
+                le = _format_value(float(bound))
+                lines.append(f"{name}_bucket{_format_labels(labels, key, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels, key)} {_format_value(float(total))}")
+            lines.append(f"{name}_count{_format_labels(labels, key)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+class RequestMetrics:
+    """WSGI middleware counting requests, latency and response bytes per route
+
+    The route label is read from environ[ROUTE_KEY], which the application
+    sets (for Flask, the URL rule), so that URLs carrying ids don't each get
+    their own series. Latency runs until the last byte of the body has been
+    handed to the server.
+    """
+
+    ROUTE_KEY = 'metrics.route'
+
+    def __init__(self, app, requests, latency, response_bytes):
+        self.app = app
+        self.requests = requests
+        self.latency = latency
+        self.response_bytes = response_bytes
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        status = ['500']
+
+        def metered_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def done(sent):
+            method = environ.get('REQUEST_METHOD', '')
+            route = environ.get(self.ROUTE_KEY, 'unmatched')
+            self.requests.inc(method, route, status[0])
+            self.latency.observe(time.perf_counter() - start, method, route)
+            self.response_bytes.inc(route, amount=sent)
+
+        return _MeteredBody(self.app(environ, metered_start_response), done)
+
+
+class _MeteredBody:
+    """Response iterable that reports the bytes sent once it is finished"""
+
+    def __init__(self, body, done):
+        self._body = body
+        self._done = done
+        self._sent = 0
+
+    def __iter__(self):
+        for chunk in self._body:
+            self._sent += len(chunk)
+            yield chunk
+        self._finish()
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        done, self._done = self._done, None
+        if done is not None:
+            done(self._sent)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MultiProcessExporter:
+    """Shares a registry's metrics with the other processes of a server
+
+    Process-local gauges (those in `local`, for example the size of the
+    storage directory) are not shared; the scraping process reports them.
+    """
+
+    def __init__(self, registry, directory, interval=1.0, local=()):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._local = set(local)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def flush(self):
+        """Write this process's snapshot"""
+        snapshot = self.registry.snapshot(lambda metric: metric.name not in self._local)
+        storage.write_atomic(self._path(os.getpid()), json.dumps(snapshot))
+
+    def start(self):
+        """Start flushing on a background thread (once per process)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Metrics flush failed: {str(e)}")
+            time.sleep(self.interval)
+
+    def collect(self):
+        """Merged snapshot of every process, plus this process's local gauges"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.flush()
+        snapshots = [self.registry.snapshot(lambda metric: metric.name in self._local)]
+        for name in os.listdir(self.directory):
+            pid, ext = os.path.splitext(name)
+            if ext != '.json' or not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not _process_alive(int(pid)):
+                snapshot = {n: m for n, m in snapshot.items() if m["kind"] != 'gauge'}
+            snapshots.append(snapshot)
+        return merge(snapshots)
+
+
+def clear_directory(directory):
+    """Remove the snapshots left by an earlier run of the server"""
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.endswith('.json') or name.endswith('.tmp'):
+            os.remove(os.path.join(directory, name))
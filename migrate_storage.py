@@ -0,0 +1,62 @@
+"""Move images from the old flat secure_images layout into shard directories.
+
+    python migrate_storage.py [--storage-dir secure_images] [--dry-run]
+
+Every image_*.enc file at the top level of the storage directory is renamed
+into its shard directory together with its metadata_*.json sidecar and any
+renditions. Metadata files whose image no longer exists are moved next to
+where that image would live. Renames are atomic and files keep their names,
+so the tool can run while the server is up and can be interrupted and
+restarted at any time.
+"""
+import argparse
+import os
+
+import storage
+
+
+def migrate(root, dry_run=False, log=print):
+    """Move flat files under root into the sharded layout; returns counts"""
+    counts = {"images": 0, "metadata": 0, "renditions": 0, "skipped": 0}
+
+    def move(source, destination, kind):
+        if os.path.exists(destination):
+            log(f"Skipping {source}: {destination} already exists")
+            counts["skipped"] += 1
+            return
+        if not dry_run:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.rename(source, destination)
+        counts[kind] += 1
+
+    entries = [entry.name for entry in os.scandir(root) if entry.is_file()]
+    for name in entries:
+        source = os.path.join(root, name)
+        if storage.is_image_filename(name):
+            move(source, storage.image_path(root, name), "images")
+        elif name.startswith(storage.METADATA_PREFIX) and name.endswith(storage.METADATA_SUFFIX):
+            image_name = storage.image_for_metadata(name)
+            move(source, storage.metadata_path(root, image_name), "metadata")
+        elif storage.split_rendition(name):
+            image_name, rendition = storage.split_rendition(name)
+            destination = storage.rendition_path(storage.image_path(root, image_name), rendition)
+            move(source, destination, "renditions")
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--storage-dir', default='secure_images')
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be moved")
+    args = parser.parse_args()
+
+    counts = migrate(args.storage_dir, dry_run=args.dry_run)
+    action = "Would move" if args.dry_run else "Moved"
+    print(f"{action} {counts['images']} images, {counts['metadata']} metadata files "
+          f"and {counts['renditions']} renditions "
+          f"({counts['skipped']} skipped)")
+
+
+if __name__ == '__main__':
+    main()
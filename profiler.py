@@ -0,0 +1,407 @@
+"""Opt-in sampling profiler for the web and crypto worker processes.
+
+A Sampler records the Python stacks of some threads every few milliseconds
+from a background thread (sys._current_frames()), so the profiled code runs
+unmodified and at full speed apart from the sampling itself. Profiles are
+written to a directory in two forms:
+
+- <name>.collapsed: one "frame;frame;frame count" line per distinct stack,
+  the input format of flamegraph.pl, speedscope and similar tools;
+- <name>.pstats: the same samples as a pstats file (python -m pstats,
+  snakeviz), with sample time in place of measured time.
+
+Profiling is switched on for all processes sharing the directory by writing
+a control file (ProfilerControl.enable()). Every process watches it:
+
+- mode 'requests' profiles the thread of a random fraction of requests, and
+  the crypto pool threads while they run those requests' jobs, one file per
+  request (see RequestProfiler);
+- mode 'window' profiles every thread of every process for the duration.
+
+Both modes end by themselves after their duration. While profiling is off
+the only cost is one attribute check per request and a stat() of the
+control file per second.
+"""
+import collections
+import contextlib
+import json
+import marshal
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+import storage
+
+CONTROL_FILE = 'control.json'
+MODES = ('requests', 'window')
+
+DEFAULT_INTERVAL = 0.005
+MAX_DURATION = 3600
+# Request profiles written per process each time profiling is enabled
+DEFAULT_REQUEST_LIMIT = 100
+
+# Threads of the profiler itself, which are never sampled
+_own_threads = set()
+
+# Sampler of the request being profiled on each thread, see current_sampler()
+_request = threading.local()
+
+
+class Sampler:
+    """Samples thread stacks at a fixed interval on a background thread
+
+    thread_ids limits sampling to those threads; by default every thread but
+    the profiler's own is sampled.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, thread_ids=None):
+        self.interval = interval
+        # Threads can be added and removed while sampling (see sampled_by())
+        self.thread_ids = collections.Counter(thread_ids) if thread_ids is not None else None
+        self.samples = collections.Counter()
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def running(self):
+        return self._thread is not None and not self._stop.is_set()
+
+    def stop(self):
+        """Stop sampling; returns the Counter of sampled stacks"""
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        return self.samples
+
+    def _run(self):
+        _own_threads.add(threading.get_ident())
+        try:
+            while not self._stop.wait(self.interval):
+                for thread_id, frame in sys._current_frames().items():
+                    if self.thread_ids is not None:
+                        if not self.thread_ids.get(thread_id):
+                            continue
+                    elif thread_id in _own_threads:
+                        continue
+                    self.samples[_stack(frame)] += 1
+        finally:
+            _own_threads.discard(threading.get_ident())
+
+
+def current_sampler():
+    """Return the Sampler profiling the current thread's request, or None"""
+    sampler = getattr(_request, 'sampler', None)
+    return sampler if sampler is not None and sampler.running else None
+
+
+@contextlib.contextmanager
+def sampled_by(sampler):
+    """Sample the current thread with sampler (if not None) inside the block
+
+    Lets work that a request hands to other threads, such as crypto jobs,
+    show up in the request's profile.
+    """
+    if sampler is None or sampler.thread_ids is None:
+        yield
+        return
+    thread_id = threading.get_ident()
+    sampler.thread_ids[thread_id] += 1
+    try:
+        yield
+    finally:
+        sampler.thread_ids[thread_id] -= 1
+
+
+def _stack(frame):
+    """Stack of (filename, first line, function) from the outermost frame in"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def _frame_name(func):
+    filename, line, name = func
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def write_collapsed(samples, path):
+    lines = [
+        f"{';'.join(_frame_name(func) for func in stack)} {count}"
+        for stack, count in samples.most_common()
+    ]
+    storage.write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def write_pstats(samples, interval, path):
+    """Write samples in the marshalled format pstats.Stats() loads
+
+    Calls are counted as samples: a function's own time is the time it was
+    on top of a sampled stack, its cumulative time the time it was anywhere
+    on one.
+    """
+    stats = {}
+
+    def entry(func):
+        if func not in stats:
+            stats[func] = [0, 0, 0.0, 0.0, collections.defaultdict(lambda: [0, 0, 0.0, 0.0])]
+        return stats[func]
+
+    for stack, count in samples.items():
+        seconds = count * interval
+        leaf = entry(stack[-1])
+        leaf[2] += seconds
+        seen = set()
+        for depth, func in enumerate(stack):
+            if func in seen:
+                continue
+            seen.add(func)
+            current = entry(func)
+            current[0] += count
+            current[1] += count
+            current[3] += seconds
+            if depth:
+                caller = current[4][stack[depth - 1]]
+                caller[0] += count
+                caller[1] += count
+                caller[3] += seconds
+                if func == stack[-1]:
+                    caller[2] += seconds
+
+    data = {
+        func: (cc, nc, tt, ct, {caller: tuple(values) for caller, values in callers.items()})
+        for func, (cc, nc, tt, ct, callers) in stats.items()
+    }
+    storage.write_atomic(path, marshal.dumps(data))
+
+
+def write_profile(directory, name, samples, interval):
+    """Write the .collapsed and .pstats files of a profile; returns the base path"""
+    if not samples:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, name)
+    write_collapsed(samples, base + '.collapsed')
+    write_pstats(samples, interval, base + '.pstats')
+    return base
+
+
+def _slug(value):
+    return re.sub(r'[^A-Za-z0-9]+', '_', value).strip('_') or 'request'
+
+
+class ProfilerControl:
+    """Applies the settings in <directory>/control.json to this process
+
+    label names the kind of process ('web', 'crypto') in the profile files.
+    """
+
+    def __init__(self, directory, label='web', poll_interval=1.0):
+        self.directory = directory
+        self.label = label
+        self.poll_interval = poll_interval
+        # Settings while profiling is on, None otherwise
+        self.settings = None
+        self._mtime = None
+        self._window = None
+        self._request_profiles = 0
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def control_path(self):
+        return os.path.join(self.directory, CONTROL_FILE)
+
+    def enable(self, mode, duration, fraction=1.0, interval=DEFAULT_INTERVAL,
+               limit=DEFAULT_REQUEST_LIMIT):
+        """Switch profiling on for every process watching the directory"""
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiler mode: {mode}")
+        duration = float(duration)
+        fraction = float(fraction)
+        interval = float(interval)
+        if not 0 < duration <= MAX_DURATION:
+            raise ValueError(f"duration must be between 0 and {MAX_DURATION} seconds")
+        if not 0 < fraction <= 1:
+            raise ValueError("fraction must be between 0 and 1")
+        if not 0.001 <= interval <= 1:
+            raise ValueError("interval must be between 0.001 and 1 second")
+        settings = {
+            "mode": mode,
+            "fraction": fraction,
+            "interval": interval,
+            "limit": int(limit),
+            "started": time.time(),
+            "until": time.time() + duration,
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        storage.write_atomic(self.control_path, json.dumps(settings))
+        self.poll()
+        return settings
+
+    def disable(self):
+        """Switch profiling off everywhere; running windows write their profiles"""
+        if os.path.exists(self.control_path):
+            os.remove(self.control_path)
+        self.poll()
+
+    def start(self):
+        """Watch the control file on a background thread (once per process)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._mtime = None
+            self.settings = None
+            self._window = None
+            self._thread = threading.Thread(target=self._run, name='profiler-control', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        _own_threads.add(threading.get_ident())
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Profiler control failed: {str(e)}")
+            time.sleep(self.poll_interval)
+
+    def poll(self):
+        """Pick up changes to the control file and end expired profiling"""
+        with self._lock:
+            try:
+                mtime = os.stat(self.control_path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime != self._mtime:
+                self._mtime = mtime
+                settings = None
+                if mtime is not None:
+                    try:
+                        with open(self.control_path) as f:
+                            settings = json.load(f)
+                    except (OSError, ValueError):
+                        settings = None
+                self._apply(settings)
+            if self.settings is not None and time.time() >= self.settings["until"]:
+                self._apply(None)
+
+    def _apply(self, settings):
+        # End the current window, writing what it sampled
+        if self._window is not None:
+            window, self._window = self._window, None
+            samples = window.stop()
+            name = f"{time.strftime('%Y%m%dT%H%M%S', time.localtime(window.started))}" \
+                   f"-window-{self.label}-{os.getpid()}"
+            write_profile(self.directory, name, samples, window.interval)
+
+        self.settings = settings
+        self._request_profiles = 0
+        if settings is not None and settings["mode"] == 'window':
+            self._window = Sampler(settings["interval"]).start()
+
+    @property
+    def profiling_requests(self):
+        settings = self.settings
+        return settings is not None and settings["mode"] == 'requests'
+
+    def sample_request(self):
+        """Return a Sampler for the current thread if this request is picked"""
+        settings = self.settings
+        if settings is None or settings["mode"] != 'requests':
+            return None
+        if time.time() >= settings["until"] or random.random() >= settings["fraction"]:
+            return None
+        with self._lock:
+            if self._request_profiles >= settings["limit"]:
+                return None
+            self._request_profiles += 1
+        return Sampler(settings["interval"], thread_ids=[threading.get_ident()]).start()
+
+    def status(self):
+        settings = self.settings
+        return {
+            "enabled": settings is not None,
+            "settings": settings,
+            "directory": self.directory,
+        }
+
+
+class RequestProfiler:
+    """WSGI middleware that profiles the requests ProfilerControl picks
+
+    Sampling covers the request thread until the response body has been
+    sent, and threads running work the request hands off under
+    sampled_by(current_sampler()) while they do. Profiles are named after
+    the time, method, route and duration.
+    When profiling is off requests are passed straight through.
+    """
+
+    def __init__(self, app, control, route_key='metrics.route'):
+        self.app = app
+        self.control = control
+        self.route_key = route_key
+
+    def __call__(self, environ, start_response):
+        if not self.control.profiling_requests:
+            return self.app(environ, start_response)
+        sampler = self.control.sample_request()
+        if sampler is None:
+            return self.app(environ, start_response)
+
+        def done():
+            _request.sampler = None
+            samples = sampler.stop()
+            elapsed_ms = (time.time() - sampler.started) * 1000
+            route = _slug(f"{environ.get('REQUEST_METHOD', '')} {environ.get(self.route_key, '')}")
+            name = f"{time.strftime('%Y%m%dT%H%M%S', time.localtime(sampler.started))}" \
+                   f"-{route}-{int(elapsed_ms)}ms-{self.control.label}-{os.getpid()}" \
+                   f"-{threading.get_ident()}"
+            try:
+                write_profile(self.control.directory, name, samples, sampler.interval)
+            except Exception as e:
+                print(f"Failed to write profile: {str(e)}")
+
+        _request.sampler = sampler
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            done()
+            raise
+        return _ProfiledBody(body, done)
+
+
+class _ProfiledBody:
+    def __init__(self, body, done):
+        self._body = body
+        self._done = done
+
+    def __iter__(self):
+        yield from self._body
+        self._finish()
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        done, self._done = self._done, None
+        if done is not None:
+            done()
@@ -0,0 +1,41 @@
+"""Rebuild the image catalog from the image store.
+
+    python rebuild_catalog.py [--storage-dir secure_images] [--catalog PATH] [--rebuild-index]
+
+Scans every stored image (metadata sidecars in the flat and sharded layouts,
+and the pack index when packs are in use) and replaces the catalog contents
+in a single transaction, so the server keeps answering from the old contents
+until the rebuild commits. --rebuild-index first rebuilds the pack index by
+scanning the pack files.
+"""
+import argparse
+import os
+import time
+
+import blobstore
+from catalog import Catalog
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--storage-dir', default='secure_images')
+    parser.add_argument('--catalog', help="catalog database (default: <storage-dir>/catalog.db)")
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help="rebuild the pack index from the pack files first")
+    args = parser.parse_args()
+
+    store = blobstore.open_store(args.storage_dir)
+    store.open()
+    if args.rebuild_index and store.kind == 'packs':
+        start = time.time()
+        count = store.rebuild_index()
+        print(f"Indexed {count} pack entries in {time.time() - start:.1f}s")
+
+    path = args.catalog or os.path.join(args.storage_dir, 'catalog.db')
+    start = time.time()
+    count = Catalog(path, args.storage_dir, records=store.iter_records).rebuild()
+    print(f"Catalogued {count} images in {time.time() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
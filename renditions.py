@@ -0,0 +1,85 @@
+"""Reduced-size renditions of stored images.
+
+Gallery views only need small previews, so besides the original every upload
+can be stored as a thumbnail and a medium-sized JPEG. They are encrypted like
+the original and kept next to it (see storage.rendition_path):
+
+    image_01HZX3Q4J8RZ5W7K2M9N0PQRST.enc          original
+    image_01HZX3Q4J8RZ5W7K2M9N0PQRST.enc.thumb    longest side 256 px
+    image_01HZX3Q4J8RZ5W7K2M9N0PQRST.enc.medium   longest side 1024 px
+
+Resizing needs Pillow. Without it no renditions are made and available()
+returns False. fit() scales uploads down to the capture policy.
+"""
+import io
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow not installed
+    Image = None
+
+# Rendition name -> longest side in pixels
+SIZES = {
+    'thumb': 256,
+    'medium': 1024,
+}
+
+JPEG_QUALITY = 80
+
+
+def available():
+    """Return True if renditions can be made in this environment"""
+    return Image is not None
+
+
+def render(data, names):
+    """Return {name: JPEG bytes} with the requested renditions of an image
+
+    The image is decoded once, at reduced scale when the JPEG decoder allows
+    it, and each rendition is scaled down from the next larger one. Images
+    already smaller than a rendition are re-encoded at their own size.
+    Raises ValueError if the data can't be decoded as an image.
+    """
+    names = sorted(names, key=SIZES.__getitem__, reverse=True)
+    largest = SIZES[names[0]]
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # Let the JPEG decoder skip detail we're about to throw away
+            image.draft('RGB', (largest, largest))
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+            renditions = {}
+            for name in names:
+                image.thumbnail((SIZES[name], SIZES[name]), Image.LANCZOS)
+                out = io.BytesIO()
+                image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+                renditions[name] = out.getvalue()
+            return renditions
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError("Cannot decode image") from e
+
+
+def fit(data, max_width, max_height, mime_type='image/jpeg', quality=JPEG_QUALITY):
+    """Scale an image down to fit max_width x max_height, in either orientation
+
+    Returns the image encoded as mime_type (WebP falls back to JPEG when
+    Pillow lacks WebP support). EXIF orientation is applied and metadata is
+    not copied. Raises ValueError if the data can't be decoded as an image.
+    """
+    long_side, short_side = max(max_width, max_height), min(max_width, max_height)
+    fmt = 'WEBP' if mime_type == 'image/webp' and features.check('webp') else 'JPEG'
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft('RGB', (long_side, long_side))
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            box = (long_side, short_side) if image.width >= image.height else (short_side, long_side)
+            image.thumbnail(box, Image.LANCZOS)
+            out = io.BytesIO()
+            image.save(out, fmt, quality=quality)
+            return out.getvalue()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError("Cannot decode image") from e
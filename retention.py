@@ -0,0 +1,357 @@
+"""Retention and garbage collection for the image store.
+
+    python retention.py [--storage-dir secure_images] [--backend files|packs] [--max-age-days N] [--max-bytes N] [--rate 500] [--dry-run]
+
+One sweep of the GarbageCollector:
+
+1. deletes images older than max_age seconds (by server timestamp);
+2. deletes the oldest images while the stored ciphertext exceeds max_bytes;
+3. removes what nothing refers to any more: metadata sidecars and
+   renditions whose image is gone, temporary files left by a crash, the
+   plaintext temp_*.jpg files of old versions, and catalog records of
+   missing images;
+4. with pack storage, compacts the packs that are mostly deleted images
+   (see blobstore.py).
+
+Images are deleted with their renditions, sidecar and catalog record. Images
+deduplicated into hard links (see DEDUP in app.py) free their space when the
+last name is deleted; the quota counts each shared file once. Images in packs
+free their space when the pack is compacted.
+
+Sweeps are paced to at most `rate` file operations per second, so a sweep
+over millions of files stays in the background of live traffic. With
+several server processes only one sweeps at a time (a lock on .gc.lock).
+Files younger than the grace period are never treated as orphans, which
+leaves uploads and migrations in progress alone.
+"""
+import argparse
+import collections
+import os
+import threading
+import time
+
+import blobstore
+import cleanup_temp_images
+import storage
+from catalog import Catalog
+
+try:
+    import fcntl
+except ImportError:  # Windows: no other process to coordinate with
+    fcntl = None
+
+LOCK_FILE = '.gc.lock'
+DEFAULT_RATE = 500
+# Orphans and temporary files younger than this may still be in use
+DEFAULT_GRACE = 3600
+# Catalog rows handled per query
+PAGE_SIZE = 500
+
+REASONS = ('expired', 'quota', 'orphan_metadata', 'orphan_rendition', 'orphan_record', 'temp')
+
+
+class GarbageCollector:
+    """Applies the retention policy and removes orphans, one sweep at a time
+
+    store is the image store of root (a blobstore FileStore or PackStore).
+    max_age (seconds) and max_bytes of 0 switch that policy off. Orphan and
+    temp file removal always runs.
+    """
+
+    def __init__(self, root, image_catalog, store, max_age=0, max_bytes=0, rate=DEFAULT_RATE,
+                 grace=DEFAULT_GRACE, dry_run=False, log=print):
+        self.root = root
+        self.catalog = image_catalog
+        self.store = store
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.rate = rate
+        self.grace = grace
+        self.dry_run = dry_run
+        self.log = log
+        self.removed = collections.Counter()
+        self.freed_bytes = 0
+        self.compacted_packs = 0
+        self.sweeps = 0
+        self.last_sweep = None
+        self.running = False
+        self._next_slot = time.monotonic()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _throttle(self):
+        # Pace file operations to `rate` per second
+        if not self.rate:
+            return
+        delay = self._next_slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_slot = max(self._next_slot, time.monotonic()) + 1.0 / self.rate
+
+    def _remove(self, path, throttle=True):
+        """Remove one file; returns the bytes this freed on disk, or None if it was gone
+
+        With throttle=False the caller has already paced this file.
+        """
+        freed = blobstore.remove_file(path, self.dry_run, self._throttle if throttle else None)
+        if freed is not None:
+            self.freed_bytes += freed
+        return freed
+
+    def delete_image(self, filename, reason):
+        """Delete an image with its renditions and sidecar; returns bytes freed
+
+        For an image in a pack this is the ciphertext released for the next
+        compaction. The catalog record is left to the caller, which removes
+        a page of them in one transaction.
+        """
+        freed = self.store.delete(filename, self.dry_run, self._throttle)
+        if freed is None:
+            return 0
+        self.removed[reason] += 1
+        self.freed_bytes += freed
+        return freed
+
+    def _forget(self, filenames):
+        if filenames and not self.dry_run:
+            self.catalog.remove(filenames)
+
+    def expire(self, now=None):
+        """Delete images stored more than max_age seconds ago"""
+        if not self.max_age:
+            return 0
+        cutoff = int((now or time.time()) - self.max_age)
+        count = 0
+        cursor = None
+        while True:
+            rows, cursor = self.catalog.list_images(
+                {'server_to': cutoff}, cursor=cursor, limit=PAGE_SIZE
+            )
+            for row in rows:
+                self.delete_image(row["filename"], 'expired')
+            self._forget([row["filename"] for row in rows])
+            count += len(rows)
+            if cursor is None:
+                return count
+
+    def stored_bytes(self):
+        """Ciphertext bytes on disk, counting shared (deduplicated) files once"""
+        return self.catalog.total_size() - self.catalog.dedup_stats()["bytes_saved"]
+
+    def enforce_quota(self):
+        """Delete the oldest images until the store fits in max_bytes"""
+        if not self.max_bytes:
+            return 0
+        excess = self.stored_bytes() - self.max_bytes
+        count = 0
+        cursor = None
+        while excess > 0:
+            rows, cursor = self.catalog.list_images(cursor=cursor, limit=PAGE_SIZE)
+            deleted = []
+            for row in rows:
+                if excess <= 0:
+                    break
+                excess -= self.delete_image(row["filename"], 'quota')
+                deleted.append(row["filename"])
+            self._forget(deleted)
+            count += len(deleted)
+            if cursor is None:
+                break
+        return count
+
+    def remove_orphans(self, now=None):
+        """Remove sidecars, renditions and temporary files nothing refers to"""
+        cutoff = (now or time.time()) - self.grace
+        count = sum(self.removed.values())
+        removed, freed = cleanup_temp_images.cleanup(self.root, dry_run=self.dry_run)
+        self.removed['temp'] += removed
+        self.freed_bytes += freed
+        for directory in storage.iter_directories(self.root):
+            for entry in _scandir(directory):
+                self._throttle()
+                reason = self._orphan_reason(entry.name)
+                if reason is None:
+                    continue
+                try:
+                    if not entry.is_file() or entry.stat().st_mtime >= cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                # Already paced by the scan above
+                if self._remove(entry.path, throttle=False) is not None:
+                    self.removed[reason] += 1
+        return sum(self.removed.values()) - count
+
+    def _orphan_reason(self, name):
+        """Reason to remove a file of this name, or None if it is in use"""
+        if name.endswith('.tmp'):
+            return 'temp'
+        if name.startswith(storage.METADATA_PREFIX) and name.endswith(storage.METADATA_SUFFIX):
+            image = storage.image_for_metadata(name)
+            if storage.resolve_path(self.root, image) is None:
+                return 'orphan_metadata'
+            return None
+        rendition = storage.split_rendition(name)
+        if rendition is not None and storage.resolve_path(self.root, rendition[0]) is None:
+            return 'orphan_rendition'
+        return None
+
+    def remove_missing_records(self, now=None):
+        """Remove catalog records of images whose file is gone"""
+        cutoff = int((now or time.time()) - self.grace)
+        count = 0
+        cursor = None
+        while True:
+            rows, cursor = self.catalog.list_images(
+                {'server_to': cutoff}, cursor=cursor, limit=PAGE_SIZE
+            )
+            missing = []
+            for row in rows:
+                self._throttle()
+                if self.store.locate(row["filename"]) is None:
+                    missing.append(row["filename"])
+            self._forget(missing)
+            self.removed['orphan_record'] += len(missing)
+            count += len(missing)
+            if cursor is None:
+                return count
+
+    def compact(self):
+        """Compact the packs that are mostly garbage; returns the packs compacted"""
+        if self.store.kind != 'packs':
+            return 0
+        compacted, _ = self.store.compact(dry_run=self.dry_run, throttle=self._throttle)
+        self.compacted_packs += compacted
+        return compacted
+
+    def sweep(self):
+        """Run one full sweep; returns the number of removals by reason
+
+        Returns None if another process is sweeping.
+        """
+        lock = _try_lock(os.path.join(self.root, LOCK_FILE))
+        if lock is None:
+            return None
+        try:
+            before = collections.Counter(self.removed)
+            started = time.time()
+            self.running = True
+            self._next_slot = time.monotonic()
+            self.expire(started)
+            self.enforce_quota()
+            self.remove_orphans(started)
+            self.remove_missing_records(started)
+            compacted = self.compact()
+            self.sweeps += 1
+            removed = {reason: self.removed[reason] - before[reason] for reason in REASONS}
+            self.last_sweep = {
+                "started": started,
+                "seconds": round(time.time() - started, 3),
+                "removed": removed,
+                "compacted_packs": compacted
+            }
+            return removed
+        finally:
+            self.running = False
+            lock.close()
+
+    def start(self, interval):
+        """Sweep every `interval` seconds on a background thread (once per process)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wakeup = threading.Event()
+            thread = threading.Thread(target=self._run, args=(interval,), name='gc', daemon=True)
+            thread.start()
+
+    def wake(self):
+        """Start the next sweep now; returns False if start() wasn't called in this process"""
+        if self._pid != os.getpid():
+            return False
+        self._wakeup.set()
+        return True
+
+    def _run(self, interval):
+        while True:
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            try:
+                self.sweep()
+            except Exception as e:
+                self.log(f"Garbage collection failed: {str(e)}")
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "max_age": self.max_age,
+            "max_bytes": self.max_bytes,
+            "rate": self.rate,
+            "sweeps": self.sweeps,
+            "removed": {reason: self.removed[reason] for reason in REASONS},
+            "freed_bytes": self.freed_bytes,
+            "compacted_packs": self.compacted_packs,
+            "last_sweep": self.last_sweep
+        }
+
+
+def _scandir(path):
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except FileNotFoundError:
+        return []
+
+
+def _try_lock(path):
+    """Open and lock path without waiting; returns the file, or None if locked"""
+    f = open(path, 'a')
+    if fcntl is None:
+        return f
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f
+    except BlockingIOError:
+        f.close()
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--storage-dir', default='secure_images')
+    parser.add_argument('--backend', choices=blobstore.BACKENDS,
+                        help="storage backend (default: packs if the storage directory has them)")
+    parser.add_argument('--catalog', help="catalog database (default: <storage-dir>/catalog.db)")
+    parser.add_argument('--max-age-days', type=float, default=0,
+                        help="delete images older than this, 0 to keep them")
+    parser.add_argument('--max-bytes', type=int, default=0,
+                        help="delete the oldest images above this much ciphertext, 0 for no limit")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                        help="file operations per second, 0 for no limit")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be deleted")
+    args = parser.parse_args()
+
+    store = blobstore.open_store(args.storage_dir, args.backend)
+    store.open()
+    image_catalog = Catalog(args.catalog or os.path.join(args.storage_dir, 'catalog.db'),
+                            args.storage_dir, records=store.iter_records)
+    image_catalog.open()
+    collector = GarbageCollector(
+        args.storage_dir, image_catalog, store, max_age=int(args.max_age_days * 86400),
+        max_bytes=args.max_bytes, rate=args.rate, dry_run=args.dry_run
+    )
+    removed = collector.sweep()
+    if removed is None:
+        print("Another process is collecting garbage; try again later")
+        return
+    action = "Would remove" if args.dry_run else "Removed"
+    print(f"{action} {removed['expired']} expired and {removed['quota']} images over quota, "
+          f"{removed['orphan_metadata']} orphaned sidecars, {removed['orphan_rendition']} "
+          f"orphaned renditions, {removed['temp']} temporary files and "
+          f"{removed['orphan_record']} catalog records of missing images "
+          f"({collector.freed_bytes} bytes freed, {collector.compacted_packs} packs compacted)")
+
+
+if __name__ == '__main__':
+    main()
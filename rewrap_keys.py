@@ -0,0 +1,206 @@
+"""Move stored images and their renditions to the active RSA key.
+
+    python rewrap_keys.py [--storage-dir secure_images] [--catalog PATH] [--rate 20] [--dry-run]
+
+Run after rotate_key.py. Images in container format version 3 only get a new
+header: their data key is unwrapped with the retired key and wrapped again
+with the active one, and the encrypted segments are copied unchanged. Older
+formats authenticate the whole header with every segment (or, for the legacy
+format, have no data key at all), so those are decrypted and re-encrypted.
+
+Every file is replaced atomically and keeps its modification time, so the
+tool can run while the server is up and can be stopped and restarted at any
+time. Images that share their ciphertext through hard links (deduplicated
+uploads) are rewrapped once and the other names linked to the new file.
+Images in pack files (see blobstore.py) get a new record with the moved
+container; the old one is reclaimed by pack compaction. It processes at most
+--rate files per second at a lowered CPU priority to leave room for live
+traffic. Once no file needs the retired keys any more
+they can be deleted from secure_images/keys.
+"""
+import argparse
+import io
+import os
+import shutil
+import time
+
+import blobstore
+import envelope
+import keystore
+import renditions
+import storage
+from catalog import Catalog
+
+
+def _action(header, keyring):
+    """What moving a container with this header takes"""
+    if header is not None and header.key_id == keyring.active.key_id:
+        return 'current'
+    if header is not None and header.version == envelope.VERSION_3:
+        return 'rewrapped'
+    return 'reencrypted'
+
+
+def _move_container(f, header, action, keyring, writer):
+    # f is positioned just after the header
+    active = keyring.active
+    if action == 'rewrapped':
+        data_key = keyring.unwrap_key(header)
+        writer.write(envelope.rewrap_header(header, active.wrap_key(data_key), active.key_id))
+        shutil.copyfileobj(f, writer)
+    else:
+        f.seek(0)
+        active.encrypt_stream(io.BytesIO(keyring.decrypt(f.read())), writer)
+
+
+def rewrap_file(path, keyring, dry_run=False):
+    """Move one container to the active key
+
+    Returns (action, size, sha256) where action is 'current' (nothing to
+    do), 'rewrapped' or 'reencrypted'; size and sha256 describe the new file.
+    """
+    with open(path, 'rb') as f:
+        header = envelope.read_header(f)
+        action = _action(header, keyring)
+        if action == 'current' or dry_run:
+            return action, None, None
+
+        stat = os.fstat(f.fileno())
+        with storage.atomic_open(path, fsync=True) as out:
+            writer = storage.HashingWriter(out)
+            _move_container(f, header, action, keyring, writer)
+            if not os.path.exists(path):
+                # Deleted while we were copying; don't bring it back
+                raise FileNotFoundError(path)
+
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return action, writer.size, writer.hexdigest()
+
+
+def rewrap_slice(store, name, location, keyring, dry_run=False):
+    """Move one container stored in a pack to the active key
+
+    Returns the same as rewrap_file(). Raises FileNotFoundError if the name
+    was deleted or replaced meanwhile.
+    """
+    with blobstore.open_location(location) as f:
+        header = envelope.read_header(f)
+        action = _action(header, keyring)
+        if action == 'current' or dry_run:
+            return action, None, None
+        buffer = io.BytesIO()
+        writer = storage.HashingWriter(buffer)
+        _move_container(f, header, action, keyring, writer)
+    if not store.rewrite(name, location, buffer.getvalue()):
+        raise FileNotFoundError(name)
+    return action, writer.size, writer.hexdigest()
+
+
+def rewrap(root, keyring, image_catalog=None, rate=None, dry_run=False, log=print, store=None):
+    """Move every stored file under root (and in store's packs) to the active key
+
+    Returns counts by action.
+    """
+    counts = {"current": 0, "rewrapped": 0, "reencrypted": 0, "relinked": 0, "failed": 0}
+    interval = 1.0 / rate if rate else 0
+    next_slot = time.monotonic()
+
+    def throttle():
+        # Throttle to `rate` files per second
+        nonlocal next_slot
+        delay = next_slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        next_slot = max(next_slot, time.monotonic()) + interval
+    # Files with more than one name: (device, inode) of the old file ->
+    # [identity, new path, size, sha256, names left to relink]
+    moved = {}
+
+    for filename, path in storage.iter_image_files(root):
+        targets = [(path, True)] + [
+            (storage.rendition_path(path, name), False) for name in renditions.SIZES
+        ]
+        for target, is_image in targets:
+            try:
+                stat = os.stat(target)
+            except FileNotFoundError:
+                continue
+            inode = (stat.st_dev, stat.st_ino)
+            identity = (stat.st_size, stat.st_mtime_ns)
+            entry = moved.get(inode)
+            if entry is not None and entry[0] == identity and not dry_run:
+                # Another name of a file rewrapped already: share the new copy
+                try:
+                    storage.link_atomic(entry[1], target)
+                except OSError as e:
+                    log(f"Failed to relink {target}: {e}")
+                    counts["failed"] += 1
+                    continue
+                counts["relinked"] += 1
+                entry[4] -= 1
+                if entry[4] <= 0:
+                    del moved[inode]
+                if is_image and image_catalog is not None:
+                    image_catalog.update_file(filename, entry[2], entry[3])
+                continue
+
+            throttle()
+            try:
+                action, size, sha256 = rewrap_file(target, keyring, dry_run=dry_run)
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                log(f"Failed to rewrap {target}: {e}")
+                counts["failed"] += 1
+                continue
+            counts[action] += 1
+            if stat.st_nlink > 1 and size is not None:
+                moved[inode] = [identity, target, size, sha256, stat.st_nlink - 1]
+            if is_image and size is not None and image_catalog is not None:
+                image_catalog.update_file(filename, size, sha256)
+
+    if store is None or store.kind != 'packs':
+        return counts
+    for name, location in store.iter_entries():
+        throttle()
+        try:
+            action, size, sha256 = rewrap_slice(store, name, location, keyring, dry_run=dry_run)
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            log(f"Failed to rewrap {name}: {e}")
+            counts["failed"] += 1
+            continue
+        counts[action] += 1
+        if storage.is_image_filename(name) and size is not None and image_catalog is not None:
+            image_catalog.update_file(name, size, sha256)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--storage-dir', default='secure_images')
+    parser.add_argument('--catalog', help="catalog database (default: <storage-dir>/catalog.db)")
+    parser.add_argument('--rate', type=float, default=20, help="files per second, 0 for no limit")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would change")
+    args = parser.parse_args()
+
+    if hasattr(os, 'nice'):
+        os.nice(10)
+    keyring = keystore.load_keyring(*keystore.key_files(args.storage_dir))
+    path = args.catalog or os.path.join(args.storage_dir, 'catalog.db')
+    image_catalog = Catalog(path, args.storage_dir) if os.path.exists(path) else None
+    store = blobstore.open_store(args.storage_dir)
+    store.open()
+
+    counts = rewrap(args.storage_dir, keyring, image_catalog, rate=args.rate,
+                    dry_run=args.dry_run, store=store)
+    action = "Would move" if args.dry_run else "Moved"
+    print(f"{action} {counts['rewrapped']} files by rewrapping their data key and "
+          f"{counts['reencrypted']} by re-encrypting them to key {keyring.active.key_id.hex()} "
+          f"({counts['current']} already current, {counts['relinked']} relinked to a shared "
+          f"copy, {counts['failed']} failed)")
+
+
+if __name__ == '__main__':
+    main()
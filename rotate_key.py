@@ -0,0 +1,25 @@
+"""Replace the active RSA key pair with a new one.
+
+    python rotate_key.py [--storage-dir secure_images]
+
+The old private key is kept in secure_images/keys/<key id>.pem, so images
+encrypted for it stay readable. Running servers load the new key within a
+second (see keystore.LazyKeyring) and use it for new uploads; then run
+rewrap_keys.py to move existing images to it.
+"""
+import argparse
+
+import keystore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--storage-dir', default='secure_images')
+    args = parser.parse_args()
+
+    old_id, new_id = keystore.rotate(args.storage_dir)
+    print(f"Retired key {old_id}; the active key is now {new_id}")
+
+
+if __name__ == '__main__':
+    main()
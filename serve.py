@@ -0,0 +1,78 @@
+"""Production server for the webcam capture app.
+
+Runs the Flask app under gunicorn with several worker processes, each with a
+pool of threads, instead of Flask's single-process development server:
+
+    python serve.py
+
+Settings come from the environment:
+
+    PORT          port to listen on (default 5000)
+    WEB_WORKERS   worker processes (default 2 x CPU count + 1)
+    WEB_THREADS   threads per worker (default 4)
+    KEEPALIVE     seconds to keep idle connections open (default 5)
+    WEB_TIMEOUT   seconds before a silent worker is restarted (default 60)
+    USE_HTTPS     "true" to terminate TLS using the certificate in CERT_DIR,
+                  which is generated on first start if missing
+    METRICS_DIR   where workers share their metrics (default
+                  secure_images/.metrics)
+"""
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+
+class ProductionServer(BaseApplication):
+    """Gunicorn application that serves app.app with the given settings"""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+        return app
+
+
+def post_fork(server, worker):
+    # Background threads don't survive fork(), so start them in each worker
+    from app import start_background_workers
+    start_background_workers()
+
+
+def server_options(tls_files=None):
+    """Build gunicorn settings from the environment"""
+    options = {
+        'bind': f"0.0.0.0:{os.environ.get('PORT', '5000')}",
+        'workers': int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1)),
+        'worker_class': 'gthread',
+        'threads': int(os.environ.get('WEB_THREADS', '4')),
+        'keepalive': int(os.environ.get('KEEPALIVE', '5')),
+        'timeout': int(os.environ.get('WEB_TIMEOUT', '60')),
+        # Import the app once in the master before the workers are forked
+        'preload_app': True,
+        'accesslog': '-',
+        'post_fork': post_fork,
+    }
+    if tls_files:
+        options['certfile'], options['keyfile'] = tls_files
+    return options
+
+
+def main():
+    # Create or load the keys, catalog and journal once in the master, so the
+    # forked workers start ready
+    from app import get_tls_files, initialize, share_metrics
+    initialize()
+    # Let /metrics on any worker report the totals of all workers
+    share_metrics()
+    ProductionServer(server_options(get_tls_files())).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""On-disk layout of the encrypted image store.
+
+Images are named after a ULID (48-bit millisecond timestamp followed by 80
+random bits, Crockford base32), so names never collide and sort by creation
+time:
+
+    image_01HZX3Q4J8RZ5W7K2M9N0PQRST.enc
+    metadata_01HZX3Q4J8RZ5W7K2M9N0PQRST.json
+
+Files are spread over two levels of subdirectories named after the SHA-256 of
+the image filename (secure_images/3f/a2/...), which keeps every directory
+small no matter how many images are stored. The metadata sidecar lives next
+to its image.
+
+Reduced-size renditions of an image (see renditions.py) are stored next to
+it, named after the image plus the rendition name:
+
+    image_01HZX3Q4J8RZ5W7K2M9N0PQRST.enc.thumb
+
+Older versions stored everything flat in the storage directory, named after
+the upload time in seconds. Those files are still found by resolve_path()
+until they are moved with migrate_storage.py.
+"""
+import contextlib
+import hashlib
+import os
+import time
+import uuid
+
+IMAGE_PREFIX = 'image_'
+IMAGE_SUFFIX = '.enc'
+METADATA_PREFIX = 'metadata_'
+METADATA_SUFFIX = '.json'
+
+_CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+
+def new_image_id():
+    """Return a new ULID string"""
+    value = (int(time.time() * 1000) << 80) | int.from_bytes(os.urandom(10), 'big')
+    chars = []
+    for _ in range(26):
+        chars.append(_CROCKFORD[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def is_image_id(value):
+    """Return True if value looks like an id made by new_image_id()"""
+    return len(value) == 26 and all(c in _CROCKFORD for c in value)
+
+
+def image_filename(image_id):
+    return f"{IMAGE_PREFIX}{image_id}{IMAGE_SUFFIX}"
+
+
+def is_image_filename(filename):
+    """Return True for a plain image filename (no directory parts)"""
+    return (
+        filename.endswith(IMAGE_SUFFIX)
+        and not filename.startswith('.')
+        and os.path.basename(filename) == filename
+    )
+
+
+def metadata_filename(filename):
+    """Return the metadata sidecar name for an image filename"""
+    stem = filename[:-len(IMAGE_SUFFIX)]
+    if stem.startswith(IMAGE_PREFIX):
+        stem = stem[len(IMAGE_PREFIX):]
+    return f"{METADATA_PREFIX}{stem}{METADATA_SUFFIX}"
+
+
+def image_for_metadata(metadata_name):
+    """Return the image filename a metadata sidecar belongs to"""
+    stem = metadata_name[len(METADATA_PREFIX):-len(METADATA_SUFFIX)]
+    return image_filename(stem)
+
+
+def rendition_path(image_path, name):
+    """Return where a rendition of the image at image_path is stored"""
+    return f"{image_path}.{name}"
+
+
+def split_rendition(filename):
+    """Return (image filename, rendition name) for a rendition file, or None"""
+    image_name, _, name = filename.rpartition('.')
+    if name and is_image_filename(image_name):
+        return image_name, name
+    return None
+
+
+def shard_dir(root, filename):
+    """Return the shard directory of an image (and its metadata)"""
+    digest = hashlib.sha256(filename.encode('utf-8')).hexdigest()
+    return os.path.join(root, digest[:2], digest[2:4])
+
+
+def image_path(root, filename, create=False):
+    """Return where an image is stored in the sharded layout"""
+    directory = shard_dir(root, filename)
+    if create:
+        os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+
+def metadata_path(root, filename, create=False):
+    """Return where the metadata of an image is stored in the sharded layout"""
+    directory = shard_dir(root, filename)
+    if create:
+        os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, metadata_filename(filename))
+
+
+def resolve_path(root, filename):
+    """Return the path of an existing image, or None
+
+    Looks in the sharded layout first and falls back to the old flat layout.
+    """
+    path = image_path(root, filename)
+    if os.path.exists(path):
+        return path
+    flat_path = os.path.join(root, filename)
+    if os.path.exists(flat_path):
+        return flat_path
+    # The file may have been migrated between the two checks
+    return path if os.path.exists(path) else None
+
+
+def temp_path(path):
+    """Return a unique temporary name next to path"""
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='wb', fsync=False, permissions=0o644):
+    """Open a temporary file that replaces path once the block succeeds
+
+    Readers see either the old file or the complete new one, never a partial
+    write. The temporary file is removed if the block raises.
+    """
+    tmp_path = temp_path(path)
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    f = os.fdopen(os.open(tmp_path, flags, permissions), mode)
+    try:
+        with f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_atomic(path, data, fsync=False, permissions=0o644):
+    """Write data to path atomically"""
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with atomic_open(path, mode, fsync=fsync, permissions=permissions) as f:
+        f.write(data)
+
+
+def link_atomic(source, path):
+    """Replace path with a hard link to source atomically"""
+    tmp_path = temp_path(path)
+    os.link(source, tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class HashingWriter:
+    """File wrapper that computes the SHA-256 and size of what is written
+
+    write_time is the time spent in the underlying file's write().
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.write_time = 0.0
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        start = time.perf_counter()
+        written = self._fileobj.write(data)
+        self.write_time += time.perf_counter() - start
+        return written
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Return the hex SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_shard(name):
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+
+def _iter_dir(path):
+    try:
+        with os.scandir(path) as entries:
+            yield from entries
+    except FileNotFoundError:
+        return
+
+
+def iter_directories(root):
+    """Yield root (the old flat layout) and then every shard directory"""
+    yield root
+    for entry in _iter_dir(root):
+        if entry.is_dir() and _is_shard(entry.name):
+            for sub in _iter_dir(entry.path):
+                if sub.is_dir() and _is_shard(sub.name):
+                    yield sub.path
+
+
+def iter_image_files(root):
+    """Yield (filename, path) for every stored image, flat or sharded"""
+    for directory in iter_directories(root):
+        for item in _iter_dir(directory):
+            if item.is_file() and is_image_filename(item.name):
+                yield item.name, item.path
@@ -0,0 +1,70 @@
+"""Fixtures shared by the tests"""
+import io
+
+import pytest
+
+import keystore
+
+
+def jpeg(color=(200, 30, 30), size=(64, 48)):
+    """A small JPEG image"""
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def storage_dir(tmp_path):
+    path = tmp_path / 'secure_images'
+    path.mkdir()
+    return str(path)
+
+
+@pytest.fixture
+def keyring(storage_dir):
+    """A LazyKeyring in storage_dir that notices key changes at once"""
+    keyring = keystore.LazyKeyring(storage_dir, reload_interval=0)
+    keyring.load()
+    return keyring
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """The app, initialized in a directory of its own for the whole session
+
+    Settings are read when app.py is imported, so they are fixed here.
+    """
+    pytest.importorskip('PIL')
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path_factory.mktemp('app'))
+        patch.setenv('DEDUP', 'true')
+        patch.setenv('GC_INTERVAL', '0')
+        patch.setenv('FEED_MAX_SECONDS', '1')
+        patch.setenv('CRYPTO_WORKERS', '2')
+        import app
+        app.initialize()
+        yield app
+        app.crypto_executor.shutdown()
+        app.rendition_executor.shutdown()
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def upload(client):
+    """Upload raw image bytes; returns the stored filename"""
+    def upload(data, timestamp=''):
+        response = client.post('/api/upload', data=data, content_type='image/jpeg',
+                               headers={'X-Capture-Timestamp': timestamp})
+        assert response.status_code == 200, response.get_json()
+        return response.get_json()
+    return upload
+
+
+@pytest.fixture
+def make_jpeg():
+    return jpeg
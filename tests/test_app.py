@@ -0,0 +1,187 @@
+"""The HTTP API, through Flask's test client"""
+import base64
+import io
+import json
+import threading
+
+import catalog
+
+
+def decrypt(client, filename, **kwargs):
+    return client.get(f'/api/decrypt/{filename}', buffered=True, **kwargs)
+
+
+def test_identical_uploads_share_one_ciphertext(client, upload, make_jpeg):
+    image = make_jpeg((10, 200, 10))
+
+    first = upload(image)
+    second = upload(image)
+
+    assert not first["deduplicated"]
+    assert second["deduplicated"]
+    assert decrypt(client, first["filename"]).data == image
+    assert decrypt(client, second["filename"]).data == image
+
+
+def test_range_request_returns_the_requested_bytes(client, upload, make_jpeg):
+    image = make_jpeg((10, 10, 200), size=(640, 480))
+    filename = upload(image)["filename"]
+
+    response = decrypt(client, filename, headers={'Range': 'bytes=100-1099'})
+
+    assert response.status_code == 206
+    assert response.data == image[100:1100]
+    assert response.headers['Content-Range'] == f"bytes 100-1099/{len(image)}"
+
+
+def test_unsatisfiable_range_is_refused(client, upload, make_jpeg):
+    image = make_jpeg((20, 10, 200))
+    filename = upload(image)["filename"]
+
+    response = decrypt(client, filename, headers={'Range': f'bytes={len(image) + 10}-'})
+
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f"bytes */{len(image)}"
+
+
+def test_decrypted_png_is_served_as_png(client, upload):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), (10, 120, 60)).save(buffer, 'PNG')
+    filename = upload(buffer.getvalue())["filename"]
+
+    whole = decrypt(client, filename)
+    part = decrypt(client, filename, headers={'Range': 'bytes=10-19'})
+
+    assert whole.mimetype == 'image/png'
+    assert part.mimetype == 'image/png'
+
+
+def test_etag_revalidation_answers_not_modified(client, upload, make_jpeg):
+    filename = upload(make_jpeg((200, 200, 10)))["filename"]
+    etag = decrypt(client, filename).headers['ETag']
+
+    response = decrypt(client, filename, headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_batch_reports_undecodable_items_and_stores_the_rest(client, make_jpeg):
+    good = base64.b64encode(make_jpeg((90, 90, 90))).decode('ascii')
+    items = [{"image": good}, {"image": "!!!notbase64"}, {"timestamp": "t"}, {"image": good}]
+
+    response = client.post('/api/upload/batch', json={"images": items})
+
+    body = response.get_json()
+    assert response.status_code == 200
+    assert [result["success"] for result in body["results"]] == [True, False, False, True]
+    assert body["stored"] == 2
+    for result in body["results"]:
+        if result["success"]:
+            assert decrypt(client, result["filename"]).status_code == 200
+
+
+def multipart(parts, boundary='frames'):
+    """multipart/form-data body from (name, value) pairs; bytes values are files"""
+    body = b''
+    for name, value in parts:
+        if isinstance(value, bytes):
+            disposition = f'form-data; name="{name}"; filename="{name}.jpg"'
+            head = f'Content-Disposition: {disposition}\r\nContent-Type: image/jpeg\r\n'
+        else:
+            head = f'Content-Disposition: form-data; name="{name}"\r\n'
+            value = value.encode()
+        body += f'--{boundary}\r\n{head}\r\n'.encode() + value + b'\r\n'
+    return body + f'--{boundary}--\r\n'.encode(), f'multipart/form-data; boundary={boundary}'
+
+
+def test_multipart_batch_pairs_each_timestamp_with_the_image_before_it(client, make_jpeg, app_module):
+    body, content_type = multipart([
+        ('image', make_jpeg((30, 60, 90))), ('timestamp', 'T1'),
+        ('image', make_jpeg((90, 60, 30))), ('timestamp', 'T2'),
+    ])
+
+    response = client.post('/api/upload/batch', data=body, content_type=content_type)
+
+    assert response.status_code == 200
+    filenames = [result["filename"] for result in response.get_json()["results"]]
+    stored = [app_module.image_catalog.get(filename)["original_timestamp"] for filename in filenames]
+    assert stored == ['T1', 'T2']
+
+
+def test_truncated_multipart_upload_is_a_client_error(client, make_jpeg):
+    body, content_type = multipart([('image', make_jpeg((5, 5, 5)))])
+    truncated = body[:-len(b'--frames--\r\n')]
+
+    single = client.post('/api/upload', data=truncated, content_type=content_type)
+    batch = client.post('/api/upload/batch', data=truncated, content_type=content_type)
+
+    assert single.status_code == 400
+    assert batch.status_code == 400
+
+
+def test_batch_waits_for_slots_once_admitted(client, make_jpeg, app_module):
+    executor = app_module.crypto_executor
+    release = threading.Event()
+    # Leave a single free slot in the executor
+    busy = [executor.submit(release.wait, block=True)
+            for _ in range(executor.workers + executor.max_queue - 1)]
+    timer = threading.Timer(0.3, release.set)
+    timer.start()
+    try:
+        items = [{"image": base64.b64encode(make_jpeg((n, 0, 0))).decode('ascii')}
+                 for n in (1, 2, 3)]
+        response = client.post('/api/upload/batch', json={"images": items})
+    finally:
+        release.set()
+        timer.cancel()
+        for future in busy:
+            future.result()
+
+    assert response.status_code == 200
+    assert response.get_json()["stored"] == 3
+
+
+def test_batch_larger_than_the_executor_is_refused(client, app_module):
+    executor = app_module.crypto_executor
+    items = [{"image": ""}] * (executor.workers + executor.max_queue + 1)
+
+    response = client.post('/api/upload/batch', json={"images": items})
+
+    assert response.status_code == 413
+
+
+def test_renditions_run_off_the_crypto_executor(upload, make_jpeg, app_module):
+    def jobs(executor):
+        counts = executor.stats()
+        return counts["in_flight"] + counts["completed"]
+    renditions_before = jobs(app_module.rendition_executor)
+
+    upload(make_jpeg((70, 140, 210)))
+
+    assert jobs(app_module.rendition_executor) == renditions_before + 1
+
+
+def test_listing_shows_only_public_fields(client, upload, make_jpeg):
+    upload(make_jpeg((1, 2, 3)))
+
+    images = client.get('/api/images?details=true&order=desc&limit=5').get_json()["images"]
+
+    assert images and all(set(image) == set(catalog.PUBLIC_FIELDS) for image in images)
+
+
+def test_feed_resumes_after_last_event_id(client, upload, make_jpeg, app_module):
+    seen = app_module.image_catalog.last_seq()
+    filenames = [upload(make_jpeg((n, 50, 50)))["filename"] for n in (100, 150)]
+
+    # The stream ends after FEED_MAX_SECONDS
+    response = client.get('/api/images/events', headers={'Last-Event-ID': str(seen)},
+                          buffered=True)
+
+    events = [
+        json.loads(line[len('data: '):])
+        for line in response.get_data(as_text=True).splitlines() if line.startswith('data: ')
+    ]
+    assert response.mimetype == 'text/event-stream'
+    assert [event["filename"] for event in events] == filenames
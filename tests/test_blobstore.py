@@ -0,0 +1,73 @@
+"""Pack storage: reading, deleting, rebuilding the index and compaction"""
+import os
+
+import pytest
+
+import blobstore
+import storage
+
+
+def store_images(store, count, size=600):
+    """Commit count images of random ciphertext; returns {filename: ciphertext}"""
+    images = {}
+    for _ in range(count):
+        filename = storage.image_filename(storage.new_image_id())
+        images[filename] = os.urandom(size)
+        metadata = {"filename": filename, "server_timestamp": 1000}
+        store.commit([(filename, {"ciphertext": images[filename]}, metadata)])
+    return images
+
+
+def read(store, filename):
+    location = store.locate(filename)
+    if location is None:
+        return None
+    with blobstore.open_location(location) as f:
+        return f.read()
+
+
+@pytest.fixture
+def packs(storage_dir):
+    store = blobstore.PackStore(storage_dir, pack_bytes=2000)
+    store.open()
+    return store
+
+
+def test_images_are_read_back_from_packs(packs):
+    images = store_images(packs, 5)
+
+    assert len(packs.pack_names()) > 1
+    for filename, ciphertext in images.items():
+        assert read(packs, filename) == ciphertext
+    assert sorted(record['filename'] for record in packs.iter_records()) == sorted(images)
+
+
+def test_deleted_images_stay_deleted_after_an_index_rebuild(packs, storage_dir):
+    images = store_images(packs, 3)
+    deleted, *kept = sorted(images)
+    assert packs.delete(deleted) == len(images[deleted])
+
+    os.remove(os.path.join(storage_dir, blobstore.PACK_DIR, blobstore.INDEX_FILE))
+    rebuilt = blobstore.PackStore(storage_dir, pack_bytes=2000)
+    rebuilt.open()
+
+    assert read(rebuilt, deleted) is None
+    for filename in kept:
+        assert read(rebuilt, filename) == images[filename]
+
+
+def test_compaction_moves_live_images_out_of_mostly_deleted_packs(packs):
+    images = store_images(packs, 8)
+    first_pack = packs.pack_names()[0]
+    in_first = [name for name in images
+                if os.path.basename(packs.locate(name).path) == first_pack]
+    for filename in in_first[:-1]:
+        packs.delete(filename)
+
+    compacted, reclaimed = packs.compact()
+
+    assert compacted >= 1 and reclaimed > 0
+    survivor = in_first[-1]
+    assert os.path.basename(packs.locate(survivor).path) != first_pack
+    for filename in set(images) - set(in_first[:-1]):
+        assert read(packs, filename) == images[filename]
@@ -0,0 +1,78 @@
+"""Catalog: keyset pagination, sequence numbers and rebuilds"""
+import os
+
+import pytest
+
+from catalog import Catalog
+
+
+def record(number, timestamp=1000):
+    return {'filename': f"image_{number:026d}.enc", 'server_timestamp': timestamp,
+            'size': 100 + number, 'sha256': 'ab' * 32, 'digest': 'cd' * 32}
+
+
+@pytest.fixture
+def stored():
+    """Records the catalog is rebuilt from"""
+    return []
+
+
+@pytest.fixture
+def image_catalog(storage_dir, stored):
+    image_catalog = Catalog(os.path.join(storage_dir, 'catalog.db'), storage_dir,
+                            records=lambda: iter(stored))
+    image_catalog.open()
+    return image_catalog
+
+
+def all_pages(image_catalog, limit, descending=False):
+    filenames = []
+    cursor = None
+    while True:
+        rows, cursor = image_catalog.list_images(cursor=cursor, limit=limit, descending=descending)
+        filenames.extend(row['filename'] for row in rows)
+        if cursor is None:
+            return filenames
+
+
+@pytest.mark.parametrize('descending', [False, True])
+def test_pages_list_every_image_once_in_order(image_catalog, descending):
+    # Several images per timestamp, so pages split runs of equal timestamps
+    records = [record(n, timestamp=1000 + n // 4) for n in range(25)]
+    image_catalog.add(records)
+
+    expected = [r['filename'] for r in sorted(
+        records, key=lambda r: (r['server_timestamp'], r['filename']), reverse=descending
+    )]
+    assert all_pages(image_catalog, limit=7, descending=descending) == expected
+
+
+def test_malformed_cursor_is_rejected(image_catalog):
+    with pytest.raises(ValueError):
+        image_catalog.list_images(cursor='not-a-cursor')
+
+
+def test_seq_is_not_reused_after_newest_image_is_deleted(image_catalog):
+    image_catalog.add([record(1), record(2)])
+    seen = image_catalog.last_seq()
+
+    image_catalog.remove([record(2)['filename']])
+    image_catalog.add([record(3)])
+
+    assert [row['filename'] for row in image_catalog.recorded_since(seen)] == [
+        record(3)['filename']
+    ]
+
+
+def test_rebuild_after_losing_rows_numbers_images_after_old_ones(image_catalog, stored):
+    stored.extend(record(n) for n in range(3))
+    image_catalog.add(stored)
+    seen = image_catalog.last_seq()
+    # Losing the newest rows leaves fewer ids in use than images to restore
+    image_catalog.remove([stored[1]['filename'], stored[2]['filename']])
+
+    assert image_catalog.rebuild() == 3
+
+    rows = image_catalog.recorded_since(seen)
+    assert sorted(row['filename'] for row in rows) == sorted(r['filename'] for r in stored)
+    assert min(row['seq'] for row in rows) == seen + 1
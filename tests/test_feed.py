@@ -0,0 +1,74 @@
+"""Server-Sent Events feed: resuming after an event id"""
+import json
+import os
+
+import pytest
+
+from catalog import PUBLIC_FIELDS, Catalog
+from feed import FeedFull, ImageFeed
+
+
+def record(number):
+    return {'filename': f"image_{number:026d}.enc", 'server_timestamp': 1000 + number,
+            'size': 10, 'sha256': 'ab' * 32, 'digest': 'cd' * 32, 'blob': 'x'}
+
+
+def read_events(stream):
+    """(id, data) of every image event until the stream ends"""
+    events = []
+    for text in stream:
+        fields = dict(line.split(': ', 1) for line in text.splitlines() if ': ' in line)
+        if fields.get('event') == 'image':
+            events.append((int(fields['id']), json.loads(fields['data'])))
+    return events
+
+
+@pytest.fixture
+def image_catalog(storage_dir):
+    image_catalog = Catalog(os.path.join(storage_dir, 'catalog.db'), storage_dir, records=list)
+    image_catalog.open()
+    return image_catalog
+
+
+@pytest.fixture
+def image_feed(image_catalog):
+    return ImageFeed(image_catalog, max_seconds=0.3, keepalive=0.1, poll_interval=0.05)
+
+
+def test_resumes_after_the_last_event_id(image_catalog, image_feed):
+    image_catalog.add([record(n) for n in range(3)])
+    first = image_catalog.recorded_since(0)[0]
+
+    stream = image_feed.subscribe(str(first['seq']))
+    try:
+        events = read_events(stream)
+    finally:
+        stream.close()
+
+    assert [data['filename'] for _, data in events] == [record(1)['filename'], record(2)['filename']]
+    assert [seq for seq, _ in events] == [first['seq'] + 1, first['seq'] + 2]
+    # Dedup digests, blob links and hashes stay on the server
+    assert all(set(data) == set(PUBLIC_FIELDS) for _, data in events)
+
+
+def test_new_stream_only_gets_images_stored_afterwards(image_catalog, image_feed):
+    image_catalog.add([record(1)])
+    stream = image_feed.subscribe()
+    try:
+        image_catalog.add([record(2)])
+        image_feed.notify()
+        events = read_events(stream)
+    finally:
+        stream.close()
+
+    assert [data['filename'] for _, data in events] == [record(2)['filename']]
+
+
+def test_clients_are_limited_and_released_on_close(image_catalog):
+    image_feed = ImageFeed(image_catalog, max_clients=1)
+    stream = image_feed.subscribe()
+    with pytest.raises(FeedFull):
+        image_feed.subscribe()
+    stream.close()
+    image_feed.subscribe().close()
+    assert image_feed.clients == 0
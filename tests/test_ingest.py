@@ -0,0 +1,57 @@
+"""Asynchronous ingest: draining the journal, failures and retries"""
+import os
+
+import pytest
+
+from crypto_pool import QueueFull
+from ingest import IngestJournal, IngestWorkers
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return IngestJournal(str(tmp_path / '.ingest'), os.urandom(32))
+
+
+def test_jobs_are_stored_oldest_first(journal):
+    for job_id in ('01A', '01B', '01C'):
+        journal.append(job_id, job_id.encode(), {"n": job_id})
+    stored = []
+    workers = IngestWorkers(journal, lambda job_id, fields, payload: stored.append(payload))
+
+    while workers._work_once():
+        pass
+
+    assert stored == [b'01A', b'01B', b'01C']
+    assert journal.count() == 0
+    assert workers.stats()["stored"] == 3
+
+
+def test_transient_errors_leave_the_job_queued(journal):
+    journal.append('01A', b'image', {})
+    errors = [QueueFull(1), OSError("disk full")]
+
+    def process(job_id, fields, payload):
+        if errors:
+            raise errors.pop(0)
+
+    workers = IngestWorkers(journal, process, transient=(OSError, QueueFull))
+
+    assert not workers._work_once()
+    assert journal.state('01A') == 'queued'
+    assert not workers._work_once()
+    assert workers._work_once()
+    assert journal.state('01A') is None
+    assert workers.stats()["retried"] == 2
+
+
+def test_other_errors_fail_the_job(journal):
+    journal.append('01A', b'image', {})
+
+    def process(job_id, fields, payload):
+        raise ValueError("not an image")
+
+    workers = IngestWorkers(journal, process)
+
+    assert workers._work_once()
+    assert journal.state('01A') == 'failed'
+    assert journal.error('01A') == "not an image"
@@ -0,0 +1,86 @@
+"""Retention and garbage collection"""
+import json
+import os
+
+import pytest
+
+import blobstore
+import storage
+from catalog import Catalog
+from retention import GarbageCollector
+
+
+def store_image(store, image_catalog, server_timestamp):
+    filename = storage.image_filename(storage.new_image_id())
+    with open(store.target(filename), 'wb') as f:
+        f.write(os.urandom(100))
+    metadata = {"filename": filename, "server_timestamp": server_timestamp, "size": 100}
+    store.commit([(filename, {}, metadata)])
+    image_catalog.add([metadata])
+    return filename
+
+
+@pytest.fixture
+def store(storage_dir):
+    store = blobstore.FileStore(storage_dir)
+    store.open()
+    return store
+
+
+@pytest.fixture
+def image_catalog(storage_dir, store):
+    image_catalog = Catalog(os.path.join(storage_dir, 'catalog.db'), storage_dir,
+                            records=store.iter_records)
+    image_catalog.open()
+    return image_catalog
+
+
+def test_expired_images_are_deleted_with_their_records(storage_dir, store, image_catalog):
+    old = store_image(store, image_catalog, server_timestamp=1000)
+    new = store_image(store, image_catalog, server_timestamp=5000)
+    gc = GarbageCollector(storage_dir, image_catalog, store, max_age=1000, rate=0)
+
+    assert gc.expire(now=5500) == 1
+
+    assert store.locate(old) is None
+    assert image_catalog.get(old) is None
+    assert store.locate(new) is not None
+    assert gc.removed['expired'] == 1
+
+
+def test_quota_deletes_oldest_images_first(storage_dir, store, image_catalog):
+    filenames = [store_image(store, image_catalog, server_timestamp=1000 + n) for n in range(4)]
+    gc = GarbageCollector(storage_dir, image_catalog, store, max_bytes=150, rate=0)
+
+    gc.enforce_quota()
+
+    assert [store.locate(name) is not None for name in filenames] == [False, False, True, True]
+
+
+def test_orphaned_sidecars_are_removed_after_the_grace_period(storage_dir, store, image_catalog):
+    filename = storage.image_filename(storage.new_image_id())
+    sidecar = storage.metadata_path(storage_dir, filename, create=True)
+    with open(sidecar, 'w') as f:
+        json.dump({"filename": filename}, f)
+    kept = store_image(store, image_catalog, server_timestamp=1000)
+    gc = GarbageCollector(storage_dir, image_catalog, store, rate=0)
+
+    assert gc.remove_orphans(now=os.stat(sidecar).st_mtime + gc.grace / 2) == 0
+    assert gc.remove_orphans(now=os.stat(sidecar).st_mtime + gc.grace + 1) == 1
+
+    assert not os.path.exists(sidecar)
+    assert store.locate(kept) is not None
+
+
+def test_each_orphan_is_throttled_once(storage_dir, store, image_catalog):
+    for _ in range(5):
+        filename = storage.image_filename(storage.new_image_id())
+        sidecar = storage.metadata_path(storage_dir, filename, create=True)
+        open(sidecar, 'w').close()
+    gc = GarbageCollector(storage_dir, image_catalog, store, rate=0)
+    calls = []
+    gc._throttle = lambda: calls.append(1)
+    scanned = sum(len(os.listdir(directory)) for directory in storage.iter_directories(storage_dir))
+
+    assert gc.remove_orphans(now=os.path.getmtime(sidecar) + gc.grace + 1) == 5
+    assert len(calls) == scanned
@@ -0,0 +1,44 @@
+"""Key rotation: reloading the keyring and moving images to the new key"""
+import io
+import os
+
+import envelope
+import keystore
+import rewrap_keys
+
+
+def encrypt_file(keyring, path, plaintext):
+    with open(path, 'wb') as f:
+        keyring.encrypt_stream(io.BytesIO(plaintext), f)
+
+
+def key_id_of(path):
+    with open(path, 'rb') as f:
+        return envelope.read_header(f).key_id
+
+
+def test_keyring_picks_up_a_rotated_key(keyring, storage_dir):
+    old_id = keyring.active.key_id
+
+    _, new_id = keystore.rotate(storage_dir)
+
+    assert keyring.active.key_id.hex() == new_id
+    assert keyring.get(old_id).key_id == old_id
+
+
+def test_rewrapped_image_names_the_new_key_and_decrypts(keyring, storage_dir):
+    plaintext = os.urandom(200 * 1024)
+    path = os.path.join(storage_dir, 'image.enc')
+    encrypt_file(keyring, path, plaintext)
+    mtime = os.stat(path).st_mtime_ns
+    keystore.rotate(storage_dir)
+
+    action, size, _ = rewrap_keys.rewrap_file(path, keyring.load())
+
+    assert action == 'rewrapped'
+    assert size == os.path.getsize(path)
+    assert key_id_of(path) == keyring.active.key_id
+    assert os.stat(path).st_mtime_ns == mtime
+    with open(path, 'rb') as f:
+        assert keyring.decrypt(f.read()) == plaintext
+    assert rewrap_keys.rewrap_file(path, keyring.load())[0] == 'current'
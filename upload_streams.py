@@ -0,0 +1,187 @@
+"""Readable wrappers used to feed request bodies into the encryption pipeline.
+
+All wrappers expose a read(size) method, so they can be passed to
+envelope.encrypt_stream like any file object. They also record how many bytes
+came off the wire, how long was spent reading and parsing them, and any
+plain form fields that arrived with the image.
+"""
+import contextlib
+import io
+import time
+
+from werkzeug.sansio.multipart import NEED_DATA, Data, Epilogue, Field, File, MultipartDecoder
+
+READ_SIZE = 64 * 1024
+
+# Upper bound for plain (non-file) form fields such as the capture timestamp
+MAX_FIELD_SIZE = 4 * 1024
+
+
+class MalformedUpload(Exception):
+    """Raised when a multipart body can't be parsed (answered with 400)"""
+
+
+@contextlib.contextmanager
+def _parsing():
+    # werkzeug's parser reports bad input as ValueError or EOFError
+    try:
+        yield
+    except (ValueError, EOFError) as e:
+        raise MalformedUpload(f"Malformed multipart body: {e}") from e
+
+
+class DecodedBody(io.BytesIO):
+    """Image already decoded from a JSON body, with the same counters"""
+
+    def __init__(self, data, bytes_received, parse_time, fields):
+        super().__init__(data)
+        self.bytes_received = bytes_received
+        self.parse_time = parse_time
+        self.fields = fields
+
+
+class MeteredStream:
+    """Pass-through reader that counts bytes and time spent in read()"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.fields = {}
+        self.bytes_received = 0
+        self.parse_time = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self._stream.read(size)
+        self.parse_time += time.perf_counter() - start
+        self.bytes_received += len(data)
+        return data
+
+
+class MultipartImageReader:
+    """Readable view of one file part of a multipart/form-data body
+
+    The body is parsed incrementally while it is read, so the file part is
+    handed on in wire-sized pieces instead of being spooled to memory or a
+    temporary file first. Plain form fields seen along the way are collected
+    in `fields`; `found` tells whether the file part was present at all.
+    """
+
+    def __init__(self, stream, boundary, field_name='image'):
+        self._stream = stream
+        self._decoder = MultipartDecoder(boundary)
+        self._field_name = field_name
+        self._pending = bytearray()
+        self._part = None
+        self._value = bytearray()
+        self._done = False
+        self.fields = {}
+        self.found = False
+        self.bytes_received = 0
+        self.parse_time = 0.0
+
+    def read(self, size=-1):
+        while not self._done and (size < 0 or len(self._pending) < size):
+            self._advance()
+        if size < 0:
+            size = len(self._pending)
+        chunk = bytes(self._pending[:size])
+        del self._pending[:size]
+        return chunk
+
+    def _advance(self):
+        start = time.perf_counter()
+        with _parsing():
+            event = self._decoder.next_event()
+
+        if event is NEED_DATA:
+            data = self._stream.read(READ_SIZE)
+            self.bytes_received += len(data)
+            with _parsing():
+                self._decoder.receive_data(data or None)
+        elif isinstance(event, File) and event.name == self._field_name and not self.found:
+            self._part = 'image'
+            self.found = True
+        elif isinstance(event, File):
+            # Other file parts are skipped
+            self._part = None
+        elif isinstance(event, Field):
+            self._part = event.name
+            self._value = bytearray()
+        elif isinstance(event, Data):
+            self._receive_part_data(event)
+        elif isinstance(event, Epilogue):
+            self._done = True
+
+        self.parse_time += time.perf_counter() - start
+
+    def _receive_part_data(self, event):
+        if self._part == 'image':
+            self._pending += event.data
+        elif self._part is not None:
+            if len(self._value) + len(event.data) > MAX_FIELD_SIZE:
+                raise MalformedUpload(f"Form field too large: {self._part}")
+            self._value += event.data
+            if not event.more_data:
+                self.fields[self._part] = self._value.decode('utf-8', 'replace')
+
+        if not event.more_data:
+            self._part = None
+
+
+def iter_multipart_files(stream, boundary, field_name='image'):
+    """Yield (data, fields) for each file part of a multipart body
+
+    Each part is yielded once the next one starts (or the body ends), so
+    callers can start processing an image while later ones are still
+    arriving. `fields` is a list of (name, value) pairs for the plain form
+    fields sent after the file part, up to the next one, as in
+    `image, timestamp, image, timestamp`. Fields before the first file part
+    go with it.
+    """
+    decoder = MultipartDecoder(boundary)
+    fields = []
+    part = None
+    in_image = False
+    value = bytearray()
+    # File part waiting for the fields that follow it
+    image = None
+
+    while True:
+        with _parsing():
+            event = decoder.next_event()
+
+        if event is NEED_DATA:
+            data = stream.read(READ_SIZE)
+            with _parsing():
+                decoder.receive_data(data or None)
+        elif isinstance(event, File):
+            # Other file parts are skipped
+            in_image = event.name == field_name
+            if in_image and image is not None:
+                yield image, fields
+                image, fields = None, []
+            part = None
+            value = bytearray()
+        elif isinstance(event, Field):
+            in_image = False
+            part = event.name
+            value = bytearray()
+        elif isinstance(event, Data):
+            if in_image:
+                value += event.data
+            elif part is not None:
+                if len(value) + len(event.data) > MAX_FIELD_SIZE:
+                    raise MalformedUpload(f"Form field too large: {part}")
+                value += event.data
+            if not event.more_data:
+                if in_image:
+                    image = bytes(value)
+                elif part is not None:
+                    fields.append((part, value.decode('utf-8', 'replace')))
+                in_image = False
+                part = None
+                value = bytearray()
+        elif isinstance(event, Epilogue):
+            if image is not None:
+                yield image, fields
+            return